@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""Deploy and export benchmarks on the fake odbc driver.
+
+A synthetic catalog is exported with `RepoGenerator`, the export becomes
+the upstream repository of a `Listener` and a commit touching some module
+scripts of every database is deployed with `handle_changes`. Login and
+round-trip latencies are simulated, see `tests/fake_odbc.py`.
+
+Example:
+    python benchmarks/bench_deploy.py --databases 4 --objects 300 --changed 50 --round-trip-ms 2
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+
+from git import Actor, Repo
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from deploydb import Listener, RepoGenerator  # noqa: E402
+from deploydb.db import set_driver  # noqa: E402
+from tests import fake_odbc  # noqa: E402
+
+
+ACTOR = Actor('deploydb', 'deploydb@localhost')
+
+
+def build_server(args):
+    """ Returns a fake server with `objects` tables, views and procedures per database, no latency yet. """
+    server = fake_odbc.reset()
+    set_driver(fake_odbc)  # pools of the previous server are dropped
+    for d in range(args.databases):
+        db_name = f'Db{d:02}'
+        for i in range(args.objects):
+            kind = i % 3
+            if kind == 0:
+                columns = [('Id', 'int NOT NULL'), ('Name', 'nvarchar(50) NULL')]
+                server.add_object(db_name, 'U', 'dbo', f'Table{i}', columns=columns)
+            elif kind == 1:
+                server.add_object(db_name, 'V', 'dbo', f'View{i}', f'CREATE VIEW View{i}\r\nAS\r\nSELECT {i} AS Id')
+            else:
+                definition = f'CREATE PROCEDURE Proc{i}\r\nAS\r\nSELECT {i} AS Id'
+                server.add_object(db_name, 'P', 'dbo', f'Proc{i}', definition)
+    return server
+
+
+def simulate(server, args):
+    server.connect_latency = args.connect_ms / 1000
+    server.round_trip_latency = args.round_trip_ms / 1000
+    server.stats.clear()
+
+
+def config(root):
+    return {
+        'local_path': os.path.join(root, 'local'),
+        'https_url': os.path.join(root, 'remote'),
+        'target_branch': 'main',
+        'db_creds': {
+            'driver': 'fake', 'server': 'fake', 'user': 'sa', 'passw': 'sa',
+            'default_db': 'master', 'timeout': 5, 'pool_size': 8,
+        },
+    }
+
+
+@contextlib.contextmanager
+def quiet():
+    """ Hides progress bars and the output of the listener. """
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        yield
+
+
+def measure(name, server, func):
+    start = time.perf_counter()
+    with quiet():
+        func()
+    return {
+        'name': name,
+        'seconds': round(time.perf_counter() - start, 3),
+        'round_trips': server.stats['round_trips'],
+        'connects': server.stats['connects'],
+        'scripts': server.stats['scripts'],
+    }
+
+
+def bench_export(args, root, name, **kwargs):
+    server = build_server(args)
+    simulate(server, args)
+    export_path = os.path.join(root, name)
+    return measure(name, server, lambda: RepoGenerator(config=config(root), export_path=export_path, **kwargs).run())
+
+
+def bench_deploy(args, root, name, **kwargs):
+    server = build_server(args)
+    workdir = os.path.join(root, name)
+    cfg = config(workdir)
+    with quiet():
+        RepoGenerator(config=cfg, export_path=cfg['https_url'], git_branch='main', checkout=True).run()
+        listener = Listener(cfg, changelog_path=os.path.join(workdir, 'changelog.csv'), **kwargs)
+
+    remote = Repo(cfg['https_url'])
+    server.databases['master'].changelog.append(remote.head.commit.hexsha)
+
+    changed = []
+    for db_name in sorted(os.listdir(os.path.join(cfg['https_url'], 'Databases'))):
+        scripts = [
+            f'Databases/{db_name}/{folder}/{x}'
+            for folder in ('Views', 'Stored-Procedures')
+            for x in sorted(os.listdir(os.path.join(cfg['https_url'], 'Databases', db_name, folder)))
+            if x.endswith('.sql')
+        ]
+        changed.extend(scripts[:args.changed])
+    for path in changed:
+        full_path = os.path.join(cfg['https_url'], path)
+        with open(full_path, encoding='utf-8') as f:
+            script = f.read()
+        with open(full_path, mode='w', encoding='utf-8') as f:
+            f.write(script.replace('CREATE ', 'CREATE OR ALTER ', 1) + '-- changed\n')
+    remote.index.add(changed)
+    remote.index.commit('benchmark change', author=ACTOR, committer=ACTOR)
+
+    simulate(server, args)
+    return measure(name, server, listener.handle_changes)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--databases', type=int, default=3)
+    parser.add_argument('--objects', type=int, default=150, help='objects per database')
+    parser.add_argument('--changed', type=int, default=30, help='module scripts changed per database')
+    parser.add_argument('--connect-ms', type=float, default=20.0, help='simulated login cost')
+    parser.add_argument('--round-trip-ms', type=float, default=1.0, help='simulated latency of every request')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--json', action='store_true', help='prints json lines instead of a table')
+    args = parser.parse_args(argv)
+
+    root = tempfile.mkdtemp(prefix='deploydb-bench-')
+    try:
+        results = [
+            bench_export(args, root, 'export'),
+            bench_export(args, root, 'export_workers', workers=args.workers),
+            bench_deploy(args, root, 'deploy'),
+            bench_deploy(args, root, 'deploy_bundled', bundle_max_count=50),
+            bench_deploy(args, root, 'deploy_workers', max_workers=args.workers),
+        ]
+    finally:
+        set_driver(None)
+        shutil.rmtree(root, ignore_errors=True)
+
+    if args.json:
+        for x in results:
+            print(json.dumps(dict(x, **{k: v for k, v in vars(args).items() if k != 'json'})))
+        return
+
+    print(f"{'benchmark':<16}{'seconds':>10}{'round trips':>14}{'connects':>10}{'scripts':>10}")
+    for x in results:
+        print(f"{x['name']:<16}{x['seconds']:>10}{x['round_trips']:>14}{x['connects']:>10}{x['scripts']:>10}")
+
+
+if __name__ == '__main__':
+    main()
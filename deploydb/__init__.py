@@ -3,8 +3,22 @@ __author__ = 'Mert Guvencli'
 __email__ = 'guvenclimert@gmail.com'
 __version__ = '0.2.3'
 
-from .repo_generator import RepoGenerator
-from .listener import Listener
+from importlib import import_module
+
+
+# Imported on first access, GitPython, pydantic and tqdm are not loaded by `import deploydb`.
+_LAZY = {
+    "RepoGenerator": ".repo_generator",
+    "Listener": ".listener",
+}
+
+
+def __getattr__(name):
+    if name in _LAZY:
+        value = getattr(import_module(_LAZY[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 __all__ = [
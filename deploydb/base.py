@@ -14,6 +14,8 @@ class Base:
         """
         self.config = config
         self._config: Config = None
+        self._database: Database = None
+        self.metrics = None  # counts the round trips of `_db`, set by the subclasses
         self._handle_config()
 
     def _is_file_path(self):
@@ -34,10 +36,10 @@ class Base:
                 'or a dict containing the parsed file contents.'.format(self.config)
             )
 
-        if self._config:
-            try:
-                _db = Database(self._config.db_creds)
-                with _db.connect() as db:
-                    db.execute("SELECT NULL").fetchone()
-            except:  # noqa
-                raise ValueError('Database connection failed!')
+        # The connection is validated by its first use, see `Database`.
+
+    def _db(self) -> Database:
+        """ Returns the database of the config, connections are pooled. """
+        if self._database is None:
+            self._database = Database(creds=self._config.db_creds, metrics=self.metrics)
+        return self._database
@@ -0,0 +1,118 @@
+import re
+
+
+_SEPARATOR = re.compile(r'^\s*GO(?:\s+(\d+))?\s*(?:--.*)?$', re.IGNORECASE)
+_OPENERS = re.compile(r"--|/\*|'|\[|\"")
+_CLOSERS = {"'": "'", '[': ']', '"': '"'}
+
+
+class _Scanner:
+    """ Tracks comments, string literals and quoted identifiers across lines. """
+
+    def __init__(self) -> None:
+        self.quote = None  # closing char of the open literal/identifier
+        self.comment_depth = 0  # nested /* */ comments
+
+    @property
+    def in_code(self) -> bool:
+        return self.quote is None and self.comment_depth == 0
+
+    def feed(self, line):
+        pos = 0
+        end = len(line)
+        while pos < end:
+            if self.comment_depth:
+                opened = line.find('/*', pos)
+                closed = line.find('*/', pos)
+                if closed < 0 and opened < 0:
+                    return
+                if opened >= 0 and (closed < 0 or opened < closed):
+                    self.comment_depth += 1
+                    pos = opened + 2
+                else:
+                    self.comment_depth -= 1
+                    pos = closed + 2
+            elif self.quote:
+                closed = line.find(self.quote, pos)
+                if closed < 0:
+                    return
+                if line.startswith(self.quote, closed + 1):  # escaped: '' ]] ""
+                    pos = closed + 2
+                else:
+                    self.quote = None
+                    pos = closed + 1
+            else:
+                match = _OPENERS.search(line, pos)
+                if not match:
+                    return
+                token = match.group(0)
+                if token == '--':
+                    return
+                if token == '/*':
+                    self.comment_depth = 1
+                else:
+                    self.quote = _CLOSERS[token]
+                pos = match.end()
+
+
+def iter_batches(stream):
+    """Splits a T-SQL script on `GO` separators while reading it line by line.
+
+    `GO` must be alone on its line (a repeat count and a trailing comment
+    are allowed) and outside of comments, string literals and quoted
+    identifiers, like sqlcmd does. Only the current batch is kept in memory.
+
+    Args:
+        stream: text stream of the script.
+
+    Yields:
+        (batch, count, line_no): batch text, how many times it runs and the
+        line number it starts at. Blank batches are skipped.
+    """
+    scanner = _Scanner()
+    lines = []
+    start_line = 1
+    line_no = 0
+    for line_no, line in enumerate(stream, start=1):
+        if scanner.in_code:
+            separator = _SEPARATOR.match(line)
+            if separator:
+                batch = ''.join(lines)
+                if batch.strip():
+                    yield batch, int(separator.group(1) or 1), start_line
+                lines = []
+                start_line = line_no + 1
+                continue
+        scanner.feed(line)
+        lines.append(line)
+
+    batch = ''.join(lines)
+    if batch.strip():
+        yield batch, 1, start_line
+
+
+def bundle_scripts(scripts):
+    """Builds a single batch running every script through `sp_executesql`.
+
+    Every script runs in its own TRY/CATCH block so a failing script does
+    not stop the others. The batch ends with a result set of
+    (Seq, IsFailed, Error) rows, `Seq` is the 1-based index of the script.
+    Scripts must be single batches (no `GO`).
+    """
+    parts = [
+        'SET NOCOUNT ON;',
+        'DECLARE @deploydb_results TABLE (Seq INT, IsFailed BIT, Error NVARCHAR(2000));',
+    ]
+    for seq, script in enumerate(scripts, start=1):
+        literal = script.replace("'", "''")
+        parts.append(
+            f"BEGIN TRY\n"
+            f"    EXEC sp_executesql N'{literal}';\n"
+            f"    INSERT INTO @deploydb_results VALUES ({seq}, 0, NULL);\n"
+            f"END TRY\n"
+            f"BEGIN CATCH\n"
+            f"    INSERT INTO @deploydb_results VALUES ({seq}, 1, ERROR_MESSAGE());\n"
+            f"END CATCH;"
+        )
+    parts.append('SELECT Seq, IsFailed, Error FROM @deploydb_results ORDER BY Seq;')
+    return '\n'.join(parts)
@@ -0,0 +1,155 @@
+import os
+import re
+import json
+import threading
+from datetime import datetime
+
+from .script import CATALOG_DELTA
+
+
+# Folder of the repository layout -> sys.objects types
+OBJECT_TYPES = {
+    'Tables': ('U',),
+    'Views': ('V',),
+    'Functions': ('FN', 'IF', 'TF'),
+    'Stored-Procedures': ('P',),
+    'Triggers': ('TR',),
+}
+
+_NAME_PART = re.compile(r'\[((?:[^\]]|\]\])*)\]|([^.\[\]]+)')
+
+
+def split_object_name(object_name, default_schema='dbo'):
+    """Splits a script name into schema and object name.
+
+    Names follow `RepoGenerator._safe_file_name`, e.g. `Orders`, `[My Table]`,
+    `[sales].[Orders]`.
+    """
+    parts = [
+        x.group(1).replace(']]', ']') if x.group(1) is not None else x.group(2)
+        for x in _NAME_PART.finditer(object_name)
+    ]
+    if len(parts) >= 2:
+        return parts[-2], parts[-1]
+    return default_schema, parts[0] if parts else object_name
+
+
+class CatalogSnapshot:
+    """In-memory copy of `sys.objects` per database.
+
+    The first lookup of a database in a run fetches the objects modified
+    since the last known `modify_date` only; a full scan happens when the
+    database is new or the object count does not match (dropped/renamed
+    objects).
+
+    Args:
+        database (Database): pooled database of the listener.
+        cache_path (str, optional): json file the snapshot is persisted to.
+    """
+
+    def __init__(self, database, cache_path=None) -> None:
+        self.database = database
+        self.cache_path = cache_path
+        self._dbs = {}  # db_name -> {"watermark": str, "objects": {(type, schema, name): modify_date}}
+        self._fresh = set()  # databases refreshed in the current run
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, mode='r', encoding='utf-8') as f:
+                data = json.load(f)
+            self._dbs = {
+                db_name: {
+                    'watermark': x['watermark'],
+                    'objects': {(t, s, n): m for t, s, n, m in x['objects']},
+                }
+                for db_name, x in data.items()
+            }
+        except (ValueError, KeyError, TypeError):
+            self._dbs = {}  # broken cache file, rescans.
+
+    def save(self):
+        """ Persists the snapshot to `cache_path` if it is set. """
+        if not self.cache_path:
+            return
+        with self._lock:
+            data = {
+                db_name: {
+                    'watermark': x['watermark'],
+                    'objects': [[t, s, n, m] for (t, s, n), m in x['objects'].items()],
+                }
+                for db_name, x in self._dbs.items()
+            }
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, mode='w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.cache_path)
+
+    def begin_run(self):
+        """ Every database is refreshed again at its first lookup. """
+        with self._lock:
+            self._fresh.clear()
+
+    def invalidate(self, db_name):
+        """ The database is refreshed (incrementally) at its next lookup. """
+        with self._lock:
+            self._fresh.discard(db_name)
+
+    def note_created(self, db_name, object_type, object_name):
+        """ Registers an object created by deploydb without asking the server. """
+        schema_name, name = split_object_name(object_name)
+        with self._lock:
+            snapshot = self._dbs.get(db_name)
+            if snapshot is None:
+                return
+            for type_ in OBJECT_TYPES.get(object_type, ())[:1]:
+                snapshot['objects'][(type_, schema_name.lower(), name.lower())] = snapshot['watermark']
+
+    def _refresh(self, db_name):
+        with self._lock:
+            if db_name in self._fresh:
+                return
+            snapshot = self._dbs.get(db_name)
+
+        if snapshot is None:
+            snapshot = {'watermark': '1900-01-01T00:00:00', 'objects': {}}
+        else:
+            snapshot = {'watermark': snapshot['watermark'], 'objects': dict(snapshot['objects'])}
+
+        watermark = datetime.fromisoformat(snapshot['watermark'])
+        with self.database.connect(db_name, phase='policy') as db:
+            cursor = db.execute(CATALOG_DELTA, watermark)
+            total = cursor.fetchone().TOTAL
+            cursor.nextset()
+            rows = cursor.fetchall()
+            self._merge(snapshot, rows)
+
+            if len(snapshot['objects']) != total:
+                snapshot = {'watermark': '1900-01-01T00:00:00', 'objects': {}}
+                cursor = db.execute(CATALOG_DELTA, datetime(1900, 1, 1))
+                cursor.fetchone()
+                cursor.nextset()
+                self._merge(snapshot, cursor.fetchall())
+
+        with self._lock:
+            self._dbs[db_name] = snapshot
+            self._fresh.add(db_name)
+
+    def _merge(self, snapshot, rows):
+        objects = snapshot['objects']
+        for row in rows:
+            modify_date = row.MODIFY_DATE.isoformat()
+            objects[(row.TYPE, row.SCHEMA_NAME.lower(), row.OBJECT_NAME.lower())] = modify_date
+            if modify_date > snapshot['watermark']:
+                snapshot['watermark'] = modify_date
+
+    def exists(self, db_name, object_type, object_name) -> bool:
+        self._refresh(db_name)
+        schema_name, name = split_object_name(object_name)
+        key = (schema_name.lower(), name.lower())
+        with self._lock:
+            objects = self._dbs[db_name]['objects']
+            return any((type_,) + key in objects for type_ in OBJECT_TYPES.get(object_type, ()))
@@ -1,38 +1,298 @@
-
-import sys
+import time
+import threading
+from collections import deque
 from contextlib import contextmanager
-import pyodbc
 
 from .model import DbCreds
+from .script import RESET_SESSION
+
+
+# Statement sent on every checkout of a reused connection. It switches to the
+# requested database and doubles as the health check; the rollback is a
+# safety net only, connections running deployed scripts are reset on checkin.
+# Fresh connections log in to the requested database and skip it.
+_CHECKOUT = "IF @@TRANCOUNT > 0 ROLLBACK; USE [{db_name}];"
+
+_driver = None
+
+
+def get_driver():
+    """ Returns the odbc module connections are opened with, `pyodbc` unless replaced. """
+    global _driver
+    if _driver is None:
+        import pyodbc
+        _driver = pyodbc
+    return _driver
+
+
+def set_driver(driver):
+    """Replaces the odbc module, e.g. with `tests/fake_odbc.py`.
+
+    Pools of the previous driver are closed and forgotten.
+    """
+    global _driver
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+        _driver = driver
+
+
+class ConnectionPool:
+    """ Keeps reusable connections of a single server. """
+
+    def __init__(self, conn_str, *, max_size=5, idle_timeout=300, timeout=30, checkout_timeout=60) -> None:
+        """Creates an empty pool, connections are opened on demand.
+
+        Args:
+            conn_str (str): odbc connection string.
+            max_size (int, optional): max number of open connections.
+            idle_timeout (int, optional): seconds after an idle connection is closed.
+            timeout (int, optional): query timeout of the connections.
+            checkout_timeout (float, optional): max seconds `checkout` waits for a free connection.
+        """
+        self._conn_str = conn_str
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.checkout_timeout = checkout_timeout
+        self._idle = {}  # db_name -> deque of (connection, released_at)
+        self._size = 0
+        self._cond = threading.Condition()
+
+    def _open(self, db_name):
+        database = '{' + db_name.replace('}', '}}') + '}'
+        connection = get_driver().connect(
+            str=f'{self._conn_str};DATABASE={database}',
+            autocommit=True
+        )
+        connection.timeout = self.timeout
+        return connection
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except get_driver().Error:
+            pass
+
+    def _evict(self):
+        """ Closes connections idle longer than `idle_timeout`. Lock must be held. """
+        expired_at = time.monotonic() - self.idle_timeout
+        for db_name in list(self._idle):
+            queue = self._idle[db_name]
+            while queue and queue[0][1] < expired_at:
+                connection, _ = queue.popleft()
+                self._discard(connection)
+                self._size -= 1
+            if not queue:
+                del self._idle[db_name]
+
+    def _take_idle(self, db_name):
+        """ Prefers a connection already on `db_name`, otherwise any idle one. Lock must be held. """
+        for key in [db_name] + [x for x in self._idle if x != db_name]:
+            queue = self._idle.get(key)
+            if queue:
+                connection, _ = queue.pop()  # most recently used first
+                if not queue:
+                    del self._idle[key]
+                return connection
+        return None
+
+    def _reserve(self, db_name):
+        deadline = time.monotonic() + self.checkout_timeout
+        with self._cond:
+            while True:
+                self._evict()
+                connection = self._take_idle(db_name)
+                if connection is not None:
+                    return connection
+                if self._size < self.max_size:
+                    self._size += 1
+                    return None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(
+                        f'No free connection in the pool after {self.checkout_timeout} sec, '
+                        f'all {self.max_size} are in use (db_creds.pool_size).'
+                    )
+                self._cond.wait(remaining)
+
+    def _release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def checkout(self, db_name='master'):
+        """Returns a healthy connection switched to `db_name`.
+
+        Reused connections failing on the checkout statement are dropped
+        and replaced by a fresh one.
+        """
+        connection = self._reserve(db_name)
+        if connection is not None:
+            try:
+                connection.execute(_CHECKOUT.format(db_name=db_name))
+                return connection
+            except get_driver().Error:
+                self._discard(connection)
+
+        try:
+            return self._open(db_name)
+        except:  # noqa
+            self._release_slot()
+            raise
+
+    def checkin(self, connection, db_name='master', broken=False, reset=False):
+        """Gives the connection back to the pool.
+
+        Broken ones are closed, which also rolls back an open transaction
+        at once. `reset` runs `RESET_SESSION` first, a connection failing
+        on it is closed.
+        """
+        if reset and not broken:
+            try:
+                connection.execute(RESET_SESSION)
+            except get_driver().Error:
+                broken = True
+        if broken:
+            self._discard(connection)
+            self._release_slot()
+            return
+
+        with self._cond:
+            self._idle.setdefault(db_name, deque()).append((connection, time.monotonic()))
+            self._cond.notify()
+
+    def close(self):
+        """ Closes all idle connections. """
+        with self._cond:
+            for queue in self._idle.values():
+                for connection, _ in queue:
+                    self._discard(connection)
+                    self._size -= 1
+            self._idle.clear()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(conn_str, **kwargs) -> ConnectionPool:
+    """ Returns the process wide pool of the connection string. """
+    with _pools_lock:
+        if conn_str not in _pools:
+            _pools[conn_str] = ConnectionPool(conn_str, **kwargs)
+        return _pools[conn_str]
+
+
+class CountingCursor:
+    """Cursor of the driver counting the requests it sends.
+
+    Every `execute`, `executemany` (one request with `fast_executemany`,
+    one per row otherwise), `commit` and `rollback` is counted in
+    `deploydb_round_trips_total{phase=...}`. `phase` may be changed while
+    the cursor is used, other attributes are the driver cursor's.
+    """
+
+    def __init__(self, cursor, metrics, phase) -> None:
+        object.__setattr__(self, '_cursor', cursor)
+        object.__setattr__(self, 'metrics', metrics)
+        object.__setattr__(self, 'phase', phase)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        if name in ('metrics', 'phase'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._cursor, name, value)
+
+    def _count(self, value=1):
+        if self.metrics is not None:
+            self.metrics.inc('deploydb_round_trips_total', value, phase=self.phase)
+
+    def execute(self, sql, *params):
+        self._count()
+        self._cursor.execute(sql, *params)
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        self._count(1 if self._cursor.fast_executemany else len(seq_of_params))
+        self._cursor.executemany(sql, seq_of_params)
+
+    def commit(self):
+        self._count()
+        self._cursor.commit()
+
+    def rollback(self):
+        self._count()
+        self._cursor.rollback()
 
 
 class Database:
-    """ Represents a database connection """
+    """Represents a database connection
+
+    The credentials are validated by the first connection, a failing one
+    raises `ValueError`.
+
+    Args:
+        creds (DbCreds): server credentials.
+        metrics (Metrics, optional): counts the requests of the connections, see `CountingCursor`.
+    """
 
-    def __init__(self, creds: DbCreds) -> None:
+    def __init__(self, creds: DbCreds, *, metrics=None) -> None:
         self.creds = creds.__dict__
-        self._conn_str = 'APP=deploydb;DRIVER={driver};SERVER={server};DATABASE=master;UID={user};PWD={passw}' # noqa
+        self.metrics = metrics
+        self._conn_str = 'APP=deploydb;DRIVER={driver};SERVER={server};UID={user};PWD={passw}' # noqa
         self._conn_builder()
+        self._validated = False
+        self.pool = _get_pool(
+            self._conn_str,
+            max_size=self.creds.get('pool_size', 5),
+            idle_timeout=self.creds.get('pool_idle_timeout', 300),
+            timeout=self.creds.get('timeout', 30),  # default timeout 30 sec.
+            checkout_timeout=self.creds.get('pool_checkout_timeout', 60),
+        )
 
     def _conn_builder(self) -> str:
         self._conn_str = self._conn_str.format(**self.creds)
 
     @contextmanager
-    def connect(self, db_name='master'):
-        connection = pyodbc.connect(
-            str=self._conn_str,
-            autocommit=True
-        )
-        connection.timeout = self.creds.get('timeout', 30)  # default timeout 30 sec.
+    def connect(self, db_name='master', *, phase='other', reset=False, reuse=True):
+        """Yields a cursor of a pooled connection switched to `db_name`.
+
+        Args:
+            phase (str, optional): label of the counted round trips, see `CountingCursor`.
+            reset (bool, optional): resets the session before the connection goes back
+                to the pool, for deployed scripts changing `SET` options or leaving a
+                transaction open, see `RESET_SESSION`.
+            reuse (bool, optional): `False` closes the connection afterwards instead of
+                pooling it, for scripts leaving state a reset does not clear (temp
+                tables, `IDENTITY_INSERT`).
+        """
+        driver = get_driver()
+        try:
+            connection = self.pool.checkout(db_name)
+        except driver.Error as ex:
+            if self._validated:
+                raise
+            raise ValueError('Database connection failed!') from ex
+        self._validated = True
         cursor = connection.cursor()
+        broken = False
         try:
-            cursor.execute(f"USE [{db_name}];")
-            yield cursor
-        except pyodbc.DatabaseError as err:
-            error, = err.args
-            sys.stderr.write(error.message)
-            raise error.message
-        except pyodbc.ProgrammingError as prg:
-            raise prg
+            yield CountingCursor(cursor, self.metrics, phase)
+        except (driver.ProgrammingError, driver.IntegrityError, driver.DataError):
+            # Errors of the statement, the connection is still usable.
+            raise
+        except driver.Error:
+            broken = True
+            raise
         finally:
-            connection.close()
+            try:
+                cursor.close()
+            except driver.Error:
+                broken = True
+            self.pool.checkin(connection, db_name, broken=broken or not reuse, reset=reset)
@@ -0,0 +1,141 @@
+from .model import ChangedFile, EXECUTION_SEQUENCE
+
+
+def _iter_tokens(stream, chunk_size=65536):
+    """ Yields NUL separated tokens of a binary stream without reading it at once. """
+    buffer = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        buffer += chunk
+        *tokens, buffer = buffer.split(b'\0')
+        for token in tokens:
+            yield token.decode('utf-8')
+    if buffer:
+        yield buffer.decode('utf-8')
+
+
+def iter_raw_diff(stream):
+    """Parses `git diff --raw -z` output.
+
+    Yields:
+        (status, src_path, dst_path, src_blob, dst_blob), status is the git
+        status letter (`A`, `M`, `D`, `R`, `C`, `T`); `src_path` and
+        `dst_path` differ for renames and copies only.
+    """
+    tokens = _iter_tokens(stream)
+    for header in tokens:
+        header = header.strip()
+        if not header:
+            continue
+        # :<src mode> <dst mode> <src sha> <dst sha> <status[score]>
+        fields = header.lstrip(':').split(' ')
+        status = fields[4][0]
+        src_path = next(tokens)
+        dst_path = next(tokens) if status in ('R', 'C') else src_path
+        yield status, src_path, dst_path, fields[2], fields[3]
+
+
+class ChangeSet:
+    """Changed scripts between two commits, bucketed by `EXECUTION_SEQUENCE`.
+
+    `git diff --raw -z -M` is streamed and every path is classified as it
+    arrives; paths outside of the `Databases/<db>/<Folder>/<name>.sql`
+    layout are dropped. Deleted scripts (and the old path of a rename) are
+    kept apart in `deleted`, iterating yields the scripts to deploy in
+    execution order.
+
+    Args:
+        repo (Repo): repository holding both commits.
+        source (str): last deployed commit.
+        target (str): commit to deploy.
+    """
+
+    def __init__(self, repo, source, target) -> None:
+        self.buckets = [[] for _ in EXECUTION_SEQUENCE]
+        self.deleted = []
+        self._load(repo, source, target)
+
+    def _load(self, repo, source, target):
+        process = repo.git.diff(
+            source, target,
+            raw=True, z=True, M=True, no_abbrev=True,
+            as_process=True
+        )
+        try:
+            for status, src_path, dst_path, _, dst_blob in iter_raw_diff(process.stdout):
+                self._add(status, src_path, dst_path, dst_blob)
+        finally:
+            process.wait()
+
+    def _add(self, status, src_path, dst_path, dst_blob):
+        if status == 'R' and ChangedFile.is_script(src_path):
+            self.deleted.append(ChangedFile(src_path, 'D'))
+
+        if status == 'D':
+            if ChangedFile.is_script(src_path):
+                self.deleted.append(ChangedFile(src_path, 'D'))
+        elif ChangedFile.is_script(dst_path):
+            file = ChangedFile(dst_path, status, dst_blob)
+            self.buckets[file.sequence].append(file)
+
+    def __iter__(self):
+        for bucket in self.buckets:
+            yield from bucket
+
+    def __len__(self):
+        return sum(len(x) for x in self.buckets)
+
+
+def _tree_blobs(repo, commit, paths):
+    """ Returns path -> blob sha of the given paths in the tree of `commit`, read by one `ls-tree` pass. """
+    blobs = {}
+    process = repo.git.ls_tree('-r', '-z', commit, '--', 'Databases', as_process=True)
+    try:
+        for entry in _iter_tokens(process.stdout):
+            info, _, path = entry.partition('\t')
+            if path in paths:
+                blobs[path] = info.split()[2]
+    finally:
+        process.wait()
+    return blobs
+
+
+class CoalescedChangeSet(ChangeSet):
+    """Changed scripts of every commit between two commits, coalesced per path.
+
+    A single `git log --raw -z -M --first-parent -m` pass collects the paths
+    touched in the range, merges included: they are diffed against their
+    first parent, like `per_commit` replays them. The final content of a
+    path comes from the target tree, so a script edited many times is
+    deployed once, a script added and deleted inside the range is skipped
+    and so is a script changed back to its original content.
+    """
+
+    def _load(self, repo, source, target):
+        paths = set()
+        process = repo.git.log(
+            f'{source}..{target}',
+            raw=True, z=True, M=True, no_abbrev=True,
+            first_parent=True, m=True, format='',
+            as_process=True
+        )
+        try:
+            for _, src_path, dst_path, _, _ in iter_raw_diff(process.stdout):
+                paths.add(src_path)
+                paths.add(dst_path)
+        finally:
+            process.wait()
+
+        old_blobs = _tree_blobs(repo, source, paths)
+        new_blobs = _tree_blobs(repo, target, paths)
+        for path in sorted(paths):
+            old_blob, new_blob = old_blobs.get(path), new_blobs.get(path)
+            if new_blob is None:
+                if old_blob is not None:
+                    self._add('D', path, path, None)
+            elif old_blob is None:
+                self._add('A', path, path, new_blob)
+            elif new_blob != old_blob:
+                self._add('M', path, path, new_blob)
@@ -0,0 +1,85 @@
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+from .catalog import split_object_name
+from .script import MODULE_HASHES
+
+
+MODULE_FOLDERS = ('Functions', 'Views', 'Stored-Procedures', 'Triggers')
+
+
+def definition_hashes(script):
+    """Returns the hashes a server definition of the script may have.
+
+    Line endings are normalized to LF like `MODULE_HASHES` does on the
+    server, and trailing newlines are ignored since editors and the
+    exporter add them. Hashes are SHA2_256 of UTF-16LE, what `HASHBYTES`
+    returns for an NVARCHAR definition.
+    """
+    text = script.replace('\r\n', '\n').replace('\r', '\n')
+    stripped = text.rstrip('\n')
+    return {
+        hashlib.sha256(x.encode('utf-16-le')).digest()
+        for x in (text, stripped, stripped + '\n')
+    }
+
+
+class DriftDetector:
+    """Compares module scripts of the repository with the definitions on the server.
+
+    The server side is a single `MODULE_HASHES` query per database, the
+    scripts are hashed locally on a thread pool.
+
+    Args:
+        database (Database): pooled database.
+        read_script (callable): returns the SQL text of a `ChangedFile`.
+        max_workers (int, optional): threads hashing the scripts.
+    """
+
+    def __init__(self, database, read_script, max_workers=8) -> None:
+        self.database = database
+        self.read_script = read_script
+        self.max_workers = max_workers
+
+    def _server_hashes(self, db_name):
+        with self.database.connect(db_name, phase='drift') as db:
+            return {
+                (x.SUB_FOLDER, x.SCHEMA_NAME.lower(), x.OBJECT_NAME.lower()): (
+                    x.SCHEMA_NAME, x.OBJECT_NAME, bytes(x.DEFINITION_HASH) if x.DEFINITION_HASH else None
+                )
+                for x in db.execute(MODULE_HASHES).fetchall()
+            }
+
+    def detect(self, db_name, files):
+        """Returns the drift of a database.
+
+        Args:
+            db_name (str): database name.
+            files (list): `ChangedFile` list of the module scripts of the database.
+
+        Returns:
+            list of [db_name, folder, object_name, status, file], status is
+            `changed` (definitions differ), `missing` (not on the server) or
+            `extra` (not in the repository); `file` is `None` for `extra`.
+        """
+        files = [x for x in files if x.object_type in MODULE_FOLDERS]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            local = list(executor.map(lambda x: definition_hashes(self.read_script(x)), files))
+        server = self._server_hashes(db_name)
+
+        drift = []
+        seen = set()
+        for file, hashes in zip(files, local):
+            schema_name, name = split_object_name(file.object_name)
+            key = (file.object_type, schema_name.lower(), name.lower())
+            seen.add(key)
+            if key not in server:
+                drift.append([db_name, file.object_type, file.object_name, 'missing', file])
+            elif server[key][2] not in hashes:
+                drift.append([db_name, file.object_type, file.object_name, 'changed', file])
+
+        for key in sorted(set(server) - seen):
+            schema_name, name, _ = server[key]
+            drift.append([db_name, key[0], f'[{schema_name}].[{name}]', 'extra', None])
+
+        return drift
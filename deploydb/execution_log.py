@@ -0,0 +1,101 @@
+import time
+import threading
+
+from .db import get_driver
+from .metrics import Metrics
+from .script import EXECUTION_LOG_INSERT
+
+
+class ExecutionLogWriter:
+    """Buffers `Deploydb.ExecutionLog` rows and inserts them in batches.
+
+    Args:
+        database (Database): pooled database of the listener.
+        db_name (str): database that holds the `Deploydb` schema.
+        batch_size (int, optional): flushes when that many rows are buffered.
+        flush_interval (float, optional): flushes when the oldest buffered row is older (sec).
+        metrics (Metrics, optional): flushes are timed as the `log_write` phase.
+    """
+    max_error_len = 2000  # Deploydb.ExecutionLog.Error
+
+    def __init__(self, database, db_name, *, batch_size=100, flush_interval=5.0, metrics=None) -> None:
+        self.database = database
+        self.db_name = db_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.metrics = metrics or Metrics()
+        self._rows = []
+        self._first_row_at = None
+        self._lock = threading.Lock()
+
+    def add(self, commit_id, file, is_failed, error, blob=None, batch=None, stats=None) -> None:
+        """Buffers a row, flushes when a threshold is reached.
+
+        Args:
+            stats (tuple, optional): (cpu_time_ms, elapsed_time_ms, logical_reads, rows_affected)
+                of the script on the server, see `Listener.server_stats`.
+        """
+        if error is not None:
+            error = str(error)[:self.max_error_len]
+
+        with self._lock:
+            if not self._rows:
+                self._first_row_at = time.monotonic()
+            self._rows.append((commit_id, file, is_failed, error, blob, batch) + tuple(stats or (None,) * 4))
+            due = (
+                len(self._rows) >= self.batch_size
+                or time.monotonic() - self._first_row_at >= self.flush_interval
+            )
+
+        if due:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes buffered rows, they are kept for the next flush if the connection fails.
+
+        A row the server rejects fails its whole batch, the rows are then
+        inserted one by one and the rejected ones are dropped.
+        """
+        with self._lock:
+            rows, self._rows = self._rows, []
+        if not rows:
+            return
+
+        driver = get_driver()
+        rejected = (driver.ProgrammingError, driver.IntegrityError, driver.DataError)
+        pending = rows
+        try:
+            with self.metrics.phase('log_write', rows=len(rows)), \
+                    self.database.connect(self.db_name, phase='log_write') as db:
+                try:
+                    self._insert(db, rows)
+                    pending = []
+                except rejected:
+                    while pending:
+                        try:
+                            self._insert(db, pending[:1])
+                        except rejected as ex:
+                            self._drop(pending[0], ex)
+                        pending = pending[1:]
+        except:  # noqa
+            with self._lock:
+                self._rows[:0] = pending
+                self._first_row_at = time.monotonic()
+            raise
+
+    def _insert(self, db, rows) -> None:
+        """ Inserts the rows in a transaction, none of them is written if one fails. """
+        db.connection.autocommit = False
+        try:
+            db.fast_executemany = True
+            db.executemany(EXECUTION_LOG_INSERT, rows)
+            db.commit()
+        except:  # noqa
+            db.rollback()
+            raise
+        finally:
+            db.connection.autocommit = True
+
+    def _drop(self, row, error) -> None:
+        print(f'Execution log row of {row[1]} dropped: {error}')
+        self.metrics.inc('deploydb_failures_total', component='execution_log')
@@ -0,0 +1,293 @@
+import os
+import re
+import sys
+import json
+import time
+import queue
+import threading
+import traceback
+import subprocess
+
+from git import Repo
+
+
+_LINE_ENDINGS = re.compile(r'\r\n?')
+
+
+def script_text(script) -> str:
+    """Returns the file content of an exported script.
+
+    `CREATE_TABLE` ends lines with CHAR(13) only and module definitions
+    usually with CRLF; every line ending becomes `\\n` and the file ends
+    with a newline.
+    """
+    text = _LINE_ENDINGS.sub('\n', str(script))
+    if not text.endswith('\n'):
+        text += '\n'
+    return text
+
+
+class FolderTarget:
+    """Writes exported files under a folder.
+
+    Args:
+        path (str): root folder of the export.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self._folders = set()
+        self._lock = threading.Lock()
+
+    def _makedirs(self, folder):
+        with self._lock:
+            if folder in self._folders:
+                return
+            self._folders.add(folder)
+        os.makedirs(folder, exist_ok=True)
+
+    def write(self, rel_path, text) -> None:
+        path = os.path.join(self.path, rel_path)
+        self._makedirs(os.path.dirname(path))
+        with open(path, mode='w', encoding='utf-8', buffering=1 << 16) as f:
+            f.write(text)
+
+    def remove(self, rel_path) -> None:
+        path = os.path.join(self.path, rel_path)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def close(self, commit=True) -> None:
+        pass
+
+
+class GitTarget:
+    """Writes exported files straight into a git branch as a single commit.
+
+    Files are streamed to `git fast-import` as blobs, nothing touches the
+    working tree; the commit is written by `close`. The process is started
+    by the first write. The repository is created if it does not exist.
+
+    Args:
+        path (str): git repository.
+        branch (str, optional): branch the commit goes to. Defaults to "main".
+        message (str, optional): commit message.
+        committer (str, optional): `Name <email>` of the commit.
+        replace (bool, optional): the commit holds the written files only, otherwise
+            it is applied on top of the branch. Defaults to True.
+        checkout (bool, optional): checks the branch out when the commit is written.
+    """
+
+    def __init__(
+        self,
+        path,
+        *,
+        branch='main',
+        message='Export database objects',
+        committer='deploydb <deploydb@localhost>',
+        replace=True,
+        checkout=False
+    ) -> None:
+        self.path = path
+        self.branch = branch
+        self.message = message
+        self.committer = committer
+        self.replace = replace
+        self.checkout = checkout
+        self.commits = 0
+        self._files = {}  # path -> blob mark
+        self._removed = set()
+        self._mark = 0
+        self._process = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+        if os.path.exists(os.path.join(path, '.git')) or os.path.exists(os.path.join(path, 'HEAD')):
+            self.repo = Repo(path)
+        else:
+            self.repo = Repo.init(path)
+            self.repo.git.symbolic_ref('HEAD', f'refs/heads/{branch}')
+        try:
+            self.repo.git.rev_parse('--verify', '-q', f'refs/heads/{branch}')
+            self._has_branch = True
+        except Exception:
+            self._has_branch = False
+
+    def _stream(self):
+        """ Returns the stdin of `git fast-import`, started on the first call. Callers hold the lock. """
+        if self._process is None:
+            self._process = self.repo.git.fast_import(
+                quiet=True, done=True,
+                as_process=True, istream=subprocess.PIPE
+            )
+        return self._process.stdin
+
+    @staticmethod
+    def _quote(rel_path):
+        path = rel_path.replace(os.sep, '/')
+        if path.startswith('"') or '\n' in path:
+            path = '"' + path.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        return path
+
+    def write(self, rel_path, text) -> None:
+        data = text.encode('utf-8')
+        with self._lock:
+            self._mark += 1
+            self._stream().write(b'blob\nmark :%d\ndata %d\n' % (self._mark, len(data)) + data + b'\n')
+            path = self._quote(rel_path)
+            self._files[path] = self._mark
+            self._removed.discard(path)
+
+    def remove(self, rel_path) -> None:
+        with self._lock:
+            path = self._quote(rel_path)
+            self._files.pop(path, None)
+            self._removed.add(path)
+
+    def _commit(self):
+        message = self.message.encode('utf-8')
+        lines = [
+            f'commit refs/heads/{self.branch}',
+            f'committer {self.committer} {int(time.time())} +0000',
+            f'data {len(message)}',
+        ]
+        changes = []
+        if self._has_branch:
+            changes.append(f'from refs/heads/{self.branch}^0')
+        if self.replace:
+            changes.append('deleteall')
+        else:
+            changes.extend(f'D {x}' for x in sorted(self._removed))
+        changes.extend(f'M 100644 :{mark} {path}' for path, mark in sorted(self._files.items()))
+        return '\n'.join(lines).encode('utf-8') + b'\n' + message + b'\n' + '\n'.join(changes).encode('utf-8') + b'\n\n'
+
+    def close(self, commit=True) -> None:
+        """Writes the commit and stops `git fast-import`, does nothing once closed.
+
+        Args:
+            commit (bool, optional): `False` stops without writing the commit, e.g. after
+                a failed export. The blobs already written are left unreferenced.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            if commit and (self._files or self._removed or not self._has_branch):
+                self._stream().write(self._commit())
+                self.commits += 1
+            if self._process is None:
+                return
+            self._process.stdin.write(b'done\n')
+            self._process.stdin.close()
+            self._process.wait()
+        if self.checkout and self.commits and not self.repo.bare:
+            self.repo.git.checkout(self.branch, force=True)
+
+
+class ExportWriter:
+    """Writes files to a target on a background thread.
+
+    The queue is bounded so reading the database and writing files overlap
+    while memory stays flat. A failing write is recorded, not raised;
+    `files`, `bytes` and `busy` (sec) account for the written files.
+
+    Args:
+        target (FolderTarget): where the files are written.
+        max_queue (int, optional): files waiting to be written at most.
+    """
+    _done = object()
+
+    def __init__(self, target, max_queue=1000) -> None:
+        self.target = target
+        self.failure = []
+        self.failed_paths = set()
+        self.files = 0
+        self.bytes = 0
+        self.busy = 0.0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, rel_path, text, failure_row=None) -> None:
+        """Queues a file, blocks while the queue is full.
+
+        Args:
+            failure_row (list, optional): recorded with the error if the write fails.
+        """
+        self._queue.put((rel_path, text, failure_row))
+
+    def remove(self, rel_path) -> None:
+        """ Queues the removal of a file. """
+        self._queue.put((rel_path, None, None))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is self._done:
+                return
+            rel_path, text, failure_row = item
+            start = time.perf_counter()
+            try:
+                if text is None:
+                    self.target.remove(rel_path)
+                else:
+                    self.target.write(rel_path, text)
+                    self.files += 1
+                    self.bytes += len(text.encode('utf-8'))
+            except:  # noqa
+                self.failed_paths.add(rel_path)
+                error = str(traceback.format_exception(*sys.exc_info()))
+                self.failure.append((failure_row or [rel_path]) + [error])
+            finally:
+                self.busy += time.perf_counter() - start
+
+    def close(self):
+        """ Waits for the queued files, returns the failures. """
+        self._queue.put(self._done)
+        self._thread.join()
+        return self.failure
+
+
+class ExportManifest:
+    """Exported files per database, `object_id -> [path, modify_date, sha256]`.
+
+    Args:
+        path (str): json file of the manifest.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self._dbs = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, mode='r', encoding='utf-8') as f:
+                self._dbs = {
+                    db_name: {key: list(entry) for key, entry in objects.items()}
+                    for db_name, objects in json.load(f).items()
+                }
+        except (ValueError, AttributeError, TypeError):
+            self._dbs = {}  # broken manifest, exports everything again.
+
+    def objects(self, db_name):
+        """ Returns the entries of a database, `None` if it was never exported. """
+        with self._lock:
+            objects = self._dbs.get(db_name)
+            return dict(objects) if objects is not None else None
+
+    def update(self, db_name, objects) -> None:
+        with self._lock:
+            self._dbs[db_name] = objects
+
+    def save(self) -> None:
+        with self._lock:
+            data = json.dumps(self._dbs, sort_keys=True)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, mode='w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
@@ -1,120 +1,484 @@
+import io
 import os
+import re
 import sys
 import traceback
 from datetime import datetime
 import time
-from typing import Any
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-import pyodbc
-from git import Repo, Git
+from git import Repo, Git, GitCommandError
 from .base import Base
-from .db import Database
+from .db import get_driver
 from .model import ChangedFile
+from .execution_log import ExecutionLogWriter
+from .metrics import Metrics
+from .catalog import CatalogSnapshot
+from .scheduler import DependencyGraph
+from .diff import ChangeSet, CoalescedChangeSet
+from .drift import DriftDetector, MODULE_FOLDERS
+from .batch import iter_batches, bundle_scripts
+from .utils import _save_csv, _in_lists
 # from .utils import _set_commit_log, _last_commit_hash
 from .script import (
-    EXECUTION_LOG_INSERT,
+    SCHEMA_VERSION,
     INIT_DEPLOYDB,
-    GET_OBJECT,
-    DUPLICATE_CONTROL,
+    DEPLOYDB_STATE,
+    EXECUTED_FILES,
+    EXPRESSION_DEPENDENCIES,
+    DEPLOYED_BLOBS,
+    IN_LIST_SIZE,
     CHANGELOG_INSERT,
     LAST_CHANGELOG_SHA,
+    SESSION_STATS,
+    COSTLY_SCRIPTS,
 )
 
+# State of a session `RESET_SESSION` does not clear: temp tables and IDENTITY_INSERT.
+_SESSION_STATE = re.compile(r'#\w|\bIDENTITY_INSERT\b', re.IGNORECASE)
+
 
 class Listener(Base):
+    """Listens the target branch and deploys changed scripts.
+
+    Args:
+        config (Any): config file or a `dict`.
+        ssh_path (str, optional): private key used with `ssh_url`.
+        log_batch_size (int, optional): execution logs are inserted in batches of that size.
+        log_flush_interval (float, optional): max seconds an execution log waits in the buffer.
+        log_durability (str, optional): extra flushes of the execution logs.
+            `batch` flushes on size/time thresholds and at the end of the run only,
+            `group` also flushes after every database group,
+            `file` flushes after every executed file.
+        catalog_cache_path (str, optional): json file to persist the `sys.objects` snapshot
+            used by `policy`, a restarted listener then refreshes it incrementally.
+        max_workers (int, optional): databases deployed concurrently. Default `1` deploys
+            every file serially.
+        dependency_graph (bool, optional): orders the files of a database by the objects
+            they reference instead of the folder sequence only, see `DependencyGraph`.
+        max_workers_per_db (int, optional): independent files of a database executed
+            concurrently when `dependency_graph` is enabled. Every worker holds a pooled
+            connection, `max_workers * max_workers_per_db` must not exceed `db_creds.pool_size`.
+        replay (str, optional): how a range of commits is deployed.
+            `diff` deploys the difference of the last deployed and the target commit,
+            `coalesce` replays the range with `git log` and deploys every touched script
+            once with its final content, `per_commit` deploys every first-parent commit
+            on its own with its own changelog and execution logs.
+        skip_unchanged (bool, optional): skips a script whose git blob equals the one of its
+            last successful deployment, e.g. after reverts or cherry-picks.
+        bundle_max_count (int, optional): consecutive single batch module scripts of a database
+            sent in one request through `sp_executesql`. Default `1` disables bundling, it is
+            not used with `dependency_graph`.
+        bundle_max_bytes (int, optional): max total size of the scripts of a bundle.
+        metrics (Metrics, optional): collects the timings of the phases (pull, diff, policy,
+            duplicate_check, execution, log_write) and the counters of the runs, see `Metrics`.
+        server_stats (bool, optional): stores the CPU time, elapsed time, logical reads and rows
+            of every executed script in `Deploydb.ExecutionLog`, read from `sys.dm_exec_sessions`
+            before and after the script (two extra requests per file), see `costly_scripts`.
+            Rows are the sum of the row counts of the statements, DMLs run without their
+            `SET NOCOUNT ON` prefix to report them. Bundled scripts are not measured.
+    """
     def __init__(
         self,
         config,
         *,
         ssh_path="~/.ssh/id_rsa",
         changelog_path="changelog.csv",
-        err_path="errors.csv"
+        err_path="errors.csv",
+        log_batch_size=100,
+        log_flush_interval=5.0,
+        log_durability="group",
+        catalog_cache_path=None,
+        max_workers=1,
+        dependency_graph=False,
+        max_workers_per_db=1,
+        replay="diff",
+        skip_unchanged=True,
+        bundle_max_count=1,
+        bundle_max_bytes=262144,
+        metrics=None,
+        server_stats=False
     ) -> None:
         super().__init__(config)
+        if log_durability not in ('batch', 'group', 'file'):
+            raise ValueError(f'Invalid log_durability: "{log_durability}". Use one of batch, group, file.')
+        if replay not in ('diff', 'coalesce', 'per_commit'):
+            raise ValueError(f'Invalid replay: "{replay}". Use one of diff, coalesce, per_commit.')
+        workers = max_workers * (max_workers_per_db if dependency_graph else 1)
+        if workers > self._config.db_creds.pool_size:
+            raise ValueError(
+                f'{workers} concurrent workers (max_workers * max_workers_per_db) '
+                f'exceed db_creds.pool_size: {self._config.db_creds.pool_size}.'
+            )
         self.ssh_path = ssh_path
         self.changelog_path = changelog_path
         self.err_path = err_path
-        self._init_deploydb_objects()
+        self.log_durability = log_durability
+        self.max_workers = max_workers
+        self.dependency_graph = dependency_graph
+        self.max_workers_per_db = max_workers_per_db
+        self.replay = replay
+        self.skip_unchanged = skip_unchanged
+        self.bundle_max_count = bundle_max_count
+        self.bundle_max_bytes = bundle_max_bytes
+        self.metrics = metrics or Metrics()
+        self.server_stats = server_stats
+        self._deployed_blobs = {}  # path -> blob of the last successful deployment
+        self._log_writer = ExecutionLogWriter(
+            self._db(),
+            self._config.db_creds.default_db,
+            batch_size=log_batch_size,
+            flush_interval=log_flush_interval,
+            metrics=self.metrics
+        )
+        self._catalog = CatalogSnapshot(self._db(), cache_path=catalog_cache_path)
+        self._target_commit = None  # commit being deployed
+        self._deployed_hash = None  # last target commit handled by this listener
+        self._executed = set()  # (commit, file_path) pairs already logged
+        self._executed_commits = set()  # commits loaded into `_executed`
+        self._deploydb_ready = False  # `Deploydb` objects are up to date
 
     def _init_deploydb_objects(self):
-        with self._db().connect(self._config.db_creds.default_db) as db:
-            db.execute(INIT_DEPLOYDB)
+        if not self._deploydb_ready:
+            self._last_changelog_hash()
+
+    def _load_executed(self, commit) -> None:
+        """ Fetches every file already logged for the commit with a single query. """
+        if commit in self._executed_commits:
+            return
+        with self.metrics.phase('duplicate_check', commit=commit):
+            with self._db().connect(self._config.db_creds.default_db, phase='duplicate_check') as db:
+                rows = db.execute(EXECUTED_FILES, commit).fetchall()
+        self._executed.update((commit, x.Folder) for x in rows)
+        self._executed_commits.add(commit)
 
     def _is_executed(self, commit, file_path):
-        with self._db().connect(self._config.db_creds.default_db) as db:
-            return True if db.execute(DUPLICATE_CONTROL, commit, file_path).fetchone() else False
+        self._load_executed(commit)
+        return (commit, file_path) in self._executed
+
+    def _load_deployed_blobs(self, changes) -> None:
+        """ Fetches the last successfully deployed blob of every changed path, `IN_LIST_SIZE` paths per query. """
+        paths = [x.path for x in changes if x.blob and x.path not in self._deployed_blobs]
+        if not self.skip_unchanged or not paths:
+            return
+        with self.metrics.phase('duplicate_check', files=len(paths)):
+            with self._db().connect(self._config.db_creds.default_db, phase='duplicate_check') as db:
+                for params in _in_lists(paths, IN_LIST_SIZE):
+                    rows = db.execute(DEPLOYED_BLOBS, *params).fetchall()
+                    self._deployed_blobs.update((x.Folder, x.BlobSHA) for x in rows)
+
+    def _is_unchanged(self, file: ChangedFile) -> bool:
+        """ The same content of the script was deployed successfully before. """
+        return self.skip_unchanged and file.blob is not None and self._deployed_blobs.get(file.path) == file.blob
 
     def _set_changelog(self, commit) -> None:
-        with self._db().connect(self._config.db_creds.default_db) as db:
+        with self._db().connect(self._config.db_creds.default_db, phase='changelog') as db:
             db.execute(CHANGELOG_INSERT, commit)
     
     def _last_changelog_hash(self) -> str:
-        with self._db().connect(self._config.db_creds.default_db) as db:
+        """Returns the last deployed commit, a single query once the `Deploydb` objects exist.
+
+        They are created or upgraded first while the schema version marker
+        is missing or older than `SCHEMA_VERSION`.
+        """
+        with self._db().connect(self._config.db_creds.default_db, phase='changelog') as db:
+            state = db.execute(DEPLOYDB_STATE).fetchone()
+            if state.SCHEMA_VERSION is not None and state.SCHEMA_VERSION >= SCHEMA_VERSION:
+                self._deploydb_ready = True
+                return state.LAST_SHA or ""
+
+            db.execute(INIT_DEPLOYDB, SCHEMA_VERSION)
+            self._deploydb_ready = True
             x = db.execute(LAST_CHANGELOG_SHA).fetchone()
             return x[0] if x else ""
 
-    def _db(self):
-        return Database(creds=self._config.db_creds)
-
-    def _prep_cmd(self, file: ChangedFile) -> Any:
-        path = os.path.join(self._config.local_path, file.path)
-        command = ''
-        with open(path, mode='r', encoding='utf-8') as f:
-            command = f.read()
-
-        if file.object_type == 'DMLs':
-            command = 'SET NOCOUNT ON;\n' + command
-
-        return command
-
-    def _add_execution_log(self, commit_id, file, is_failed, error):
-        with self._db().connect(self._config.db_creds.default_db) as db:
-            db.execute(EXECUTION_LOG_INSERT, commit_id, file, is_failed, error)
+    @property
+    def _reads_objects(self) -> bool:
+        """ Scripts are read from the target commit instead of the working tree. """
+        return self._config.bare or self.replay == 'per_commit'
+
+    def _file_exists(self, file: ChangedFile) -> bool:
+        if self._reads_objects:
+            try:
+                self._target_commit.tree / file.path
+                return True
+            except KeyError:
+                return False
+        return os.path.exists(os.path.join(self._config.local_path, file.path))
+
+    @contextmanager
+    def _open_script(self, file: ChangedFile):
+        """ Yields a text stream of the script, read from the target commit in bare mode. """
+        if self._reads_objects:
+            blob = self._target_commit.tree / file.path
+            process = self._target_commit.repo.git.cat_file('blob', blob.hexsha, as_process=True)
+            stream = io.TextIOWrapper(process.stdout, encoding='utf-8')
+            try:
+                yield stream
+            finally:
+                stream.close()
+                process.wait()
+        else:
+            path = os.path.join(self._config.local_path, file.path)
+            with open(path, mode='r', encoding='utf-8') as f:
+                yield f
+
+    def _read_script(self, file: ChangedFile) -> str:
+        with self._open_script(file) as f:
+            return f.read()
+
+    def _leaves_session_state(self, file: ChangedFile) -> bool:
+        """ Tells if the script may leave state behind that a reset of its session does not clear. """
+        if file.object_type in MODULE_FOLDERS:
+            return False
+        with self._open_script(file) as f:
+            return any(_SESSION_STATE.search(line) for line in f)
+
+    def _prep_batches(self, file: ChangedFile):
+        """ Yields (batch, count, line_no) of the script while it is read, see `iter_batches`. """
+        with self._open_script(file) as f:
+            for i, (command, count, line_no) in enumerate(iter_batches(f)):
+                if i == 0 and file.object_type == 'DMLs' and not self.server_stats:
+                    command = 'SET NOCOUNT ON;\n' + command
+                yield command, count, line_no
+
+    def _add_execution_log(self, commit_id, file, is_failed, error, blob=None, batch=None, stats=None):
+        self._log_writer.add(commit_id, file, is_failed, error, blob, batch, stats)
+        self._executed.add((commit_id, file))
+        if blob and not is_failed:
+            self._deployed_blobs[file] = blob
+        if self.log_durability == 'file':
+            self._log_writer.flush()
+
+    def _is_skipped(self, file: ChangedFile, target_hash) -> bool:
+        if self._is_executed(target_hash, file.path):
+            print('Item already executed!')
+            self.metrics.inc('deploydb_files_total', result='skipped')
+            return True
+
+        if self._is_unchanged(file):
+            print('Item unchanged, skipped!')
+            self.metrics.inc('deploydb_files_total', result='skipped')
+            return True
+
+        return False
+
+    def _bundle_script(self, file: ChangedFile):
+        """ Returns the script if it can be bundled: a module of a single batch within the byte cap. """
+        if self.bundle_max_count < 2 or file.object_type not in MODULE_FOLDERS:
+            return None
+        script = self._read_script(file)
+        if len(script.encode('utf-8')) > self.bundle_max_bytes:
+            return None
+        batches = list(iter_batches(io.StringIO(script)))
+        if len(batches) != 1 or batches[0][1] != 1:
+            return None
+        return batches[0][0]
+
+    def _run_bundle(self, bundle, target_hash):
+        """Executes [(file, script)] of a database in a single request, returns the failures.
+
+        A failure of the request itself (e.g. a lost connection) fails every
+        script of the bundle.
+        """
+        start_time = time.time()
+        print(f'Executing bundle of {len(bundle)} scripts ...')
+        results = {}
+        _message = None
+        try:
+            with self.metrics.phase('execution', db=bundle[0][0].db_name, files=len(bundle)):
+                with self._db().connect(bundle[0][0].db_name, phase='execution', reset=True) as db:
+                    db.execute(bundle_scripts([x[1] for x in bundle]))
+                    while not (db.description and db.description[0][0] == 'Seq'):
+                        if not db.nextset():
+                            break
+                    else:
+                        results = {x.Seq: (bool(x.IsFailed), x.Error) for x in db.fetchall()}
+        except get_driver().ProgrammingError as ex:
+            err, _message = ex.args
+        except:  # noqa
+            _message = str(traceback.format_exception(*sys.exc_info()))
+        self.metrics.inc('deploydb_bytes_total', sum(len(x[1].encode('utf-8')) for x in bundle))
+
+        failures = []
+        for seq, (file, _) in enumerate(bundle, start=1):
+            failed, error = results.get(seq, (True, _message or 'No result returned for the script.'))
+            self._add_execution_log(target_hash, file.path, failed, error, file.blob, 1 if failed else None)
+            self._count_file(failed)
+            if failed:
+                failures.append([file.path, error])
+            else:
+                self._note_executed(file)
+        print('Finished bundle... Elapsed Time:', time.time()-start_time)
+        return failures
+
+    def _count_file(self, failed):
+        self.metrics.inc('deploydb_files_total', result='failed' if failed else 'success')
+        if failed:
+            self.metrics.inc('deploydb_failures_total', component='listener')
+
+    def _session_stats(self, db):
+        """ Returns the counters of the session on the server, `None` if they can not be read. """
+        try:
+            return db.execute(SESSION_STATS).fetchone()
+        except:  # noqa
+            return None
+
+    def _stats_delta(self, db, before, rows_affected):
+        """ Returns (cpu_time_ms, elapsed_time_ms, logical_reads, rows_affected) since `before`. """
+        after = self._session_stats(db) if before else None
+        if not after:
+            return None
+        return (
+            after.CPU_TIME - before.CPU_TIME,
+            int((after.NOW - before.NOW).total_seconds() * 1000),
+            after.LOGICAL_READS - before.LOGICAL_READS,
+            rows_affected,
+        )
 
     def _run_cmd(self, file: ChangedFile, target_hash):
         _failed = False
         _message = None
         start_time = time.time()
-        with self._db().connect(file.db_name) as db:
-            if self._is_executed(target_hash, file.path):
-                print('Item already executed!')
-            else:
-                print('Executing commands ...')
-                try:
-                    db.execute(self._prep_cmd(file))
-                    self._add_execution_log(target_hash, file.path, False, None)
-                except pyodbc.ProgrammingError as ex:
-                    _failed = True
-                    err, _message = ex.args
-                    self._add_execution_log(target_hash, file.path, True, str(_message))
-                except:  # noqa
-                    _failed = True
-                    _message = str(traceback.format_exception(*sys.exc_info()))
-                    self._add_execution_log(target_hash, file.path, True, _message)
-                print('Finished commands... Elapsed Time:', time.time()-start_time)
-
+        if self._is_skipped(file, target_hash):
+            return _failed, _message
+
+        reuse = not self._leaves_session_state(file)
+        with self.metrics.phase('execution', file=file.path), \
+                self._db().connect(file.db_name, phase='execution', reset=reuse, reuse=reuse) as db:
+            print('Executing commands ...')
+            before = self._session_stats(db) if self.server_stats else None
+            batch_no = None
+            rows_affected = 0
+            try:
+                for batch_no, (command, count, line_no) in enumerate(self._prep_batches(file), start=1):
+                    self.metrics.inc('deploydb_bytes_total', len(command.encode('utf-8')) * count)
+                    for _ in range(count):
+                        db.execute(command)
+                        # Errors of the later statements are raised while moving to their results.
+                        while True:
+                            if db.description is None and db.rowcount > 0:
+                                rows_affected += db.rowcount
+                            if not db.nextset():
+                                break
+                    print(f'Batch {batch_no} (line {line_no}) done... Elapsed Time:', time.time()-start_time)
+            except get_driver().ProgrammingError as ex:
+                _failed = True
+                err, _message = ex.args
+            except:  # noqa
+                _failed = True
+                _message = str(traceback.format_exception(*sys.exc_info()))
+            stats = self._stats_delta(db, before, rows_affected)
+            print('Finished commands... Elapsed Time:', time.time()-start_time)
+
+        # Logged once the connection is released, a flush of the log writer
+        # checks out a connection of its own.
+        if _failed:
+            self._add_execution_log(target_hash, file.path, True, str(_message), file.blob, batch_no, stats)
+        else:
+            self._add_execution_log(target_hash, file.path, False, None, file.blob, stats=stats)
+            self._note_executed(file)
+        self._count_file(_failed)
         return _failed, _message
 
+    def _remote_hash(self) -> str:
+        """ Returns the head of the target branch on the remote, no objects are fetched. """
+        ref = f'refs/heads/{self._config.target_branch}'
+        git = Git()
+        if self._config.ssh_url:
+            cmd = f'ssh -i {os.path.expanduser(self.ssh_path)}'
+            with git.custom_environment(GIT_SSH_COMMAND=cmd):
+                heads = git.ls_remote(self._config.ssh_url, ref)
+        elif self._config.https_url:
+            heads = git.ls_remote(self._config.https_url, ref)
+        else:
+            raise Exception('No found repository!')
+        return heads.split()[0] if heads else ""
+
+    def watch(self, interval=60, *, jitter=0.1, max_backoff=600, stop_event=None, executable=True):
+        """Polls the target branch and handles changes until `stop_event` is set.
+
+        Every poll is a single `ls-remote` of the target branch compared to the
+        last deployed commit, `handle_changes` (pull, diff, deploy) runs only
+        when the branch moved. Failed polls back off exponentially.
+
+        Args:
+            interval (float, optional): seconds between polls.
+            jitter (float, optional): random +/- ratio applied to every wait.
+            max_backoff (float, optional): max seconds between polls after failures.
+            stop_event (threading.Event, optional): stops the loop when set.
+            executable (bool, optional): passed to `handle_changes`.
+        """
+        stop_event = stop_event or threading.Event()
+        delay = interval
+        while not stop_event.is_set():
+            try:
+                if self._deployed_hash is None:
+                    self._deployed_hash = self._last_changelog_hash()
+
+                if self._remote_hash() != self._deployed_hash:
+                    self.handle_changes(executable)
+                delay = interval
+            except Exception:
+                traceback.print_exc()
+                delay = min(max(delay, 1) * 2, max_backoff)
+
+            stop_event.wait(delay * (1 + random.uniform(-jitter, jitter)))
+
+    def _git_env(self) -> dict:
+        if self._config.ssh_url:
+            return {'GIT_SSH_COMMAND': f'ssh -i {os.path.expanduser(self.ssh_path)}'}
+        return {}
+
+    def _clone(self, url):
+        options = {'branch': self._config.target_branch}
+        if self._config.clone_depth:
+            options['depth'] = self._config.clone_depth
+        if self._config.partial_clone:
+            options['filter'] = 'blob:none'
+        if self._config.bare:
+            options['bare'] = True
+        elif self._config.sparse_databases:
+            options['sparse'] = True
+
+        repo = Repo.clone_from(url, self._config.local_path, env=self._git_env(), **options)
+        if self._config.sparse_databases and not self._config.bare:
+            repo.git.update_environment(**self._git_env())
+            repo.git.sparse_checkout('set', *[f'Databases/{x}' for x in self._config.sparse_databases])
+        return repo
+
     def _pull(self):
         if self._config.ssh_url:
             print("SSH connection starting...")
-            cmd = f'ssh -i {os.path.expanduser(self.ssh_path)}'
-            with Git().custom_environment(GIT_SSH_COMMAND=cmd):
-                Repo.clone_from(
-                    self._config.ssh_url,
-                    self._config.local_path,
-                    branch=self._config.target_branch
-                )
+            self._clone(self._config.ssh_url)
         elif self._config.https_url:
             print("HTTPS connection starting...")
-            Repo.clone_from(
-                self._config.https_url,
-                self._config.local_path,
-                branch=self._config.target_branch
-            )
+            self._clone(self._config.https_url)
         else:
             raise Exception('No found repository!')
 
+    def _commit(self, repo, hexsha):
+        """Returns the commit, fetching it first if a shallow clone does not have it.
+
+        The commit alone is enough to diff against; if the remote refuses to
+        serve it by its sha the history is deepened completely.
+        """
+        try:
+            repo.git.cat_file('-e', f'{hexsha}^{{commit}}')
+        except GitCommandError:
+            print(f"Fetching missing commit: {hexsha}")
+            repo.git.update_environment(**self._git_env())
+            try:
+                repo.git.fetch('origin', hexsha, depth=1)
+            except GitCommandError:
+                if not os.path.exists(os.path.join(repo.git_dir, 'shallow')):
+                    raise
+                repo.git.fetch('origin', unshallow=True)
+        return repo.commit(hexsha)
+
     def _extract_creds(self, changed_file):
         x = changed_file.split('/')
         db_name = str(x[1])
@@ -123,10 +487,17 @@ class Listener(Base):
         return db_name, object_type, object_name
 
     def _is_object_exists(self, db_name, object_type, object_name):
-        with self._db().connect(db_name) as db:
-            exist = any(db.execute(GET_OBJECT, object_type, object_name).fetchall())
-            print(f"Db:{db_name} Type:{object_type} Name:{object_name} Exists:{exist}")
-            return exist
+        exist = self._catalog.exists(db_name, object_type, object_name)
+        print(f"Db:{db_name} Type:{object_type} Name:{object_name} Exists:{exist}")
+        return exist
+
+    def _note_executed(self, file: ChangedFile):
+        # A created table is registered as is; any other script may create
+        # or drop objects, its database is refreshed at the next lookup.
+        if file.object_type == "Tables":
+            self._catalog.note_created(file.db_name, file.object_type, file.object_name)
+        else:
+            self._catalog.invalidate(file.db_name)
 
     def policy(self, file):
         """ Determine if the script be able to execute ? """
@@ -140,6 +511,295 @@ class Listener(Base):
 
         return True
 
+    def _passes_policy(self, file: ChangedFile) -> bool:
+        with self.metrics.phase('policy', file=file.path):
+            passed = self.policy(file=file.path)
+        if not passed:
+            self.metrics.inc('deploydb_files_total', result='rejected')
+        return passed
+
+    def _deploy_file(self, file: ChangedFile, target_hash):
+        """ Executes a changed file if it exists and passes the policy, returns the failure. """
+        # Some files may be removed the folders therefore checking...
+        if self._file_exists(file):
+            print("Changed file:", file.path)
+            # Refers customized applied policies.
+            # Pre-defined rules are listed. You may customize that.
+            # Say for instance:
+            # Prevent DDL commands side affects over existing table.
+            if self._passes_policy(file):
+                failed, msg = self._run_cmd(file, target_hash)
+
+                if failed:
+                    return [file.path, msg]
+
+        return None
+
+    def _deploy(self, changes, target_hash, failures=None):
+        """Executes the sorted changes one by one, returns the failures.
+
+        With bundling enabled, consecutive module scripts of a database are
+        sent together, see `_run_bundle`.
+
+        Args:
+            failures (dict, optional): collects the failures by path as the scripts fail.
+        """
+        failures = {} if failures is None else failures
+        bundle = []
+        last_db = None
+
+        def run_bundle():
+            if bundle:
+                failures.update((x[0], x) for x in self._run_bundle(bundle, target_hash))
+                bundle.clear()
+
+        for file in changes:
+            if last_db not in (None, file.db_name):
+                run_bundle()
+                # Execution logs of a finished database group are persisted.
+                if self.log_durability == 'group':
+                    self._log_writer.flush()
+            last_db = file.db_name
+
+            script = self._bundle_script(file) if self._file_exists(file) else None
+            if script is not None:
+                print("Changed file:", file.path)
+                if self._passes_policy(file) and not self._is_skipped(file, target_hash):
+                    size = sum(len(x[1].encode('utf-8')) for x in bundle) + len(script.encode('utf-8'))
+                    if len(bundle) >= self.bundle_max_count or size > self.bundle_max_bytes:
+                        run_bundle()
+                    bundle.append((file, script))
+                continue
+
+            run_bundle()
+            failure = self._deploy_file(file, target_hash)
+            if failure:
+                failures[file.path] = failure
+
+        run_bundle()
+        return [failures[x.path] for x in changes if x.path in failures]
+
+    def _server_dependencies(self, db_name):
+        with self._db().connect(db_name, phase='dependencies') as db:
+            rows = [tuple(x) for x in db.execute(EXPRESSION_DEPENDENCIES).fetchall()]
+        return rows
+
+    def _deploy_graph(self, changes, target_hash, failures=None):
+        """ Executes the changes of a database in dependency order, returns the failures, see `_deploy`. """
+        failures = {} if failures is None else failures
+        existing = [x for x in changes if self._file_exists(x)]
+        graph = DependencyGraph(
+            existing,
+            self._read_script,
+            self._server_dependencies(changes[0].db_name)
+        )
+
+        def execute(file):
+            failure = self._deploy_file(file, target_hash)
+            if failure:
+                failures[file.path] = failure
+
+        graph.run(execute, max_workers=self.max_workers_per_db)
+        return [failures[x.path] for x in changes if x.path in failures]
+
+    def _deploy_group(self, changes, target_hash):
+        """Executes the changes of a database, returns the failures.
+
+        A failure of the database itself (e.g. its dependencies can not be
+        read) fails every script of it not executed yet.
+        """
+        failures = {}
+        try:
+            try:
+                if self.dependency_graph:
+                    self._deploy_graph(changes, target_hash, failures)
+                else:
+                    self._deploy(changes, target_hash, failures)
+            finally:
+                if self.log_durability == 'group':
+                    self._log_writer.flush()
+        except:  # noqa
+            _message = str(traceback.format_exception(*sys.exc_info()))
+            for file in changes:
+                executed = file.path in failures or self._is_executed(target_hash, file.path)
+                if not executed and self._file_exists(file):
+                    failures[file.path] = [file.path, _message]
+        return [failures[x.path] for x in changes if x.path in failures]
+
+    def _deploy_databases(self, changes, target_hash):
+        """Executes every database on its own worker, returns the failures.
+
+        Files of a database keep their `execution_sequence` order, failures
+        are merged in the order the databases first appear in the changes.
+        """
+        groups = {}
+        for file in changes:
+            groups.setdefault(file.db_name, []).append(file)
+
+        failure_list = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self._deploy_group, files, target_hash) for files in groups.values()]
+            for future in futures:
+                failure_list.extend(future.result())
+
+        return failure_list
+
+    def _deploy_changes(self, changes, target_hash):
+        """ Deploys sorted changes of the target commit, returns the failures. """
+        # Files already logged for the commit are fetched once,
+        # `_is_executed` checks then become set lookups.
+        self._load_executed(target_hash)
+        self._load_deployed_blobs(changes)
+        self._catalog.begin_run()
+
+        try:
+            if self.max_workers > 1 or self.dependency_graph:
+                return self._deploy_databases(changes, target_hash)
+            return self._deploy(changes, target_hash)
+        finally:
+            self._log_writer.flush()
+            self._catalog.save()
+
+    def _ensure_history(self, repo, source_hash, target_hash):
+        """ Unshallows the clone if the range between the commits is not complete. """
+        if not os.path.exists(os.path.join(repo.git_dir, 'shallow')):
+            return
+        try:
+            repo.git.merge_base(source_hash, target_hash, is_ancestor=True)
+        except GitCommandError:
+            print("Fetching history of the changes...")
+            repo.git.fetch('origin', unshallow=True)
+
+    def _replay_commits(self, repo, source_hash, target_hash):
+        """Deploys every first-parent commit between the last deployed and the target commit.
+
+        Every commit gets its own changelog and execution logs, scripts are
+        read from the commit they belong to.
+        """
+        source_commit = self._commit(repo, source_hash)
+        self._ensure_history(repo, source_commit.hexsha, target_hash)
+        commits = repo.git.rev_list(
+            f'{source_commit.hexsha}..{target_hash}', reverse=True, first_parent=True
+        ).split()
+
+        failure_list = []
+        parent_hash = source_commit.hexsha
+        for commit_hash in commits:
+            print("Replaying commit:", commit_hash)
+            self._set_changelog(commit_hash)
+            self._target_commit = repo.commit(commit_hash)
+            with self.metrics.phase('diff', commit=commit_hash):
+                changes = list(ChangeSet(repo, parent_hash, commit_hash))
+            failure_list.extend(self._deploy_changes(changes, commit_hash))
+            parent_hash = commit_hash
+
+        return target_hash, True if failure_list else False, failure_list
+
+    def _repo_scripts(self, folders):
+        """ Returns the scripts of the given folders in the working tree, or the target commit. """
+        if self._target_commit is None:
+            repo = Repo(self._config.local_path)
+            if self._config.bare:
+                self._target_commit = repo.commit(f'refs/heads/{self._config.target_branch}')
+            else:
+                self._target_commit = repo.head.commit
+
+        if self._reads_objects:
+            try:
+                databases = self._target_commit.tree / 'Databases'
+            except KeyError:
+                return []
+            paths = [
+                x.path
+                for db in databases.trees
+                for folder in db.trees if folder.name in folders
+                for x in folder.blobs
+            ]
+        else:
+            root = os.path.join(self._config.local_path, 'Databases')
+            paths = [
+                f'Databases/{db}/{folder}/{name}'
+                for db in (sorted(os.listdir(root)) if os.path.isdir(root) else [])
+                for folder in folders if os.path.isdir(os.path.join(root, db, folder))
+                for name in sorted(os.listdir(os.path.join(root, db, folder)))
+            ]
+
+        return [ChangedFile(x) for x in paths if ChangedFile.is_script(x)]
+
+    def detect_drift(self, databases=None, report_path=None):
+        """Compares `Functions`, `Views`, `Stored-Procedures` and `Triggers` scripts with the server.
+
+        Args:
+            databases (list, optional): databases to check, defaults to every database of the repository.
+            report_path (str, optional): csv file the drift report is written to.
+
+        Returns:
+            list of [db_name, folder, object_name, status, file], see `DriftDetector.detect`.
+        """
+        groups = {}
+        for file in self._repo_scripts(MODULE_FOLDERS):
+            if not databases or file.db_name in databases:
+                groups.setdefault(file.db_name, []).append(file)
+
+        detector = DriftDetector(self._db(), self._read_script)
+        drift = []
+        for db_name, files in groups.items():
+            drift.extend(detector.detect(db_name, files))
+
+        if report_path:
+            _save_csv(
+                path=report_path,
+                columns=['DB_NAME', 'SUB_FOLDER', 'OBJECT_NAME', 'STATUS'],
+                rows=[x[:4] for x in drift]
+            )
+        return drift
+
+    def costly_scripts(self, by='elapsed', top=20, report_path=None):
+        """Ranks the executions measured with `server_stats` across every deployed commit.
+
+        Args:
+            by (str, optional): one of `elapsed`, `cpu`, `reads`, `rows`.
+            top (int, optional): executions returned.
+            report_path (str, optional): csv file the ranking is written to.
+
+        Returns:
+            list of [commit, file, is_failed, cpu_time_ms, elapsed_time_ms, logical_reads, rows_affected, created_at]
+        """
+        if by not in ('elapsed', 'cpu', 'reads', 'rows'):
+            raise ValueError(f'Invalid by: "{by}". Use one of elapsed, cpu, reads, rows.')
+        self._init_deploydb_objects()
+        with self._db().connect(self._config.db_creds.default_db, phase='report') as db:
+            rows = [list(x) for x in db.execute(COSTLY_SCRIPTS, top, by).fetchall()]
+
+        if report_path:
+            _save_csv(
+                path=report_path,
+                columns=[
+                    'COMMIT', 'FILE', 'IS_FAILED', 'CPU_TIME_MS',
+                    'ELAPSED_TIME_MS', 'LOGICAL_READS', 'ROWS_AFFECTED', 'CREATED_AT'
+                ],
+                rows=rows
+            )
+        return rows
+
+    def deploy_drift(self, databases=None, report_path=None):
+        """Deploys only the scripts whose definitions differ from or are missing on the server.
+
+        Execution logs are written with a `drift-<timestamp>` commit id.
+
+        Returns:
+            commit_id
+            is_failed
+            failure_list
+        """
+        self._init_deploydb_objects()
+        drift = self.detect_drift(databases, report_path)
+        changes = sorted([x[4] for x in drift if x[4] is not None], key=lambda x: x.sequence)
+        commit_id = f"drift-{datetime.now():%Y%m%d%H%M%S}"
+        failure_list = self._deploy_changes(changes, commit_id) if changes else []
+        self.metrics.write()
+        return commit_id, True if failure_list else False, failure_list
+
     def handle_changes(self, executable=True):
         """Handles changes and deploys to your server automatically.
 
@@ -152,48 +812,57 @@ class Listener(Base):
             is_failed
             failure_list
         """
-        if not os.path.exists(self._config.local_path):
-            print(f"Initial pulling branch: {self._config.target_branch}")
-            os.mkdir(self._config.local_path)
-            self._pull()
-
-        print("Checking changes...", datetime.now())
-        repo = Repo(self._config.local_path)
-        origin = repo.remotes.origin
-        origin.pull()
+        try:
+            with self.metrics.phase('deploy'):
+                return self._handle_changes(executable)
+        finally:
+            self.metrics.inc('deploydb_runs_total', component='listener')
+            self.metrics.write()
+
+    def _handle_changes(self, executable):
+        with self.metrics.phase('pull'):
+            if not os.path.exists(self._config.local_path):
+                print(f"Initial pulling branch: {self._config.target_branch}")
+                os.mkdir(self._config.local_path)
+                self._pull()
+
+            print("Checking changes...", datetime.now())
+            repo = Repo(self._config.local_path)
+            repo.git.update_environment(**self._git_env())
+            if self._config.bare:
+                # No working tree, only the target branch is updated in the object store.
+                branch = self._config.target_branch
+                repo.git.fetch('origin', f'+refs/heads/{branch}:refs/heads/{branch}')
+                self._target_commit = repo.commit(f'refs/heads/{branch}')
+            else:
+                origin = repo.remotes.origin
+                origin.pull()
+                self._target_commit = repo.head.commit
 
         source_hash = self._last_changelog_hash()
-        target_hash = repo.head.commit.hexsha
+        target_hash = self._target_commit.hexsha
+        self._deployed_hash = target_hash
 
         failure_list = []
 
         if source_hash != target_hash:
+            if executable and self.replay == 'per_commit':
+                print("Changes detected...")
+                return self._replay_commits(repo, source_hash, target_hash)
+
             self._set_changelog(target_hash)
 
             if executable:
                 print("Changes detected...")
-                source_commit = repo.commit(source_hash)
-                target_commit = repo.commit(target_hash)
-                git_diff = target_commit.diff(source_commit)
-
-                changes = [ChangedFile(f.a_path) for f in git_diff if str(f.a_path).lower().endswith('.sql')]
-
-                for file in sorted(changes, key=lambda x: x.sequence):
-                    # Some files may be removed the folders therefore checking...
-                    file_exists = os.path.exists(
-                        os.path.join(self._config.local_path, file.path)
-                    )
-
-                    if file_exists:
-                        print("Changed file:", file.path)
-                        # Refers customized applied policies.
-                        # Pre-defined rules are listed. You may customize that.
-                        # Say for instance:
-                        # Prevent DDL commands side affects over existing table.
-                        if self.policy(file=file.path):
-                            failed, msg = self._run_cmd(file, target_hash)
-
-                            if failed:
-                                failure_list.append([file.path, msg])
-
+                with self.metrics.phase('diff', commit=target_hash):
+                    source_commit = self._commit(repo, source_hash)
+                    if self.replay == 'coalesce':
+                        self._ensure_history(repo, source_commit.hexsha, target_hash)
+                        changes = CoalescedChangeSet(repo, source_commit.hexsha, target_hash)
+                    else:
+                        changes = ChangeSet(repo, source_commit.hexsha, target_hash)
+                    # Already in execution sequence, deleted scripts are left out.
+                    changes = list(changes)
+
+                failure_list = self._deploy_changes(changes, target_hash)
                 return target_hash, True if failure_list else False, failure_list
@@ -0,0 +1,190 @@
+import os
+import json
+import time
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# name -> (type, help)
+METRICS = {
+    'deploydb_phase_seconds': ('histogram', 'Time spent in a phase of a deployment or an export.'),
+    'deploydb_runs_total': ('counter', 'Deployments and exports run.'),
+    'deploydb_files_total': ('counter', 'Deployed script files by result.'),
+    'deploydb_bytes_total': ('counter', 'Bytes of the executed scripts.'),
+    'deploydb_round_trips_total': ('counter', 'Requests sent to the server by phase, pool statements excluded.'),
+    'deploydb_failures_total': ('counter', 'Failed scripts, objects failed to export and dropped execution log rows.'),
+    'deploydb_exported_files_total': ('counter', 'Files written by the exports.'),
+    'deploydb_exported_bytes_total': ('counter', 'Bytes written by the exports.'),
+}
+
+
+def _labels(labels, extra=None):
+    items = sorted(labels) + ([extra] if extra else [])
+    if not items:
+        return ''
+    escaped = (
+        (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in items
+    )
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """Counters, duration histograms and events of deployments and exports.
+
+    Every finished phase is observed in `deploydb_phase_seconds{phase=...}`
+    and emitted as an event to the hooks and the event log.
+
+    Args:
+        textfile_path (str, optional): Prometheus text file rewritten by `write`,
+            e.g. for the node exporter textfile collector.
+        event_log_path (str, optional): JSON lines file every event is appended to.
+        hooks (list, optional): callables receiving every event as a `dict`.
+        buckets (tuple, optional): upper bounds of the duration histograms (sec).
+
+    Example:
+        from deploydb import Listener
+        from deploydb.metrics import Metrics
+
+        metrics = Metrics(textfile_path='deploydb.prom', event_log_path='events.jsonl')
+        metrics.serve(port=9464)  # optional OpenMetrics endpoint
+        Listener('config.json', metrics=metrics).handle_changes()
+    """
+
+    def __init__(self, *, textfile_path=None, event_log_path=None, hooks=None, buckets=DEFAULT_BUCKETS) -> None:
+        self.textfile_path = textfile_path
+        self.event_log_path = event_log_path
+        self.hooks = list(hooks or [])
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+        self._log_lock = threading.Lock()
+
+    def add_hook(self, hook) -> None:
+        self.hooks.append(hook)
+
+    def inc(self, name, value=1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def event(self, name, **fields) -> None:
+        """ Sends an event to the hooks and appends it to the event log. """
+        event = {'ts': datetime.now().isoformat(), 'event': name, **fields}
+        for hook in self.hooks:
+            hook(event)
+        if self.event_log_path:
+            line = json.dumps(event, default=str)
+            with self._log_lock:
+                with open(self.event_log_path, mode='a', encoding='utf-8') as f:
+                    f.write(line + '\n')
+
+    def record_phase(self, phase, seconds, failed=False, **fields) -> None:
+        self.observe('deploydb_phase_seconds', seconds, phase=phase)
+        self.event('phase', phase=phase, seconds=round(seconds, 6), failed=failed, **fields)
+
+    @contextmanager
+    def phase(self, phase, **fields):
+        """Times the block as `phase`, `fields` are added to the event only.
+
+        Example:
+            with metrics.phase('execution', file=path):
+                ...
+        """
+        start = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            self.record_phase(phase, time.perf_counter() - start, failed, **fields)
+
+    def render(self, openmetrics=False) -> str:
+        """ Returns the metrics in the Prometheus text format, or OpenMetrics. """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: (list(v[0]), v[1], v[2]) for k, v in self._histograms.items()}
+
+        lines = []
+        names = sorted({x[0] for x in counters} | {x[0] for x in histograms})
+        for name in names:
+            type_, help_ = METRICS.get(name, ('untyped', name))
+            family = name[:-len('_total')] if openmetrics and type_ == 'counter' and name.endswith('_total') else name
+            lines.append(f'# HELP {family} {help_}')
+            lines.append(f'# TYPE {family} {"unknown" if openmetrics and type_ == "untyped" else type_}')
+            for (key, labels), value in sorted(counters.items()):
+                if key == name:
+                    lines.append(f'{name}{_labels(labels)} {_number(value)}')
+            for (key, labels), (buckets, total, count) in sorted(histograms.items()):
+                if key != name:
+                    continue
+                for bound, bucket in zip(self.buckets, buckets):
+                    lines.append(f'{name}_bucket{_labels(labels, ("le", _number(bound)))} {bucket}')
+                lines.append(f'{name}_sum{_labels(labels)} {_number(total)}')
+                lines.append(f'{name}_count{_labels(labels)} {count}')
+        if openmetrics:
+            lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def write(self) -> None:
+        """ Rewrites `textfile_path` if it is set. """
+        if not self.textfile_path:
+            return
+        tmp_path = self.textfile_path + '.tmp'
+        with open(tmp_path, mode='w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.replace(tmp_path, self.textfile_path)
+
+    def serve(self, host='127.0.0.1', port=9464):
+        """Serves the metrics over HTTP on a background thread.
+
+        OpenMetrics is returned when the scraper accepts it, the Prometheus
+        text format otherwise. Returns the server, `shutdown()` stops it.
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):  # noqa
+                openmetrics = 'application/openmetrics-text' in (self.headers.get('Accept') or '')
+                data = metrics.render(openmetrics).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', (
+                    'application/openmetrics-text; version=1.0.0; charset=utf-8'
+                    if openmetrics else 'text/plain; version=0.0.4; charset=utf-8'
+                ))
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        httpd = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        return httpd
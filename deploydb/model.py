@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 
 
 class DbCreds(BaseModel):
@@ -9,6 +9,9 @@ class DbCreds(BaseModel):
     passw: str
     default_db: str
     timeout: int
+    pool_size: int = 5
+    pool_idle_timeout: int = 300
+    pool_checkout_timeout: int = 60
 
 
 class Config(BaseModel):
@@ -17,16 +20,44 @@ class Config(BaseModel):
     ssh_url: Optional[str] = None
     target_branch: str
     db_creds: DbCreds
+    clone_depth: Optional[int] = None
+    partial_clone: bool = False
+    sparse_databases: Optional[List[str]] = None
+    bare: bool = False
+
+
+EXECUTION_SEQUENCE = ('Types', 'Tables', 'DDLs', 'Functions', 'Views', 'Stored-Procedures', 'Triggers', 'DMLs')  # noqa
 
 
 class ChangedFile:
-    def __init__(self, path: str) -> None:
-        execution_sequence = ('Types', 'Tables', 'DDLs', 'Functions', 'Views', 'Stored-Procedures', 'Triggers', 'DMLs')  # noqa
+    __slots__ = ('items', 'db_name', 'object_type', 'object_name', 'sequence', 'path', 'status', 'blob')
+
+    def __init__(self, path: str, status: str = 'M', blob: str = None) -> None:
+        """A script of the repository layout: `Databases/<db>/<Folder>/<name>.sql`.
+
+        Args:
+            path (str): repository relative path.
+            status (str, optional): git status letter, `A`dded, `M`odified, `D`eleted, `R`enamed...
+            blob (str, optional): git blob sha of the script content.
+        """
+        self.status = status
+        self.blob = blob
 
         if path.endswith('.sql'):
             self.items = [str(x) for x in path.split('/')]
             self.db_name = self.items[1]
             self.object_type = self.items[2]
             self.object_name = self.items[3].split('.sql')[0]
-            self.sequence = execution_sequence.index(self.object_type)
+            self.sequence = EXECUTION_SEQUENCE.index(self.object_type)
             self.path = path
+
+    @staticmethod
+    def is_script(path: str) -> bool:
+        """ Returns whether the path follows the repository layout. """
+        items = path.split('/')
+        return (
+            len(items) == 4
+            and items[0] == 'Databases'
+            and items[2] in EXECUTION_SEQUENCE
+            and path.endswith('.sql')
+        )
@@ -1,12 +1,16 @@
 import os
 import sys
+import hashlib
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
 from .base import Base
-from .db import Database
-from .utils import _save_csv
-from .script import DATABASES, OBJECTS, CREATE_TABLE
+from .utils import _save_csv, _in_lists
+from .script import DATABASES, OBJECTS, OBJECT_COUNT, OBJECT_LIST, OBJECTS_BY_ID, IN_LIST_SIZE
+from .export import FolderTarget, GitTarget, ExportWriter, ExportManifest, script_text
+from .table_scripter import TableScripter
+from .metrics import Metrics
 
 
 class RepoGenerator(Base):
@@ -18,6 +22,19 @@ class RepoGenerator(Base):
         includes (list, optional): default takes all databases from the given credential.
         excludes (list, optional): exclude databases from the given credential.
         err_file_path (str, optional): where the errors locate. Defaults to "errors.csv".
+        workers (int, optional): databases exported concurrently, each on its own connection.
+            At most `db_creds.pool_size`. Defaults to 1.
+        fetch_size (int, optional): objects fetched from the server at once. Defaults to 500.
+        queue_size (int, optional): scripts waiting to be written at most. Defaults to 1000.
+        incremental (bool, optional): refreshes an existing export; only objects modified since
+            the last run are scripted, files of dropped objects are deleted. Defaults to False.
+        manifest_path (str, optional): state of the exported files.
+            Defaults to "<export_path>/.deploydb_manifest.json".
+        git_branch (str, optional): exports straight into this branch of the git repository
+            at `export_path` as one commit, without writing the files. Created if missing.
+        checkout (bool, optional): checks `git_branch` out after the export. Defaults to False.
+        metrics (Metrics, optional): collects the timings of the phases (export_list, export_tables,
+            export_objects, export_write) and the counters of the export, see `Metrics`.
 
     Example:
         from deploydb import RepoGenerator
@@ -37,13 +54,32 @@ class RepoGenerator(Base):
         export_path,
         includes=[],
         excludes=[],
-        err_file_path="errors.csv"
+        err_file_path="errors.csv",
+        workers=1,
+        fetch_size=500,
+        queue_size=1000,
+        incremental=False,
+        manifest_path=None,
+        git_branch=None,
+        checkout=False,
+        metrics=None
     ) -> None:
         super().__init__(config)
+        if not 1 <= workers <= self._config.db_creds.pool_size:
+            raise ValueError(
+                f'Invalid workers: {workers}. Use 1 up to db_creds.pool_size: {self._config.db_creds.pool_size}.'
+            )
         self.path = export_path
         self.includes = includes
         self.excludes = excludes
         self.err_file_path = err_file_path
+        self.workers = workers
+        self.fetch_size = fetch_size
+        self.queue_size = queue_size
+        self.incremental = incremental
+        self.manifest_path = manifest_path or os.path.join(export_path, '.deploydb_manifest.json')
+        self.git_branch = git_branch
+        self.metrics = metrics or Metrics()
         self._failure = []
 
         self.sub_folders = (
@@ -57,36 +93,24 @@ class RepoGenerator(Base):
             {'DDLs': '# DDLs - Data Definitions'}
         )
         self._export_path_check()
+        if git_branch:
+            self._target = GitTarget(self.path, branch=git_branch, replace=not incremental, checkout=checkout)
+        else:
+            self._target = FolderTarget(self.path)
+        self._manifest = ExportManifest(self.manifest_path)
 
     def _export_path_check(self):
-        if os.path.exists(self.path):
+        if os.path.exists(self.path) and not (self.incremental or self.git_branch):
             raise ValueError(f'<export_path> folder exists! Please type a does not exist folder name.\nPath: {self.path}')  # noqa
 
     def _create_folder(self, db_name):
-        # base folder
-        if not os.path.exists(self.path):
-            os.mkdir(self.path)
-
-        # wrapper folder
-        project_path = os.path.join(self.path, 'Databases')
-        if not os.path.exists(project_path):
-            os.mkdir(project_path)
-
-        # db folder
-        project_path = os.path.join(project_path, db_name)
-        if not os.path.exists(project_path):
-            os.mkdir(project_path)
-
-        # objects folder
+        # objects folders with their README.md files
         for folder in self.sub_folders:
-            # add README.md file
             _folder = list(folder.keys())[0]
-            os.mkdir(os.path.join(self.path, project_path, _folder))
-
-            with open(os.path.join(self.path, project_path, _folder, f'{_folder}_README.md'), 'w') as f:
-                f.write(folder.get(_folder))
-
-        return project_path
+            self._target.write(
+                os.path.join('Databases', db_name, _folder, f'{_folder}_README.md'),
+                folder.get(_folder)
+            )
 
     def _safe_file_name(self, schema_name, object_name) -> str:
         allowed_chars = 'abcdefghijklmnopqrstuvwxyz_0123456789'
@@ -107,61 +131,149 @@ class RepoGenerator(Base):
 
         return f"{schema_name}{object_name}.sql"
 
-    def _write_script(self, parent, sub, schema_name, object_name, script):
+    def _script_path(self, db_name, sub, schema_name, object_name):
         safe_name = self._safe_file_name(schema_name, object_name)
-        path = os.path.join(parent, sub, safe_name)
-        with open(path, mode='w', encoding='utf-8') as f:
-            for line in str(script).split('\n'):
-                f.write(line)
-
-        total_rows = None
-        with open(path, mode='r', encoding='utf-8') as x:
-            total_rows = len(x.readlines())
-
-        if total_rows == 1:
-            with open(path, mode='w', encoding='utf-8') as f:
-                for line in str(script).split('\n'):
-                    f.write(line + '\n')
-
-    def _init_project(self, db_name, max_name_len):
-        project_path = self._create_folder(db_name)
+        return os.path.join('Databases', db_name, sub, safe_name)
+
+    def _changed_objects(self, db, db_name, known, objects):
+        """Compares the server objects with the manifest.
+
+        Unchanged entries are copied to `objects`. Returns the ids to script
+        (new, modified or renamed), whether a table is among them and the
+        paths of dropped objects.
+        """
+        changed = []
+        has_tables = False
+        current = set()
+        for x in db.execute(OBJECT_LIST).fetchall():
+            key = str(x.OBJECT_ID)
+            current.add(key)
+            entry = known.get(key)
+            path = self._script_path(db_name, x.SUB_FOLDER, x.SCHEMA_NAME, x.OBJECT_NAME)
+            if entry and entry[0] == path and entry[1] == x.MODIFY_DATE.isoformat():
+                objects[key] = entry
+            else:
+                changed.append(x.OBJECT_ID)
+                has_tables = has_tables or x.SUB_FOLDER == "Tables"
+        dropped = [entry[0] for key, entry in known.items() if key not in current]
+        return changed, has_tables, dropped
+
+    def _fetch_batches(self, db, queries):
+        """ Yields `fetch_size` rows at once of the queries, run one after the other. """
+        for query in queries:
+            cursor = db.execute(*query)
+            yield from iter(lambda: cursor.fetchmany(self.fetch_size), [])
+
+    def _init_project(self, db_name, max_name_len, position=0):
+        """ Exports a database, returns its failures. """
+        failure = []
+        known = self._manifest.objects(db_name) if self.incremental else None
+        if known is None:
+            self._create_folder(db_name)
+        objects = {}  # manifest of this run
+        stale = []  # paths of dropped or renamed objects
         progress = db_name + (" " * (max_name_len - len(db_name)))
-        _db = Database(creds=self._config.db_creds)
-        with _db.connect(db_name) as db:
-            objects = db.execute(OBJECTS).fetchall()
-            for item in tqdm(objects, desc=progress, colour="green"):
-                try:
-                    if item.SUB_FOLDER == "Tables":
-                        script = db.execute(
-                            CREATE_TABLE,
-                            item.SCHEMA_NAME,
-                            item.OBJECT_NAME
-                        ).fetchone().SQL
-                        self._write_script(project_path, item.SUB_FOLDER, item.SCHEMA_NAME, item.OBJECT_NAME, script)
+        writer = ExportWriter(self._target, max_queue=self.queue_size)
+        try:
+            with self._db().connect(db_name, phase='export_list') as db:
+                with self.metrics.phase('export_list', db=db_name):
+                    if known is None:
+                        known = {}
+                        has_tables = True
+                        total = db.execute(OBJECT_COUNT).fetchone().TOTAL
+                        queries = [(OBJECTS,)]
                     else:
-                        self._write_script(project_path, item.SUB_FOLDER, item.SCHEMA_NAME, item.OBJECT_NAME, item.SQL)
-                except:  # noqa
-                    error = str(traceback.format_exception(*sys.exc_info()))
-                    self._failure.append([db_name, item.SUB_FOLDER, item.OBJECT_NAME, error])
+                        changed, has_tables, stale = self._changed_objects(db, db_name, known, objects)
+                        total = len(changed)
+                        queries = [(OBJECTS_BY_ID, *x) for x in _in_lists(changed, IN_LIST_SIZE)]
+
+                # Table scripts are built from bulk catalog queries, before the
+                # cursor streams the objects.
+                tables = None
+                if has_tables and total:
+                    db.phase = 'export_tables'
+                    with self.metrics.phase('export_tables', db=db_name):
+                        tables = TableScripter(db)
+                db.phase = 'export_objects'
+                with self.metrics.phase('export_objects', db=db_name, objects=total), \
+                        tqdm(total=total, desc=progress, colour="green", position=position) as bar:
+                    for rows in self._fetch_batches(db, queries if total else []):
+                        for item in rows:
+                            try:
+                                if item.SUB_FOLDER == "Tables":
+                                    script = tables.script(item.OBJECT_ID)
+                                else:
+                                    script = item.SQL
+                                key = str(item.OBJECT_ID)
+                                path = self._script_path(db_name, item.SUB_FOLDER, item.SCHEMA_NAME, item.OBJECT_NAME)
+                                text = script_text(script)
+                                digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+                                entry = known.get(key)
+                                objects[key] = [path, item.MODIFY_DATE.isoformat(), digest]
+                                if entry and entry[0] != path:
+                                    stale.append(entry[0])
+                                elif entry and entry[2] == digest:
+                                    continue  # only modify_date changed
+                                writer.put(path, text, [db_name, item.SUB_FOLDER, item.OBJECT_NAME])
+                            except:  # noqa
+                                error = str(traceback.format_exception(*sys.exc_info()))
+                                failure.append([db_name, item.SUB_FOLDER, item.OBJECT_NAME, error])
+                        bar.update(len(rows))
+
+                # A stale path may have been taken over by another object.
+                in_use = {x[0] for x in objects.values()}
+                for path in stale:
+                    if path not in in_use:
+                        writer.remove(path)
+        finally:
+            failure.extend(writer.close())
+            self.metrics.record_phase('export_write', writer.busy, db=db_name, files=writer.files)
+            self.metrics.inc('deploydb_exported_files_total', writer.files)
+            self.metrics.inc('deploydb_exported_bytes_total', writer.bytes)
+            self.metrics.inc('deploydb_failures_total', len(failure), component='export')
+
+        # Files failed to write are exported again by the next run.
+        self._manifest.update(db_name, {
+            key: entry for key, entry in objects.items() if entry[0] not in writer.failed_paths
+        })
+        return failure
 
     def _generate(self):
-        _db = Database(creds=self._config.db_creds)
-        with _db.connect("master") as db:
-            databases = None
+        databases = None
 
-            if self.includes:
-                databases = self.includes
-            else:
+        if self.includes:
+            databases = self.includes
+        else:
+            with self._db().connect("master", phase='export_list') as db:
                 databases = [x.DB_NAME for x in db.execute(DATABASES).fetchall()]
 
-            max_name_len = max([len(x) for x in databases])
-            databases = [x for x in databases if x not in self.excludes]
+        max_name_len = max([len(x) for x in databases])
+        databases = [x for x in databases if x not in self.excludes]
 
+        if self.workers > 1:
+            # Failures are merged in database order, the same as a serial run.
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = [
+                    executor.submit(self._init_project, x, max_name_len, i)
+                    for i, x in enumerate(databases)
+                ]
+                for future in futures:
+                    self._failure.extend(future.result())
+        else:
             for x in databases:
-                self._init_project(x, max_name_len)
+                self._failure.extend(self._init_project(x, max_name_len))
 
     def run(self):
-        self._generate()
+        try:
+            with self.metrics.phase('export'):
+                self._generate()
+                self._target.close()
+                self._manifest.save()
+        finally:
+            # A failed export leaves no commit behind, nor a running `git fast-import`.
+            self._target.close(commit=False)
+            self.metrics.inc('deploydb_runs_total', component='export')
+            self.metrics.write()
         if self._failure:
             _save_csv(
                 path=os.path.join(self.path, self.err_file_path),
@@ -0,0 +1,145 @@
+import re
+import heapq
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .catalog import split_object_name
+
+
+# Folders of a stage run after the previous stage is completed.
+STAGES = (
+    ('Types',),
+    ('Tables',),
+    ('DDLs',),
+    ('Functions', 'Views', 'Stored-Procedures', 'Triggers'),
+    ('DMLs',),
+)
+# Free-form scripts, their references can not be analyzed; kept in order.
+SERIAL_TYPES = ('DDLs', 'DMLs')
+
+_COMMENTS = re.compile(r'--[^\n]*|/\*.*?\*/', re.S)
+_PART = r'(?:\[(?:[^\]]|\]\])+\]|"[^"]+"|[A-Za-z_#][\w@#$]*)'
+_MULTI_PART_NAME = re.compile(_PART + r'(?:\s*\.\s*' + _PART + r')*')
+_NAME_PARTS = re.compile(r'\[((?:[^\]]|\]\])+)\]|"([^"]+)"|([A-Za-z_#][\w@#$]*)')
+
+
+def referenced_names(script):
+    """Returns (schema, name) pairs referenced by a script, lower cased.
+
+    Schema is `None` for unqualified names. Comments are ignored, every
+    other identifier is a candidate; unknown ones are dropped by the graph.
+    """
+    names = set()
+    for match in _MULTI_PART_NAME.finditer(_COMMENTS.sub(' ', script)):
+        parts = [
+            (x.group(1) or '').replace(']]', ']') or x.group(2) or x.group(3)
+            for x in _NAME_PARTS.finditer(match.group(0))
+        ]
+        if len(parts) >= 2:
+            names.add((parts[-2].lower(), parts[-1].lower()))
+        else:
+            names.add((None, parts[-1].lower()))
+    return names
+
+
+class DependencyGraph:
+    """Execution plan of the changed files of a single database.
+
+    Files run in `STAGES`; inside a stage a file waits for the changed files
+    it references, found by scanning its SQL text and from the server side
+    `sys.sql_expression_dependencies` of the existing objects. Cycles are
+    broken by the original (`execution_sequence`) order.
+
+    Args:
+        files (list): `ChangedFile` list sorted by `sequence`.
+        read_script (callable): returns the SQL text of a `ChangedFile`.
+        server_dependencies (iterable, optional): (referencing_schema, referencing_name,
+            referenced_schema, referenced_name) rows.
+    """
+
+    def __init__(self, files, read_script, server_dependencies=()) -> None:
+        self.files = list(files)
+        self.stages = []
+        self._preds = {i: set() for i in range(len(self.files))}
+        self._succs = {i: set() for i in range(len(self.files))}
+
+        keys = {}
+        for i, file in enumerate(self.files):
+            schema_name, name = split_object_name(file.object_name)
+            keys.setdefault((schema_name.lower(), name.lower()), []).append(i)
+
+        for folders in STAGES:
+            stage = [i for i, x in enumerate(self.files) if x.object_type in folders]
+            if not stage:
+                continue
+            self.stages.append(stage)
+            members = set(stage)
+
+            serial = [i for i in stage if self.files[i].object_type in SERIAL_TYPES]
+            for prev, i in zip(serial, serial[1:]):
+                self._add_edge(prev, i)
+
+            for i in stage:
+                if self.files[i].object_type in SERIAL_TYPES:
+                    continue
+                own_schema, _ = split_object_name(self.files[i].object_name)
+                for schema_name, name in referenced_names(read_script(self.files[i])):
+                    candidates = [(schema_name, name)] if schema_name else [(own_schema.lower(), name), ('dbo', name)]
+                    for key in candidates:
+                        for j in keys.get(key, ()):
+                            if j in members:
+                                self._add_edge(j, i)
+
+            for ref_schema, ref_name, dep_schema, dep_name in server_dependencies:
+                dependents = keys.get((str(ref_schema).lower(), str(ref_name).lower()), ())
+                dependencies = keys.get((str(dep_schema).lower(), str(dep_name).lower()), ())
+                for i in dependents:
+                    for j in dependencies:
+                        if i in members and j in members:
+                            self._add_edge(j, i)
+
+    def _add_edge(self, before, after):
+        if before != after:
+            self._preds[after].add(before)
+            self._succs[before].add(after)
+
+    def dependencies(self, file_index):
+        return set(self._preds[file_index])
+
+    def order(self):
+        """ Returns the files in a dependency respecting order. """
+        ordered = []
+        self.run(lambda x: ordered.append(x), max_workers=1)
+        return ordered
+
+    def run(self, execute, max_workers=1):
+        """Calls `execute(file)` for every file, independent files concurrently.
+
+        A failing file does not stop its dependents, errors are expected to
+        be handled (logged) by `execute`.
+        """
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            for stage in self.stages:
+                remaining = {i: len(self._preds[i]) for i in stage}
+                ready = [i for i in stage if remaining[i] == 0]
+                heapq.heapify(ready)
+                running = {}
+                while remaining or running:
+                    if not ready and not running:
+                        # Cycle: the earliest file in the original order goes first.
+                        i = min(remaining)
+                        heapq.heappush(ready, i)
+
+                    while ready and len(running) < max(1, max_workers):
+                        i = heapq.heappop(ready)
+                        del remaining[i]
+                        running[executor.submit(execute, self.files[i])] = i
+
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        i = running.pop(future)
+                        future.result()
+                        for j in self._succs[i]:
+                            if j in remaining and remaining[j] > 0:
+                                remaining[j] -= 1
+                                if remaining[j] == 0:
+                                    heapq.heappush(ready, j)
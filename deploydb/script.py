@@ -155,6 +155,116 @@ CREATE_TABLE = """
     SELECT @SQL AS SQL
 """  # noqa
 
+# Set-based counterparts of CREATE_TABLE for every table of a database,
+# assembled by `deploydb.table_scripter.TableScripter`. Expressions are the
+# same as in CREATE_TABLE so the output stays byte-identical.
+TABLES = """
+    SELECT
+        OBJECT_ID   = o.[object_id]
+    ,   TABLE_NAME  = '[' + s.name + '].[' + o.name + ']'
+    FROM sys.objects o WITH (NOWAIT)
+        JOIN sys.schemas s WITH (NOWAIT) ON o.[schema_id] = s.[schema_id]
+    WHERE o.[type] = 'U'
+    AND o.is_ms_shipped = 0
+"""
+
+TABLE_COLUMNS = """
+    SELECT
+        OBJECT_ID   = c.[object_id]
+    ,   LINE        = CHAR(9) + ', [' + c.name + '] ' +
+            CASE WHEN c.is_computed = 1
+                THEN 'AS ' + cc.[definition]
+                ELSE (tp.name) +
+                    CASE WHEN tp.name IN ('varchar', 'char', 'varbinary', 'binary', 'text')
+                        THEN '(' + CASE WHEN c.max_length = -1 THEN 'MAX' ELSE CAST(c.max_length AS VARCHAR(5)) END + ')'
+                        WHEN tp.name IN ('nvarchar', 'nchar')
+                        THEN '(' + CASE WHEN c.max_length = -1 THEN 'MAX' ELSE CAST(c.max_length / 2 AS VARCHAR(5)) END + ')'
+                        WHEN tp.name IN ('datetime2', 'time2', 'datetimeoffset')
+                        THEN '(' + CAST(c.scale AS VARCHAR(5)) + ')'
+                        WHEN tp.name = 'decimal'
+                        THEN '(' + CAST(c.[precision] AS VARCHAR(5)) + ',' + CAST(c.scale AS VARCHAR(5)) + ')'
+                        ELSE ''
+                    END +
+                    CASE WHEN c.is_nullable = 1 THEN ' NULL' ELSE ' NOT NULL' END +
+                    CASE WHEN dc.[definition] IS NOT NULL THEN ' DEFAULT' + dc.[definition] ELSE '' END +
+                    CASE WHEN ic.is_identity = 1 THEN ' IDENTITY(' + CAST(ISNULL(ic.seed_value, '0') AS CHAR(1)) + ',' + CAST(ISNULL(ic.increment_value, '1') AS CHAR(1)) + ')' ELSE '' END
+            END + CHAR(13)
+    FROM sys.columns c WITH (NOWAIT)
+    JOIN sys.objects o WITH (NOWAIT) ON o.[object_id] = c.[object_id] AND o.[type] = 'U' AND o.is_ms_shipped = 0
+    JOIN sys.types tp WITH (NOWAIT) ON c.user_type_id = tp.user_type_id
+    LEFT JOIN sys.computed_columns cc WITH (NOWAIT) ON c.[object_id] = cc.[object_id] AND c.column_id = cc.column_id
+    LEFT JOIN sys.default_constraints dc WITH (NOWAIT) ON c.default_object_id != 0 AND c.[object_id] = dc.parent_object_id AND c.column_id = dc.parent_column_id
+    LEFT JOIN sys.identity_columns ic WITH (NOWAIT) ON c.is_identity = 1 AND c.[object_id] = ic.[object_id] AND c.column_id = ic.column_id
+    ORDER BY c.[object_id], c.column_id
+"""  # noqa
+
+TABLE_PRIMARY_KEYS = """
+    SELECT
+        OBJECT_ID       = k.parent_object_id
+    ,   CONSTRAINT_NAME = k.name
+    ,   COLUMN_SQL      = ', [' + c.name + '] ' + CASE WHEN ic.is_descending_key = 1 THEN 'DESC' ELSE 'ASC' END
+    FROM sys.key_constraints k WITH (NOWAIT)
+    JOIN sys.index_columns ic WITH (NOWAIT) ON ic.[object_id] = k.parent_object_id AND ic.index_id = k.unique_index_id
+    JOIN sys.columns c WITH (NOWAIT) ON c.[object_id] = ic.[object_id] AND c.column_id = ic.column_id
+    WHERE k.[type] = 'PK'
+    AND ic.is_included_column = 0
+    ORDER BY k.parent_object_id, ic.index_column_id
+"""
+
+TABLE_FOREIGN_KEYS = """
+    SELECT
+        OBJECT_ID       = fk.parent_object_id
+    ,   FK_ID           = fk.[object_id]
+    ,   FK_NAME         = fk.name
+    ,   IS_NOT_TRUSTED  = fk.is_not_trusted
+    ,   REFERENCED_NAME = '[' + SCHEMA_NAME(ro.[schema_id]) + '].[' + ro.name + ']'
+    ,   DELETE_ACTION   = fk.delete_referential_action
+    ,   UPDATE_ACTION   = fk.update_referential_action
+    FROM sys.foreign_keys fk WITH (NOWAIT)
+    JOIN sys.objects ro WITH (NOWAIT) ON ro.[object_id] = fk.referenced_object_id
+    ORDER BY fk.parent_object_id, fk.[object_id]
+"""
+
+TABLE_FOREIGN_KEY_COLUMNS = """
+    SELECT
+        FK_ID   = k.constraint_object_id
+    ,   CNAME   = c.name
+    ,   RCNAME  = rc.name
+    FROM sys.foreign_key_columns k WITH (NOWAIT)
+    JOIN sys.columns rc WITH (NOWAIT) ON rc.[object_id] = k.referenced_object_id AND rc.column_id = k.referenced_column_id
+    JOIN sys.columns c WITH (NOWAIT) ON c.[object_id] = k.parent_object_id AND c.column_id = k.parent_column_id
+    ORDER BY k.constraint_object_id, k.constraint_column_id
+"""  # noqa
+
+TABLE_INDEXES = """
+    SELECT
+        OBJECT_ID   = i.[object_id]
+    ,   INDEX_ID    = i.index_id
+    ,   INDEX_NAME  = i.name
+    ,   IS_UNIQUE   = i.is_unique
+    FROM sys.indexes i WITH (NOWAIT)
+    JOIN sys.objects o WITH (NOWAIT) ON o.[object_id] = i.[object_id] AND o.[type] = 'U' AND o.is_ms_shipped = 0
+    WHERE i.is_primary_key = 0
+    AND i.[type] = 2
+    ORDER BY i.[object_id], i.index_id
+"""
+
+TABLE_INDEX_COLUMNS = """
+    SELECT
+        OBJECT_ID           = ic.[object_id]
+    ,   INDEX_ID            = ic.index_id
+    ,   COLUMN_NAME         = c.name
+    ,   IS_DESCENDING_KEY   = ic.is_descending_key
+    ,   IS_INCLUDED_COLUMN  = ic.is_included_column
+    FROM sys.index_columns ic WITH (NOWAIT)
+    JOIN sys.columns c WITH (NOWAIT) ON ic.[object_id] = c.[object_id] AND ic.column_id = c.column_id
+    JOIN sys.indexes i WITH (NOWAIT) ON i.[object_id] = ic.[object_id] AND i.index_id = ic.index_id
+    JOIN sys.objects o WITH (NOWAIT) ON o.[object_id] = i.[object_id] AND o.[type] = 'U' AND o.is_ms_shipped = 0
+    WHERE i.is_primary_key = 0
+    AND i.[type] = 2
+    ORDER BY ic.[object_id], ic.index_id, ic.index_column_id
+"""
+
 OBJECTS = """
 	SELECT
         SUB_FOLDER		= CASE all_objects.type
@@ -169,6 +279,7 @@ OBJECTS = """
     ,	OBJECT_ID	= all_objects.object_id
     ,	SCHEMA_NAME	= schemas.name
     ,	OBJECT_NAME	= all_objects.name
+    ,	MODIFY_DATE	= all_objects.modify_date
     ,	SQL		    = all_sql_modules.definition
 
     FROM sys.all_objects
@@ -192,6 +303,82 @@ OBJECTS = """
     --,	all_objects.object_id
 """  # noqa
 
+# OBJECTS without definitions, compared to the export manifest.
+OBJECT_LIST = """
+    SELECT
+        SUB_FOLDER  = CASE all_objects.type
+                        WHEN 'U' THEN 'Tables'
+                        WHEN 'FN' THEN 'Functions'
+                        WHEN 'V ' THEN 'Views'
+                        WHEN 'IF' THEN 'Functions'
+                        WHEN 'TF' THEN 'Functions'
+                        WHEN 'P ' THEN 'Stored-Procedures'
+                        WHEN 'TR' THEN 'Triggers'
+                    END
+    ,   OBJECT_ID   = all_objects.object_id
+    ,   SCHEMA_NAME = schemas.name
+    ,   OBJECT_NAME = all_objects.name
+    ,   MODIFY_DATE = all_objects.modify_date
+    FROM sys.all_objects
+        JOIN sys.schemas
+            ON schemas.schema_id = all_objects.schema_id
+    WHERE all_objects.object_id > 0
+    AND all_objects.type IN ('U', 'FN', 'V', 'IF', 'TF', 'P', 'TR')
+"""
+
+# Values of an `IN (?, ...)` list sent per query. The list has a fixed length,
+# padded with NULLs, so every chunk reuses the cached plan. OPENJSON would need
+# database compatibility level 130.
+IN_LIST_SIZE = 500
+_IN_LIST = ', '.join(['?'] * IN_LIST_SIZE)
+
+# OBJECTS of up to IN_LIST_SIZE object ids.
+OBJECTS_BY_ID = f"""
+	SELECT
+        SUB_FOLDER		= CASE all_objects.type
+                            WHEN 'U' THEN 'Tables'			-- SQL_SCALAR_FUNCTION
+                            WHEN 'FN' THEN 'Functions'			-- SQL_SCALAR_FUNCTION
+                            WHEN 'V ' THEN 'Views'				-- VIEW
+                            WHEN 'IF' THEN 'Functions'			-- SQL_INLINE_TABLE_VALUED_FUNCTION
+                            WHEN 'TF' THEN 'Functions'			-- SQL_TABLE_VALUED_FUNCTION
+                            WHEN 'P ' THEN 'Stored-Procedures'	-- SQL_STORED_PROCEDURE
+                            WHEN 'TR' THEN 'Triggers'			-- SQL_TRIGGER
+                        END
+    ,	OBJECT_ID	= all_objects.object_id
+    ,	SCHEMA_NAME	= schemas.name
+    ,	OBJECT_NAME	= all_objects.name
+    ,	MODIFY_DATE	= all_objects.modify_date
+    ,	SQL		    = all_sql_modules.definition
+
+    FROM sys.all_objects
+		JOIN sys.schemas
+			ON schemas.schema_id = all_objects.schema_id 
+		LEFT JOIN sys.all_sql_modules
+			ON all_sql_modules.object_id = all_objects.object_id
+    WHERE all_objects.object_id > 0
+	AND all_objects.type IN ('U', 'FN', 'V', 'IF', 'TF', 'P', 'TR')
+	AND all_objects.object_id IN ({_IN_LIST})
+    ORDER BY
+        CASE all_objects.type
+            WHEN 'U' THEN 0	-- SQL_SCALAR_FUNCTION
+            WHEN 'FN' THEN 1	-- SQL_SCALAR_FUNCTION
+            WHEN 'V ' THEN 2	-- VIEW
+            WHEN 'IF' THEN 3	-- SQL_INLINE_TABLE_VALUED_FUNCTION
+            WHEN 'TF' THEN 4	-- SQL_TABLE_VALUED_FUNCTION
+            WHEN 'P ' THEN 5	-- SQL_STORED_PROCEDURE
+            WHEN 'TR' THEN 6	-- SQL_TRIGGER
+        END
+    ,   schemas.name
+    --,	all_objects.object_id
+"""  # noqa
+
+OBJECT_COUNT = """
+    SELECT COUNT(*) AS TOTAL
+    FROM sys.all_objects
+    WHERE all_objects.object_id > 0
+    AND all_objects.type IN ('U', 'FN', 'V', 'IF', 'TF', 'P', 'TR')
+"""
+
 GET_OBJECT = """
     SELECT *
     FROM sys.all_objects
@@ -208,6 +395,60 @@ GET_OBJECT = """
     AND all_objects.object_id = OBJECT_ID(?)
 """
 
+CATALOG_DELTA = """
+    SELECT COUNT(*) AS TOTAL FROM sys.objects;
+
+    SELECT
+        SCHEMA_NAME = schemas.name
+    ,   OBJECT_NAME = objects.name
+    ,   TYPE        = RTRIM(objects.type)
+    ,   MODIFY_DATE = objects.modify_date
+    FROM sys.objects
+        JOIN sys.schemas
+            ON schemas.schema_id = objects.schema_id
+    WHERE objects.modify_date >= DATEADD(SECOND, -1, ?)
+"""
+
+EXPRESSION_DEPENDENCIES = """
+    SELECT
+        REFERENCING_SCHEMA  = OBJECT_SCHEMA_NAME(d.referencing_id)
+    ,   REFERENCING_NAME    = OBJECT_NAME(d.referencing_id)
+    ,   REFERENCED_SCHEMA   = ISNULL(d.referenced_schema_name, OBJECT_SCHEMA_NAME(d.referenced_id))
+    ,   REFERENCED_NAME     = d.referenced_entity_name
+    FROM sys.sql_expression_dependencies d
+    WHERE d.referencing_class = 1
+    AND d.referenced_database_name IS NULL
+    AND d.referenced_id IS NOT NULL
+"""
+
+MODULE_HASHES = """
+    SELECT
+        SUB_FOLDER      = CASE objects.type
+                            WHEN 'FN' THEN 'Functions'
+                            WHEN 'IF' THEN 'Functions'
+                            WHEN 'TF' THEN 'Functions'
+                            WHEN 'V ' THEN 'Views'
+                            WHEN 'P ' THEN 'Stored-Procedures'
+                            WHEN 'TR' THEN 'Triggers'
+                        END
+    ,   SCHEMA_NAME     = schemas.name
+    ,   OBJECT_NAME     = objects.name
+        -- line endings are normalized to LF, see `deploydb.drift.definition_hashes`
+    ,   DEFINITION_HASH = HASHBYTES('SHA2_256', REPLACE(REPLACE(
+                            sql_modules.definition, CHAR(13) + CHAR(10), CHAR(10)), CHAR(13), CHAR(10)))
+    FROM sys.sql_modules
+        JOIN sys.objects
+            ON objects.object_id = sql_modules.object_id
+        JOIN sys.schemas
+            ON schemas.schema_id = objects.schema_id
+    WHERE objects.type IN ('FN', 'IF', 'TF', 'V', 'P', 'TR')
+    AND objects.is_ms_shipped = 0
+"""
+
+# Version of the `Deploydb` objects, kept in the `deploydb_schema_version` extended
+# property of the schema. `INIT_DEPLOYDB` runs only while it is lower.
+SCHEMA_VERSION = 1
+
 INIT_DEPLOYDB = """
     IF NOT EXISTS (SELECT NULL FROM sys.schemas WHERE name = 'Deploydb')
         EXEC('CREATE SCHEMA Deploydb');
@@ -220,20 +461,66 @@ INIT_DEPLOYDB = """
             Folder NVARCHAR(1000),
             IsFailed BIT CONSTRAINT DF_Deploydb_ExecutionLog_IsFailed DEFAULT(0),
             Error NVARCHAR(2000),
+            BlobSHA VARCHAR(64),
+            FailedBatch INT,
+            CpuTimeMs INT,
+            ElapsedTimeMs INT,
+            LogicalReads BIGINT,
+            RowsAffected BIGINT,
             INDEX IX_Deploydb_ExecutionLog_CommitHexSHA_Folder (CommitHexSHA, Folder)
         );
 
+    IF COL_LENGTH('Deploydb.ExecutionLog', 'BlobSHA') IS NULL
+        EXEC('ALTER TABLE Deploydb.ExecutionLog ADD BlobSHA VARCHAR(64)');
+
+    IF COL_LENGTH('Deploydb.ExecutionLog', 'FailedBatch') IS NULL
+        EXEC('ALTER TABLE Deploydb.ExecutionLog ADD FailedBatch INT');
+
+    IF COL_LENGTH('Deploydb.ExecutionLog', 'CpuTimeMs') IS NULL
+        EXEC('ALTER TABLE Deploydb.ExecutionLog ADD CpuTimeMs INT, ElapsedTimeMs INT, LogicalReads BIGINT, RowsAffected BIGINT');
+
+    IF NOT EXISTS (SELECT NULL FROM sys.indexes WHERE name = 'IX_Deploydb_ExecutionLog_Folder')
+        EXEC('CREATE INDEX IX_Deploydb_ExecutionLog_Folder ON Deploydb.ExecutionLog (Folder, RowId) INCLUDE (BlobSHA, IsFailed)');
+
     IF OBJECT_ID('Deploydb.ChangeLog', 'U') IS NULL
         CREATE TABLE Deploydb.ChangeLog (
             RowId INT IDENTITY,
             CreatedAt DATETIME CONSTRAINT DF_Deploydb_ChangeLog_CreatedAt DEFAULT(GETDATE()),
             CommitHexSHA VARCHAR(64) CONSTRAINT PK_Deploydb_ChangeLog_CommitHexSHA PRIMARY KEY CLUSTERED
         );
+
+    DECLARE @version SQL_VARIANT = ?;
+    IF EXISTS (SELECT NULL FROM sys.extended_properties WHERE class = 3 AND major_id = SCHEMA_ID('Deploydb') AND minor_id = 0 AND name = 'deploydb_schema_version')
+        EXEC sys.sp_updateextendedproperty @name = N'deploydb_schema_version', @value = @version, @level0type = N'SCHEMA', @level0name = N'Deploydb';
+    ELSE
+        EXEC sys.sp_addextendedproperty @name = N'deploydb_schema_version', @value = @version, @level0type = N'SCHEMA', @level0name = N'Deploydb';
+"""  # noqa
+
+DEPLOYDB_STATE = """
+    DECLARE @version INT = (
+        SELECT CAST(value AS INT)
+        FROM sys.extended_properties
+        WHERE class = 3
+        AND major_id = SCHEMA_ID('Deploydb')
+        AND minor_id = 0
+        AND name = 'deploydb_schema_version'
+    );
+
+    -- The changelog is read only when the marker guarantees it exists.
+    IF @version IS NULL
+        SELECT SCHEMA_VERSION = @version, LAST_SHA = CAST(NULL AS VARCHAR(64));
+    ELSE
+        SELECT
+            SCHEMA_VERSION = @version
+        ,   LAST_SHA = (SELECT TOP 1 CommitHexSHA FROM Deploydb.ChangeLog ORDER BY RowId DESC);
 """
 
 EXECUTION_LOG_INSERT = """
-    INSERT INTO Deploydb.ExecutionLog (CommitHexSHA, Folder, IsFailed, Error)
-    VALUES (?,?,?,?);
+    INSERT INTO Deploydb.ExecutionLog (
+        CommitHexSHA, Folder, IsFailed, Error, BlobSHA, FailedBatch,
+        CpuTimeMs, ElapsedTimeMs, LogicalReads, RowsAffected
+    )
+    VALUES (?,?,?,?,?,?,?,?,?,?);
 """
 
 CHANGELOG_INSERT = """
@@ -244,6 +531,70 @@ DUPLICATE_CONTROL = """
     SELECT 1 FROM Deploydb.ExecutionLog WHERE CommitHexSHA = ? AND Folder = ?
 """
 
+EXECUTED_FILES = """
+    SELECT DISTINCT Folder FROM Deploydb.ExecutionLog WHERE CommitHexSHA = ?
+"""
+
+# DEPLOYED_BLOBS of up to IN_LIST_SIZE paths.
+DEPLOYED_BLOBS = f"""
+    SELECT Folder, BlobSHA
+    FROM (
+        SELECT
+            Folder
+        ,   BlobSHA
+        ,   RowNo = ROW_NUMBER() OVER (PARTITION BY Folder ORDER BY RowId DESC)
+        FROM Deploydb.ExecutionLog
+        WHERE IsFailed = 0
+        AND BlobSHA IS NOT NULL
+        AND Folder IN ({_IN_LIST})
+    ) x
+    WHERE RowNo = 1
+"""
+
 LAST_CHANGELOG_SHA = """
     SELECT TOP 1 CommitHexSHA FROM Deploydb.ChangeLog ORDER BY RowId DESC
 """
+
+# Sent on checkin of a connection that ran deployed scripts: rolls back an open
+# transaction and restores the SET options of a fresh ODBC connection. Temp
+# tables and IDENTITY_INSERT survive it, scripts using them are run on a
+# connection of their own.
+RESET_SESSION = """
+    IF @@TRANCOUNT > 0 ROLLBACK;
+    SET ANSI_NULLS ON; SET ANSI_NULL_DFLT_ON ON; SET ANSI_PADDING ON; SET ANSI_WARNINGS ON;
+    SET CONCAT_NULL_YIELDS_NULL ON; SET QUOTED_IDENTIFIER ON; SET ARITHABORT OFF; SET NUMERIC_ROUNDABORT OFF;
+    SET XACT_ABORT OFF; SET IMPLICIT_TRANSACTIONS OFF; SET NOCOUNT OFF; SET ROWCOUNT 0; SET TEXTSIZE 2147483647;
+    SET TRANSACTION ISOLATION LEVEL READ COMMITTED; SET LOCK_TIMEOUT -1; SET DEADLOCK_PRIORITY NORMAL;
+    SET DATEFIRST 7; SET DATEFORMAT mdy;
+"""
+
+SESSION_STATS = """
+    SELECT
+        CPU_TIME = cpu_time
+    ,   LOGICAL_READS = logical_reads
+    ,   NOW = SYSDATETIME()
+    FROM sys.dm_exec_sessions
+    WHERE session_id = @@SPID
+"""
+
+COSTLY_SCRIPTS = """
+    SELECT TOP (?)
+        CommitHexSHA
+    ,   Folder
+    ,   IsFailed
+    ,   CpuTimeMs
+    ,   ElapsedTimeMs
+    ,   LogicalReads
+    ,   RowsAffected
+    ,   CreatedAt
+    FROM Deploydb.ExecutionLog
+    WHERE ElapsedTimeMs IS NOT NULL
+    ORDER BY
+        CASE ?
+            WHEN 'cpu' THEN CAST(CpuTimeMs AS BIGINT)
+            WHEN 'reads' THEN LogicalReads
+            WHEN 'rows' THEN RowsAffected
+            ELSE CAST(ElapsedTimeMs AS BIGINT)
+        END DESC
+    ,   RowId DESC
+"""
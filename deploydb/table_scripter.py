@@ -0,0 +1,100 @@
+from .script import (
+    TABLES, TABLE_COLUMNS, TABLE_PRIMARY_KEYS, TABLE_FOREIGN_KEYS,
+    TABLE_FOREIGN_KEY_COLUMNS, TABLE_INDEXES, TABLE_INDEX_COLUMNS
+)
+
+
+_DELETE_ACTIONS = {1: ' ON DELETE CASCADE', 2: ' ON DELETE SET NULL', 3: ' ON DELETE SET DEFAULT'}
+_UPDATE_ACTIONS = {1: ' ON UPDATE CASCADE', 2: ' ON UPDATE SET NULL', 3: ' ON UPDATE SET DEFAULT'}
+
+
+def _group(rows, *keys):
+    """ Groups ordered rows by the given columns. """
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(getattr(row, x) for x in keys), []).append(row)
+    return groups
+
+
+class TableScripter:
+    """Scripts every table of a database with a fixed number of catalog queries.
+
+    The output is byte-identical to the `CREATE_TABLE` query, which runs
+    once per table; here columns, keys and indexes of all tables are read
+    in bulk and the scripts are assembled in memory.
+
+    Args:
+        db (pyodbc.Cursor): cursor of the database to script.
+    """
+
+    def __init__(self, db) -> None:
+        self.names = {x.OBJECT_ID: x.TABLE_NAME for x in db.execute(TABLES).fetchall()}
+
+        self.columns = {}
+        for row in db.execute(TABLE_COLUMNS).fetchall():
+            if row.LINE is not None:
+                self.columns.setdefault(row.OBJECT_ID, []).append(row.LINE)
+
+        self.primary_keys = _group(db.execute(TABLE_PRIMARY_KEYS).fetchall(), 'OBJECT_ID')
+        self.foreign_keys = _group(db.execute(TABLE_FOREIGN_KEYS).fetchall(), 'OBJECT_ID')
+        self.foreign_key_columns = _group(db.execute(TABLE_FOREIGN_KEY_COLUMNS).fetchall(), 'FK_ID')
+        self.indexes = _group(db.execute(TABLE_INDEXES).fetchall(), 'OBJECT_ID')
+        self.index_columns = _group(db.execute(TABLE_INDEX_COLUMNS).fetchall(), 'OBJECT_ID', 'INDEX_ID')
+
+    def script(self, object_id):
+        """ Returns the `CREATE TABLE` script, `None` like `CREATE_TABLE` when it can not be scripted. """
+        object_name = self.names.get(object_id)
+        columns = self.columns.get(object_id)
+        if object_name is None or not columns:
+            return None
+
+        sql = 'CREATE TABLE ' + object_name + '\r' + '(' + '\r' + '\t ' + ''.join(columns)[2:]
+        sql += self._primary_key(object_id) + ')' + '\r'
+        sql += self._foreign_keys(object_id, object_name)
+        sql += self._indexes(object_id, object_name)
+        return sql
+
+    def _primary_key(self, object_id):
+        rows = self.primary_keys.get((object_id,))
+        if not rows:
+            return ''
+        columns = ''.join(x.COLUMN_SQL for x in rows)[2:]
+        return '\t' + ', CONSTRAINT [' + rows[0].CONSTRAINT_NAME + '] PRIMARY KEY (' + columns + ')' + '\r'
+
+    def _foreign_keys(self, object_id, object_name):
+        sql = ''
+        for fk in self.foreign_keys.get((object_id,), ()):
+            columns = self.foreign_key_columns.get((fk.FK_ID,))
+            if not columns:
+                continue  # NULL row, skipped by FOR XML
+            sql += (
+                '\r' + 'ALTER TABLE ' + object_name + ' WITH'
+                + (' NOCHECK' if fk.IS_NOT_TRUSTED else ' CHECK')
+                + ' ADD CONSTRAINT [' + fk.FK_NAME + '] FOREIGN KEY('
+                + ', '.join('[' + x.CNAME + ']' for x in columns) + ')'
+                + ' REFERENCES ' + fk.REFERENCED_NAME + ' ('
+                + ', '.join('[' + x.RCNAME + ']' for x in columns) + ')'
+                + _DELETE_ACTIONS.get(fk.DELETE_ACTION, '')
+                + _UPDATE_ACTIONS.get(fk.UPDATE_ACTION, '')
+                + '\r' + 'ALTER TABLE ' + object_name + ' CHECK CONSTRAINT [' + fk.FK_NAME + ']' + '\r'
+            )
+        return sql
+
+    def _indexes(self, object_id, object_name):
+        sql = ''
+        for index in self.indexes.get((object_id,), ()):
+            columns = self.index_columns.get((object_id, index.INDEX_ID), ())
+            keys = [x for x in columns if not x.IS_INCLUDED_COLUMN]
+            included = [x for x in columns if x.IS_INCLUDED_COLUMN]
+            if not keys:
+                continue  # NULL row, skipped by FOR XML
+            sql += (
+                '\r' + 'CREATE' + (' UNIQUE' if index.IS_UNIQUE else '')
+                + ' NONCLUSTERED INDEX [' + index.INDEX_NAME + '] ON ' + object_name + ' ('
+                + ', '.join('[' + x.COLUMN_NAME + ']' + (' DESC' if x.IS_DESCENDING_KEY else ' ASC') for x in keys)
+                + ')'
+                + ('\r' + 'INCLUDE (' + ', '.join('[' + x.COLUMN_NAME + ']' for x in included) + ')'
+                   if included else '')
+                + '\r'
+            )
+        return sql
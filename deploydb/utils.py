@@ -29,3 +29,11 @@ def _last_commit_hash(path):
     if len(logs) > 1:
         return logs[-1][0]  # commit_id
     return None
+
+
+def _in_lists(values, size):
+    """ Yields `size` long parameter lists of the values, the last one padded with `None`. """
+    values = list(values)
+    for i in range(0, len(values), size):
+        chunk = values[i:i + size]
+        yield chunk + [None] * (size - len(chunk))
@@ -0,0 +1,172 @@
+import hmac
+import json
+import hashlib
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def parse_push(payload: dict):
+    """Returns (ref, after_sha) of a push event payload.
+
+    GitHub and GitLab push events use `ref` and `after`, a generic payload
+    may also send `branch` and `sha`.
+    """
+    ref = payload.get('ref') or payload.get('branch') or ''
+    if ref and not ref.startswith('refs/'):
+        ref = f'refs/heads/{ref}'
+    after = payload.get('after') or payload.get('checkout_sha') or payload.get('sha') or ''
+    return ref, after
+
+
+def verify_signature(secret, body: bytes, headers) -> bool:
+    """Checks the request against the shared secret.
+
+    Accepts GitHub `X-Hub-Signature-256`, GitLab `X-Gitlab-Token` and the
+    generic `X-Deploydb-Signature` (`sha256=<hmac of the body>`) headers.
+    """
+    if not secret:
+        return True
+
+    token = headers.get('X-Gitlab-Token')
+    if token is not None:
+        return hmac.compare_digest(token, secret)
+
+    signature = headers.get('X-Hub-Signature-256') or headers.get('X-Deploydb-Signature')
+    if not signature:
+        return False
+    expected = 'sha256=' + hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(signature, expected)
+
+
+class WebhookServer:
+    """Receives push events and runs `handle_changes` of a listener.
+
+    Pushes arriving while a run is queued or in progress are coalesced,
+    a burst of pushes ends up in a single follow-up run.
+
+    Args:
+        listener (Listener): listener to trigger.
+        secret (str, optional): shared secret of the webhook.
+        host (str, optional): address to bind. Defaults to localhost.
+        port (int, optional): port to bind, `0` picks a free one.
+        coalesce_delay (float, optional): seconds to wait for more pushes before a run.
+        executable (bool, optional): passed to `handle_changes`.
+
+    Example:
+        from deploydb import Listener
+        from deploydb.webhook import WebhookServer
+
+        server = WebhookServer(Listener('config.json'), secret='...', port=8080)
+        server.serve_forever()
+    """
+
+    def __init__(
+        self,
+        listener,
+        *,
+        secret=None,
+        host='127.0.0.1',
+        port=8080,
+        coalesce_delay=1.0,
+        executable=True
+    ) -> None:
+        self.listener = listener
+        self.secret = secret
+        self.coalesce_delay = coalesce_delay
+        self.executable = executable
+        self.runs = 0
+        self._pending = None
+        self._queued = threading.Event()
+        self._stopped = threading.Event()
+        self._httpd = ThreadingHTTPServer((host, port), self._handler())
+        self._threads = []
+
+    @property
+    def server_address(self):
+        return self._httpd.server_address
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, status, body):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):  # noqa
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if not verify_signature(server.secret, body, self.headers):
+                    return self._reply(401, {'status': 'invalid signature'})
+                try:
+                    payload = json.loads(body.decode('utf-8') or '{}')
+                except ValueError:
+                    return self._reply(400, {'status': 'invalid payload'})
+                if not isinstance(payload, dict):
+                    return self._reply(400, {'status': 'invalid payload'})
+
+                ref, after = parse_push(payload)
+                if ref != f'refs/heads/{server.listener._config.target_branch}':
+                    return self._reply(202, {'status': 'ignored', 'ref': ref})
+
+                server.enqueue(after)
+                return self._reply(202, {'status': 'queued', 'after': after})
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def enqueue(self, sha=None):
+        """ Requests a run for the pushed commit, coalesced with pending requests. """
+        self._pending = sha
+        self._queued.set()
+
+    def _worker(self):
+        while not self._stopped.is_set():
+            if not self._queued.wait(timeout=0.5):
+                continue
+            # Gathers the rest of a push burst into this run.
+            self._stopped.wait(self.coalesce_delay)
+            self._queued.clear()
+            sha, self._pending = self._pending, None
+            if self._stopped.is_set():
+                break
+            if sha and sha == self.listener._deployed_hash:
+                continue
+            try:
+                self.listener.handle_changes(self.executable)
+            except Exception:
+                traceback.print_exc()
+            self.runs += 1
+
+    def start(self):
+        """ Serves and deploys on background threads. """
+        self._threads = [
+            threading.Thread(target=self._httpd.serve_forever, daemon=True),
+            threading.Thread(target=self._worker, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._threads:
+            self._httpd.shutdown()
+        self._httpd.server_close()
+        for thread in self._threads:
+            thread.join()
+
+    def serve_forever(self):
+        self.start()
+        try:
+            self._stopped.wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
@@ -0,0 +1,672 @@
+"""In-process stand-in for `pyodbc` simulating a SQL Server.
+
+Plugged in with `deploydb.db.set_driver`, it answers the queries of
+`deploydb.script` from in-memory catalogs and runs deployed scripts by
+registering the objects they create, alter or drop. Login and round-trip
+latencies are simulated with sleeps so pooling and batching can be
+measured without a server.
+
+Example:
+    from tests import fake_odbc
+    from deploydb.db import set_driver
+
+    server = fake_odbc.reset(round_trip_latency=0.002)
+    server.add_database('Sales')
+    server.add_object('Sales', 'P', 'dbo', 'GetOrders', 'CREATE PROCEDURE GetOrders AS SELECT 1')
+    set_driver(fake_odbc)
+"""
+import re
+import time
+import hashlib
+import threading
+from datetime import datetime, timedelta
+from collections import Counter
+
+from deploydb import script as queries
+
+
+class Error(Exception):
+    pass
+
+
+class InterfaceError(Error):
+    pass
+
+
+class DatabaseError(Error):
+    pass
+
+
+class OperationalError(DatabaseError):
+    pass
+
+
+class ProgrammingError(DatabaseError):
+    pass
+
+
+class IntegrityError(DatabaseError):
+    pass
+
+
+class DataError(DatabaseError):
+    pass
+
+
+def _error(cls, state, message):
+    return cls(state, f'[{state}] [deploydb][Fake SQL Server]{message}')
+
+
+SYSTEM_DATABASES = ('master', 'tempdb', 'model', 'msdb')
+# sys.objects type -> repository folder
+FOLDERS = {'U': 'Tables', 'FN': 'Functions', 'IF': 'Functions', 'TF': 'Functions',
+           'V': 'Views', 'P': 'Stored-Procedures', 'TR': 'Triggers'}
+MODULE_TYPES = ('FN', 'IF', 'TF', 'V', 'P', 'TR')
+_EXPORT_ORDER = ('U', 'FN', 'V', 'IF', 'TF', 'P', 'TR')
+
+_CHECKOUT = re.compile(r'^IF @@TRANCOUNT > 0 ROLLBACK; USE \[(.*)\];$')
+_DATABASE = re.compile(r'(?:^|;)DATABASE=\{((?:[^}]|\}\})*)\}', re.I)
+_BUNDLED = re.compile(r"EXEC sp_executesql N'((?:[^']|'')*)';")
+_COMMENTS = re.compile(r'--[^\n]*|/\*.*?\*/', re.S)
+_NAME = r'((?:\[[^\]]+\]|[\w#@$]+)(?:\s*\.\s*(?:\[[^\]]+\]|[\w#@$]+))?)'
+_DDL = re.compile(
+    r'\b(CREATE(?:\s+OR\s+ALTER)?|ALTER|DROP)\s+(TABLE|VIEW|PROCEDURE|PROC|FUNCTION|TRIGGER)\s+'
+    r'(IF\s+EXISTS\s+)?' + _NAME,
+    re.I
+)
+_NOCOUNT = re.compile(r'\bSET\s+NOCOUNT\s+(ON|OFF)\b', re.I)
+_DML = re.compile(r'(?:^|;)\s*(?:INSERT|UPDATE|DELETE|MERGE)\b', re.I | re.M)
+_RAISE = re.compile(r"\b(?:RAISERROR\s*\(\s*|THROW\s+\d+\s*,\s*)N?'((?:[^']|'')*)'", re.I)
+_KINDS = {'TABLE': 'U', 'VIEW': 'V', 'PROC': 'P', 'PROCEDURE': 'P', 'FUNCTION': 'FN', 'TRIGGER': 'TR'}
+
+
+def _split_name(name):
+    parts = [x.strip().strip('[]') for x in re.split(r'\s*\.\s*(?![^\[]*\])', name.strip())]
+    return ('dbo', parts[0]) if len(parts) == 1 else (parts[-2], parts[-1])
+
+
+def _table_columns(sql, start):
+    """ Returns [(name, definition)] of the column list of a `CREATE TABLE` statement. """
+    opened = sql.find('(', start)
+    if opened < 0:
+        return []
+    depth, items, current = 0, [], ''
+    for char in sql[opened + 1:]:
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            if depth == 0:
+                break
+            depth -= 1
+        if char == ',' and depth == 0:
+            items.append(current)
+            current = ''
+        else:
+            current += char
+    items.append(current)
+
+    columns = []
+    for item in (x.strip() for x in items):
+        match = re.match(r'(\[[^\]]+\]|\w+)\s+(.*)$', item, re.S)
+        if not match or match.group(1).upper() in ('CONSTRAINT', 'PRIMARY', 'INDEX', 'UNIQUE', 'FOREIGN', 'CHECK'):
+            continue
+        columns.append((match.group(1).strip('[]'), ' '.join(match.group(2).split())))
+    return columns
+
+
+class Row(tuple):
+    """ Result row, values by index or by column name like `pyodbc.Row`. """
+
+    def __new__(cls, columns, values):
+        row = super().__new__(cls, values)
+        row._columns = columns
+        return row
+
+    def __getattr__(self, name):
+        try:
+            return self[self._columns.index(name)]
+        except ValueError:
+            raise AttributeError(name)
+
+
+class FakeObject:
+    __slots__ = (
+        'object_id', 'type', 'schema_name', 'name', 'definition', 'columns', 'modify_date',
+        'primary_key', 'foreign_keys', 'indexes'
+    )
+
+    def __init__(self, object_id, type_, schema_name, name, definition=None, columns=(), modify_date=None) -> None:
+        self.object_id = object_id
+        self.type = type_
+        self.schema_name = schema_name
+        self.name = name
+        self.definition = definition
+        self.columns = list(columns)
+        self.modify_date = modify_date or datetime.now()
+        self.primary_key = None  # (name, [(column, is_descending)])
+        self.foreign_keys = []  # see add_foreign_key
+        self.indexes = []  # (index_id, name, is_unique, [(column, is_descending, is_included)])
+
+
+class FakeDatabase:
+    """ Catalog and `Deploydb` tables of a database. """
+
+    def __init__(self, name) -> None:
+        self.name = name
+        self.objects = {}  # (schema, name) lower cased -> FakeObject
+        self.deploydb = False  # INIT_DEPLOYDB ran
+        self.schema_version = None  # `deploydb_schema_version` extended property
+        # [RowId, CommitHexSHA, Folder, IsFailed, Error, BlobSHA, FailedBatch,
+        #  CpuTimeMs, ElapsedTimeMs, LogicalReads, RowsAffected, CreatedAt]
+        self.execution_log = []
+        self.changelog = []  # CommitHexSHA
+
+    def get(self, schema_name, name):
+        return self.objects.get((schema_name.lower(), name.lower()))
+
+
+class FakeServer:
+    """Simulated server shared by every fake connection.
+
+    Args:
+        connect_latency (float, optional): seconds a login takes.
+        round_trip_latency (float, optional): seconds every request takes.
+    """
+
+    def __init__(self, *, connect_latency=0.0, round_trip_latency=0.0) -> None:
+        self.connect_latency = connect_latency
+        self.round_trip_latency = round_trip_latency
+        self.databases = {}
+        self.stats = Counter()  # connects, round_trips, checkouts, resets and executed statements by name
+        self._next_id = 1000
+        self._lock = threading.RLock()
+        self._handlers = {
+            queries.DATABASES: self._databases,
+            queries.OBJECTS: self._objects,
+            queries.OBJECTS_BY_ID: self._objects_by_id,
+            queries.OBJECT_LIST: self._object_list,
+            queries.OBJECT_COUNT: self._object_count,
+            queries.TABLES: self._tables,
+            queries.TABLE_COLUMNS: self._table_columns,
+            queries.TABLE_PRIMARY_KEYS: self._table_primary_keys,
+            queries.TABLE_FOREIGN_KEYS: self._table_foreign_keys,
+            queries.TABLE_FOREIGN_KEY_COLUMNS: self._table_foreign_key_columns,
+            queries.TABLE_INDEXES: self._table_indexes,
+            queries.TABLE_INDEX_COLUMNS: self._table_index_columns,
+            queries.GET_OBJECT: self._get_object,
+            queries.CATALOG_DELTA: self._catalog_delta,
+            queries.EXPRESSION_DEPENDENCIES: self._empty(
+                'REFERENCING_SCHEMA', 'REFERENCING_NAME', 'REFERENCED_SCHEMA', 'REFERENCED_NAME'),
+            queries.MODULE_HASHES: self._module_hashes,
+            queries.INIT_DEPLOYDB: self._init_deploydb,
+            queries.DEPLOYDB_STATE: self._deploydb_state,
+            queries.EXECUTION_LOG_INSERT: self._execution_log_insert,
+            queries.CHANGELOG_INSERT: self._changelog_insert,
+            queries.DUPLICATE_CONTROL: self._duplicate_control,
+            queries.EXECUTED_FILES: self._executed_files,
+            queries.DEPLOYED_BLOBS: self._deployed_blobs,
+            queries.LAST_CHANGELOG_SHA: self._last_changelog_sha,
+            queries.COSTLY_SCRIPTS: self._costly_scripts,
+        }
+        self._names = {
+            sql: name for name, sql in vars(queries).items() if isinstance(sql, str) and sql in self._handlers
+        }
+        self.add_database('master')
+
+    def add_database(self, name) -> FakeDatabase:
+        with self._lock:
+            return self.databases.setdefault(name, FakeDatabase(name))
+
+    def add_object(self, db_name, type_, schema_name, name, definition=None, columns=(), modify_date=None):
+        """ Registers an object, `columns` are (name, definition) pairs of a table. """
+        with self._lock:
+            self._next_id += 1
+            obj = FakeObject(self._next_id, type_, schema_name, name, definition, columns, modify_date)
+            self.add_database(db_name).objects[(schema_name.lower(), name.lower())] = obj
+            return obj
+
+    def add_primary_key(self, db_name, table, name, columns):
+        """ Adds a primary key of (column, is_descending) pairs to a table registered by `add_object`. """
+        self.databases[db_name].get(*_split_name(table)).primary_key = (name, list(columns))
+
+    def add_foreign_key(self, db_name, table, name, referenced_name, columns,
+                        is_not_trusted=False, delete_action=0, update_action=0):
+        """ Adds a foreign key of (column, referenced_column) pairs, `referenced_name` is `[schema].[name]`. """
+        with self._lock:
+            self._next_id += 1
+            self.databases[db_name].get(*_split_name(table)).foreign_keys.append(
+                (self._next_id, name, referenced_name, list(columns), is_not_trusted, delete_action, update_action)
+            )
+
+    def add_index(self, db_name, table, name, columns, is_unique=False):
+        """ Adds a nonclustered index of (column, is_descending, is_included) items. """
+        obj = self.databases[db_name].get(*_split_name(table))
+        obj.indexes.append((len(obj.indexes) + 2, name, is_unique, list(columns)))
+
+    def connect(self, str=None, autocommit=False, **kwargs):
+        """ Logs in to the `DATABASE={...}` of the connection string, `master` by default. """
+        if self.connect_latency:
+            time.sleep(self.connect_latency)
+        match = _DATABASE.search(str or '')
+        db_name = match.group(1).replace('}}', '}') if match else 'master'
+        with self._lock:
+            self.stats['connects'] += 1
+            if db_name not in self.databases:
+                raise _error(
+                    InterfaceError, '42000',
+                    f'Cannot open database "{db_name}" requested by the login. The login failed.'
+                )
+        connection = Connection(self, autocommit)
+        connection.db_name = db_name
+        return connection
+
+    def _round_trip(self):
+        if self.round_trip_latency:
+            time.sleep(self.round_trip_latency)
+        with self._lock:
+            self.stats['round_trips'] += 1
+
+    def execute(self, connection, sql, params):
+        """ Returns the result sets, [(columns, rows)], of a request; (None, count) for a row count. """
+        with self._lock:
+            handler = self._handlers.get(sql)
+            if handler is not None:
+                self.stats[self._names[sql]] += 1
+                result = handler(self._database(connection), params)
+                if sql == queries.EXECUTION_LOG_INSERT and not connection.autocommit:
+                    connection.undo.append(self._database(connection).execution_log)
+                return result
+
+            checkout = _CHECKOUT.match(sql)
+            if checkout:
+                if checkout.group(1) not in self.databases:
+                    raise _error(ProgrammingError, '42000', f"Database '{checkout.group(1)}' does not exist.")
+                self.stats['checkouts'] += 1
+                connection.db_name = checkout.group(1)
+                return []
+
+            if sql == queries.RESET_SESSION:
+                self.stats['resets'] += 1
+                connection.nocount = False
+                return []
+
+            if sql.strip().upper() == 'SELECT NULL':
+                return [(('',), [(None,)])]
+
+            if sql == queries.SESSION_STATS:
+                self.stats['SESSION_STATS'] += 1
+                session = connection.session
+                columns = ('CPU_TIME', 'LOGICAL_READS', 'NOW')
+                row = (session['cpu_time'], session['logical_reads'], datetime.now())
+                return [(columns, [row])]
+
+            db = self._database(connection)
+            if '@deploydb_results' in sql:
+                self.stats['bundles'] += 1
+                results = []
+                for seq, literal in enumerate(_BUNDLED.findall(sql), start=1):
+                    try:
+                        self._run_script(db, literal.replace("''", "'"), connection)
+                        results.append((seq, False, None))
+                    except ProgrammingError as ex:
+                        results.append((seq, True, ex.args[1]))
+                return [(('Seq', 'IsFailed', 'Error'), results)]
+
+            return self._run_script(db, sql, connection)
+
+    def _database(self, connection):
+        return self.databases[connection.db_name]
+
+    def _run_script(self, db, sql, connection):
+        """Simulates a deployed batch: raised errors and created, altered or dropped objects.
+
+        The session is charged a cost growing with the length of the batch.
+        Every DML statement affects one row, returns the row count results
+        unless `SET NOCOUNT ON` is in effect on the connection.
+        """
+        self.stats['scripts'] += 1
+        connection.session['cpu_time'] += len(sql) // 100 + 1
+        connection.session['logical_reads'] += len(sql)
+        code = _COMMENTS.sub(' ', sql)
+        error = _RAISE.search(code)
+        if error:
+            raise _error(ProgrammingError, '42000', error.group(1).replace("''", "'"))
+        for match in _NOCOUNT.finditer(code):
+            connection.nocount = match.group(1).upper() == 'ON'
+        row_counts = [] if connection.nocount else [(None, 1) for _ in _DML.finditer(code)]
+
+        for match in _DDL.finditer(code):
+            action = match.group(1).split()[0].upper()
+            or_alter = 'ALTER' in match.group(1).upper() and action == 'CREATE'
+            kind = _KINDS[match.group(2).upper()]
+            schema_name, name = _split_name(match.group(4))
+            if name.startswith('#'):
+                continue
+            existing = db.get(schema_name, name)
+
+            if action == 'DROP':
+                if existing is None and not match.group(3):
+                    raise _error(ProgrammingError, '42S02', f"Cannot drop '{name}', because it does not exist.")
+                db.objects.pop((schema_name.lower(), name.lower()), None)
+                continue
+
+            if action == 'CREATE' and existing is not None and not or_alter:
+                raise _error(ProgrammingError, '42S01', f"There is already an object named '{name}' in the database.")
+            if action == 'ALTER' and existing is None:
+                raise _error(ProgrammingError, '42S02', f"Invalid object name '{name}'.")
+
+            if kind == 'FN' and re.search(r'\bRETURNS\s+TABLE\b', code, re.I):
+                kind = 'IF'
+            elif kind == 'FN' and re.search(r'\bRETURNS\s+@\w+\s+TABLE\b', code, re.I):
+                kind = 'TF'
+            if kind == 'U':
+                self.add_object(db.name, kind, schema_name, name, columns=_table_columns(code, match.end()))
+            else:
+                obj = existing or self.add_object(db.name, kind, schema_name, name)
+                obj.definition = sql
+                obj.modify_date = datetime.now()
+                # The rest of the batch is the body of the module.
+                break
+        return row_counts
+
+    def _empty(self, *columns):
+        return lambda db, params: [(columns, [])]
+
+    def _require_deploydb(self, db):
+        if not db.deploydb:
+            raise _error(ProgrammingError, '42S02', "Invalid object name 'Deploydb.ExecutionLog'.")
+
+    def _databases(self, db, params):
+        names = sorted(x for x in self.databases if x not in SYSTEM_DATABASES)
+        return [(('DB_NAME',), [(x,) for x in names])]
+
+    def _sorted_objects(self, db):
+        return sorted(
+            (x for x in db.objects.values() if x.type in FOLDERS),
+            key=lambda x: (_EXPORT_ORDER.index(x.type), x.schema_name)
+        )
+
+    def _objects(self, db, params, ids=None):
+        columns = ('SUB_FOLDER', 'OBJECT_ID', 'SCHEMA_NAME', 'OBJECT_NAME', 'MODIFY_DATE', 'SQL')
+        rows = [
+            (FOLDERS[x.type], x.object_id, x.schema_name, x.name, x.modify_date, x.definition)
+            for x in self._sorted_objects(db) if ids is None or x.object_id in ids
+        ]
+        return [(columns, rows)]
+
+    def _objects_by_id(self, db, params):
+        return self._objects(db, params, ids={x for x in params if x is not None})
+
+    def _object_list(self, db, params):
+        columns = ('SUB_FOLDER', 'OBJECT_ID', 'SCHEMA_NAME', 'OBJECT_NAME', 'MODIFY_DATE')
+        rows = [(FOLDERS[x.type], x.object_id, x.schema_name, x.name, x.modify_date) for x in self._sorted_objects(db)]
+        return [(columns, rows)]
+
+    def _object_count(self, db, params):
+        return [(('TOTAL',), [(len(self._sorted_objects(db)),)])]
+
+    def _tables(self, db, params):
+        rows = [(x.object_id, f'[{x.schema_name}].[{x.name}]') for x in db.objects.values() if x.type == 'U']
+        return [(('OBJECT_ID', 'TABLE_NAME'), rows)]
+
+    def _table_columns(self, db, params):
+        rows = [
+            (x.object_id, f'\t, [{name}] {definition}\r')
+            for x in sorted(db.objects.values(), key=lambda x: x.object_id) if x.type == 'U'
+            for name, definition in x.columns
+        ]
+        return [(('OBJECT_ID', 'LINE'), rows)]
+
+    def _user_tables(self, db):
+        return sorted((x for x in db.objects.values() if x.type == 'U'), key=lambda x: x.object_id)
+
+    def _table_primary_keys(self, db, params):
+        rows = [
+            (x.object_id, x.primary_key[0], f', [{name}] ' + ('DESC' if desc else 'ASC'))
+            for x in self._user_tables(db) if x.primary_key
+            for name, desc in x.primary_key[1]
+        ]
+        return [(('OBJECT_ID', 'CONSTRAINT_NAME', 'COLUMN_SQL'), rows)]
+
+    def _table_foreign_keys(self, db, params):
+        rows = [
+            (x.object_id, fk_id, name, not_trusted, referenced, delete_action, update_action)
+            for x in self._user_tables(db)
+            for fk_id, name, referenced, _, not_trusted, delete_action, update_action in x.foreign_keys
+        ]
+        columns = (
+            'OBJECT_ID', 'FK_ID', 'FK_NAME', 'IS_NOT_TRUSTED', 'REFERENCED_NAME', 'DELETE_ACTION', 'UPDATE_ACTION'
+        )
+        return [(columns, rows)]
+
+    def _table_foreign_key_columns(self, db, params):
+        keys = sorted(fk for x in self._user_tables(db) for fk in x.foreign_keys)
+        rows = [(fk[0], name, referenced) for fk in keys for name, referenced in fk[3]]
+        return [(('FK_ID', 'CNAME', 'RCNAME'), rows)]
+
+    def _table_indexes(self, db, params):
+        rows = [(x.object_id, *index[:3]) for x in self._user_tables(db) for index in x.indexes]
+        return [(('OBJECT_ID', 'INDEX_ID', 'INDEX_NAME', 'IS_UNIQUE'), rows)]
+
+    def _table_index_columns(self, db, params):
+        rows = [
+            (x.object_id, index[0], name, desc, included)
+            for x in self._user_tables(db)
+            for index in x.indexes
+            for name, desc, included in index[3]
+        ]
+        return [(('OBJECT_ID', 'INDEX_ID', 'COLUMN_NAME', 'IS_DESCENDING_KEY', 'IS_INCLUDED_COLUMN'), rows)]
+
+    def _get_object(self, db, params):
+        folder, object_name = params
+        types = {'Tables': 'U', 'Functions': 'FN', 'Views': 'V', 'Stored-Procedures': 'P', 'Triggers': 'TR'}
+        obj = db.get(*_split_name(object_name))
+        rows = [(obj.object_id, obj.name, obj.type)] if obj and obj.type == types.get(folder) else []
+        return [(('object_id', 'name', 'type'), rows)]
+
+    def _catalog_delta(self, db, params):
+        since = params[0] - timedelta(seconds=1)
+        rows = [(x.schema_name, x.name, x.type, x.modify_date) for x in db.objects.values() if x.modify_date >= since]
+        return [
+            (('TOTAL',), [(len(db.objects),)]),
+            (('SCHEMA_NAME', 'OBJECT_NAME', 'TYPE', 'MODIFY_DATE'), rows),
+        ]
+
+    def _module_hashes(self, db, params):
+        rows = []
+        for x in db.objects.values():
+            if x.type in MODULE_TYPES:
+                text = (x.definition or '').replace('\r\n', '\n').replace('\r', '\n')
+                rows.append((FOLDERS[x.type], x.schema_name, x.name, hashlib.sha256(text.encode('utf-16-le')).digest()))
+        return [(('SUB_FOLDER', 'SCHEMA_NAME', 'OBJECT_NAME', 'DEFINITION_HASH'), rows)]
+
+    def _init_deploydb(self, db, params):
+        db.deploydb = True
+        db.schema_version = params[0]
+        return []
+
+    def _deploydb_state(self, db, params):
+        last_sha = db.changelog[-1] if db.schema_version is not None and db.changelog else None
+        return [(('SCHEMA_VERSION', 'LAST_SHA'), [(db.schema_version, last_sha)])]
+
+    def _execution_log_insert(self, db, params):
+        self._require_deploydb(db)
+        if len(params[1] or '') > 1000:
+            raise _error(DataError, '22001', 'String or binary data would be truncated.')
+        row = list(params) + [None] * (10 - len(params))
+        db.execution_log.append([len(db.execution_log) + 1] + row + [datetime.now()])
+        return []
+
+    def _changelog_insert(self, db, params):
+        self._require_deploydb(db)
+        if params[0] in db.changelog:
+            raise _error(IntegrityError, '23000', 'Violation of PRIMARY KEY constraint PK_Deploydb_ChangeLog.')
+        db.changelog.append(params[0])
+        return []
+
+    def _duplicate_control(self, db, params):
+        self._require_deploydb(db)
+        rows = [(1,) for x in db.execution_log if x[1] == params[0] and x[2] == params[1]]
+        return [(('',), rows)]
+
+    def _executed_files(self, db, params):
+        self._require_deploydb(db)
+        folders = dict.fromkeys(x[2] for x in db.execution_log if x[1] == params[0])
+        return [(('Folder',), [(x,) for x in folders])]
+
+    def _deployed_blobs(self, db, params):
+        self._require_deploydb(db)
+        paths = {x for x in params if x is not None}
+        last = {}
+        for x in db.execution_log:
+            if not x[3] and x[5] is not None and x[2] in paths:
+                last[x[2]] = x[5]
+        return [(('Folder', 'BlobSHA'), list(last.items()))]
+
+    def _costly_scripts(self, db, params):
+        self._require_deploydb(db)
+        top, by = params
+        column = {'cpu': 7, 'reads': 9, 'rows': 10}.get(by, 8)
+        measured = [x for x in db.execution_log if x[8] is not None]
+        measured.sort(key=lambda x: (x[column] if x[column] is not None else -1, x[0]), reverse=True)
+        columns = (
+            'CommitHexSHA', 'Folder', 'IsFailed', 'CpuTimeMs',
+            'ElapsedTimeMs', 'LogicalReads', 'RowsAffected', 'CreatedAt'
+        )
+        return [(columns, [(x[1], x[2], x[3], x[7], x[8], x[9], x[10], x[11]) for x in measured[:top]])]
+
+    def _last_changelog_sha(self, db, params):
+        self._require_deploydb(db)
+        return [(('CommitHexSHA',), [(db.changelog[-1],)] if db.changelog else [])]
+
+
+class Cursor:
+    def __init__(self, connection) -> None:
+        self.connection = connection
+        self.fast_executemany = False
+        self.description = None
+        self.rowcount = -1
+        self._sets = []
+        self._rows = []
+
+    def _check(self):
+        if self.connection.closed:
+            raise _error(ProgrammingError, '08003', 'Attempt to use a closed connection.')
+
+    def _params(self, params):
+        if len(params) == 1 and isinstance(params[0], (list, tuple)):
+            return tuple(params[0])
+        return params
+
+    def execute(self, sql, *params):
+        self._check()
+        server = self.connection.server
+        server._round_trip()
+        self._sets = server.execute(self.connection, sql, self._params(params))
+        self._next()
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self._check()
+        server = self.connection.server
+        if self.fast_executemany:
+            server._round_trip()
+        for params in seq_of_params:
+            if not self.fast_executemany:
+                server._round_trip()
+            server.execute(self.connection, sql, tuple(params))
+        self._sets = []
+        self._next()
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def _next(self):
+        if not self._sets:
+            self.description = None
+            self._rows = []
+            self.rowcount = -1
+            return False
+        columns, rows = self._sets.pop(0)
+        if columns is None:  # row count of a statement
+            self.description = None
+            self._rows = []
+            self.rowcount = rows
+            return True
+        self.description = tuple((x, None, None, None, None, None, True) for x in columns)
+        self._rows = [Row(columns, x) for x in rows]
+        self.rowcount = len(self._rows)
+        return True
+
+    def nextset(self):
+        return self._next()
+
+    def _fetch(self, size):
+        if self.description is None:
+            raise _error(ProgrammingError, '24000', 'No results. Previous SQL was not a query.')
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    def fetchone(self):
+        rows = self._fetch(1)
+        return rows[0] if rows else None
+
+    def fetchmany(self, size=1):
+        return self._fetch(size)
+
+    def fetchall(self):
+        return self._fetch(len(self._rows))
+
+    def close(self):
+        self._sets = []
+        self._rows = []
+
+
+class Connection:
+    def __init__(self, server, autocommit=False) -> None:
+        self.server = server
+        self.autocommit = autocommit
+        self.timeout = 0
+        self.closed = False
+        self.db_name = 'master'
+        self.session = Counter()  # cpu_time, logical_reads of `sys.dm_exec_sessions`
+        self.nocount = False
+        self.undo = []  # execution logs of the inserts of the transaction, see `rollback`
+
+    def cursor(self):
+        if self.closed:
+            raise _error(ProgrammingError, '08003', 'Attempt to use a closed connection.')
+        return Cursor(self)
+
+    def execute(self, sql, *params):
+        return self.cursor().execute(sql, *params)
+
+    def commit(self):
+        self.server._round_trip()
+        self.undo = []
+
+    def rollback(self):
+        """ Takes back the execution log rows inserted since the last commit, the only transactional data. """
+        self.server._round_trip()
+        while self.undo:
+            self.undo.pop().pop()
+
+    def close(self):
+        self.closed = True
+
+
+server = FakeServer()
+
+
+def reset(**kwargs) -> FakeServer:
+    """ Replaces the server of the module with an empty one, see `FakeServer`. """
+    global server
+    server = FakeServer(**kwargs)
+    return server
+
+
+def connect(str=None, autocommit=False, **kwargs):
+    return server.connect(str, autocommit, **kwargs)
@@ -2,7 +2,39 @@
 
 """Tests for `deploydb` package."""
 
+import io
+import os
+import hmac
+import json
+import hashlib
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+import urllib.error
+import urllib.request
+
+from git import Actor, GitCommandError, Repo
+
+from deploydb import Listener, RepoGenerator
+from deploydb.db import ConnectionPool, Database, set_driver
+from deploydb.batch import iter_batches
+from deploydb.execution_log import ExecutionLogWriter
+from deploydb.script import INIT_DEPLOYDB, IN_LIST_SIZE, SCHEMA_VERSION
+from deploydb.catalog import CatalogSnapshot, split_object_name
+from deploydb.diff import ChangeSet
+from deploydb.export import GitTarget
+from deploydb.metrics import Metrics
+from deploydb.model import ChangedFile, DbCreds
+from deploydb.scheduler import DependencyGraph
+from deploydb.table_scripter import TableScripter
+from deploydb.webhook import WebhookServer, parse_push, verify_signature
+
+from . import fake_odbc
+
+
+ACTOR = Actor('deploydb', 'deploydb@localhost')
 
 
 class TestDeploydb(unittest.TestCase):
@@ -10,9 +42,1012 @@ class TestDeploydb(unittest.TestCase):
 
     def setUp(self):
         """Set up test fixtures, if any."""
+        self.server = fake_odbc.reset()
+        self.server.add_database('Sales')
+        set_driver(fake_odbc)
+        self.tmp = tempfile.mkdtemp()
+        self.config = {
+            'local_path': os.path.join(self.tmp, 'local'),
+            'https_url': os.path.join(self.tmp, 'remote'),
+            'target_branch': 'main',
+            'db_creds': {
+                'driver': 'fake', 'server': 'fake', 'user': 'sa', 'passw': 'sa',
+                'default_db': 'master', 'timeout': 5,
+            },
+        }
 
     def tearDown(self):
         """Tear down test fixtures, if any."""
+        set_driver(None)
+        shutil.rmtree(self.tmp)
+
+    def _commit(self, repo, files, message='change'):
+        for path, text in files.items():
+            full_path = os.path.join(repo.working_tree_dir, path)
+            if text is None:
+                repo.index.remove([path], working_tree=True)
+                continue
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            with open(full_path, mode='w', encoding='utf-8') as f:
+                f.write(text)
+            repo.index.add([path])
+        return repo.index.commit(message, author=ACTOR, committer=ACTOR).hexsha
+
+    def _remote(self, **kwargs):
+        """ Upstream repository with an initial commit, already deployed. """
+        repo = Repo.init(self.config['https_url'], initial_branch='main')
+        sha = self._commit(repo, {'README.md': '# Databases'}, 'initial')
+        listener = Listener(self.config, changelog_path=os.path.join(self.tmp, 'changelog.csv'), **kwargs)
+        self.server.databases['master'].changelog.append(sha)
+        return repo, listener
+
+    def test_repo_generator_exports_objects(self):
+        self.server.add_object('Sales', 'U', 'dbo', 'Orders', columns=[('Id', 'int NOT NULL')])
+        self.server.add_object('Sales', 'P', 'sales', 'GetOrders', 'CREATE PROCEDURE sales.GetOrders\r\nAS SELECT 1')
+        export_path = os.path.join(self.tmp, 'export')
+
+        RepoGenerator(config=self.config, export_path=export_path).run()
+
+        root = os.path.join(export_path, 'Databases', 'Sales')
+        with open(os.path.join(root, 'Tables', 'Orders.sql'), encoding='utf-8') as f:
+            self.assertEqual(f.read(), 'CREATE TABLE [dbo].[Orders]\n(\n\t  [Id] int NOT NULL\n)\n')
+        with open(os.path.join(root, 'Stored-Procedures', '[sales].[GetOrders].sql'), encoding='utf-8') as f:
+            self.assertEqual(f.read(), 'CREATE PROCEDURE sales.GetOrders\nAS SELECT 1\n')
+        self.assertTrue(os.path.exists(os.path.join(root, 'Views', 'Views_README.md')))
+        with self.assertRaises(ValueError):
+            RepoGenerator(config=self.config, export_path=export_path)
+
+    def test_table_scripter_keys_and_indexes(self):
+        server = self.server
+        server.add_object('Sales', 'U', 'dbo', 'Customers', columns=[
+            ('Id', 'int NOT NULL IDENTITY(1,1)'), ('Region', 'char(2) NOT NULL'),
+        ])
+        orders = server.add_object('Sales', 'U', 'sales', 'Orders', columns=[
+            ('Id', 'int NOT NULL'),
+            ('CustomerId', 'int NOT NULL'),
+            ('CustomerRegion', 'char(2) NOT NULL'),
+            ('ParentId', 'int NULL'),
+            ('CreatedAt', 'datetime2(7) NOT NULL DEFAULT(getdate())'),
+            ('Total', 'decimal(18,2) NULL'),
+        ])
+        server.add_primary_key('Sales', 'dbo.Customers', 'PK_Customers', [('Id', False), ('Region', False)])
+        server.add_primary_key('Sales', 'sales.Orders', 'PK_Orders', [('Id', False), ('CreatedAt', True)])
+        server.add_foreign_key(
+            'Sales', 'sales.Orders', 'FK_Orders_Customers', '[dbo].[Customers]',
+            [('CustomerId', 'Id'), ('CustomerRegion', 'Region')], delete_action=1
+        )
+        server.add_foreign_key(
+            'Sales', 'sales.Orders', 'FK_Orders_Parent', '[sales].[Orders]', [('ParentId', 'Id')],
+            is_not_trusted=True, update_action=2
+        )
+        server.add_index('Sales', 'sales.Orders', 'IX_Orders_Customer', [
+            ('CustomerId', False, False), ('CreatedAt', True, False), ('Total', False, True), ('ParentId', False, True)
+        ])
+        server.add_index('Sales', 'sales.Orders', 'UQ_Orders_Parent', [('ParentId', False, False)], is_unique=True)
+
+        with Database(DbCreds(**self.config['db_creds'])).connect('Sales') as db:
+            scripter = TableScripter(db)
+        script = scripter.script(orders.object_id)
+
+        # What CREATE_TABLE returns for the table.
+        self.assertEqual(script, (
+            'CREATE TABLE [sales].[Orders]\r'
+            '(\r'
+            '\t  [Id] int NOT NULL\r'
+            '\t, [CustomerId] int NOT NULL\r'
+            '\t, [CustomerRegion] char(2) NOT NULL\r'
+            '\t, [ParentId] int NULL\r'
+            '\t, [CreatedAt] datetime2(7) NOT NULL DEFAULT(getdate())\r'
+            '\t, [Total] decimal(18,2) NULL\r'
+            '\t, CONSTRAINT [PK_Orders] PRIMARY KEY ([Id] ASC, [CreatedAt] DESC)\r'
+            ')\r'
+            '\r'
+            'ALTER TABLE [sales].[Orders] WITH CHECK ADD CONSTRAINT [FK_Orders_Customers]'
+            ' FOREIGN KEY([CustomerId], [CustomerRegion]) REFERENCES [dbo].[Customers] ([Id], [Region])'
+            ' ON DELETE CASCADE\r'
+            'ALTER TABLE [sales].[Orders] CHECK CONSTRAINT [FK_Orders_Customers]\r'
+            '\r'
+            'ALTER TABLE [sales].[Orders] WITH NOCHECK ADD CONSTRAINT [FK_Orders_Parent]'
+            ' FOREIGN KEY([ParentId]) REFERENCES [sales].[Orders] ([Id]) ON UPDATE SET NULL\r'
+            'ALTER TABLE [sales].[Orders] CHECK CONSTRAINT [FK_Orders_Parent]\r'
+            '\r'
+            'CREATE NONCLUSTERED INDEX [IX_Orders_Customer] ON [sales].[Orders] ([CustomerId] ASC, [CreatedAt] DESC)\r'
+            'INCLUDE ([Total], [ParentId])\r'
+            '\r'
+            'CREATE UNIQUE NONCLUSTERED INDEX [UQ_Orders_Parent] ON [sales].[Orders] ([ParentId] ASC)\r'
+        ))
+        customers = scripter.script(server.databases['Sales'].get('dbo', 'Customers').object_id)
+        self.assertEqual(customers, (
+            'CREATE TABLE [dbo].[Customers]\r'
+            '(\r'
+            '\t  [Id] int NOT NULL IDENTITY(1,1)\r'
+            '\t, [Region] char(2) NOT NULL\r'
+            '\t, CONSTRAINT [PK_Customers] PRIMARY KEY ([Id] ASC, [Region] ASC)\r'
+            ')\r'
+        ))
+        # A fixed number of catalog queries, whatever the number of tables.
+        self.assertEqual(server.stats['round_trips'], 7)
+
+    def test_repo_generator_incremental(self):
+        changed = self.server.add_object('Sales', 'V', 'dbo', 'Changed', 'CREATE VIEW Changed AS SELECT 1')
+        self.server.add_object('Sales', 'V', 'dbo', 'Dropped', 'CREATE VIEW Dropped AS SELECT 1')
+        export_path = os.path.join(self.tmp, 'export')
+        RepoGenerator(config=self.config, export_path=export_path, incremental=True).run()
+
+        changed.definition = 'CREATE VIEW Changed AS SELECT 2'
+        changed.modify_date = changed.modify_date.replace(year=changed.modify_date.year + 1)
+        del self.server.databases['Sales'].objects[('dbo', 'dropped')]
+        self.server.stats.clear()
+        RepoGenerator(config=self.config, export_path=export_path, incremental=True).run()
+
+        views = os.path.join(export_path, 'Databases', 'Sales', 'Views')
+        with open(os.path.join(views, 'Changed.sql'), encoding='utf-8') as f:
+            self.assertEqual(f.read(), 'CREATE VIEW Changed AS SELECT 2\n')
+        self.assertFalse(os.path.exists(os.path.join(views, 'Dropped.sql')))
+        self.assertEqual(self.server.stats['OBJECTS'], 0)
+        self.assertEqual(self.server.stats['OBJECTS_BY_ID'], 1)
+
+    def test_repo_generator_incremental_in_chunks(self):
+        views = [
+            self.server.add_object('Sales', 'V', 'dbo', f'View{i}', f'CREATE VIEW View{i} AS SELECT {i} AS Id')
+            for i in range(IN_LIST_SIZE + 1)
+        ]
+        export_path = os.path.join(self.tmp, 'export')
+        RepoGenerator(config=self.config, export_path=export_path, incremental=True).run()
+
+        for x in views:
+            x.definition = x.definition.replace('AS Id', 'AS Key')
+            x.modify_date = x.modify_date.replace(year=x.modify_date.year + 1)
+        RepoGenerator(config=self.config, export_path=export_path, incremental=True, fetch_size=200).run()
+
+        self.assertEqual(self.server.stats['OBJECTS_BY_ID'], 2)
+        with open(os.path.join(export_path, 'Databases', 'Sales', 'Views', f'View{IN_LIST_SIZE}.sql')) as f:
+            self.assertEqual(f.read(), f'CREATE VIEW View{IN_LIST_SIZE} AS SELECT {IN_LIST_SIZE} AS Key\n')
+
+    def test_git_target(self):
+        path = os.path.join(self.tmp, 'export')
+        target = GitTarget(path, branch='export', message='First export')
+        target.write(os.path.join('Databases', 'Sales', 'Views', 'Totals.sql'), 'CREATE VIEW Totals AS SELECT 1\n')
+        target.write(os.path.join('Databases', 'Sales', 'Views', '"Quoted".sql'), 'CREATE VIEW "Quoted" AS SELECT 1\n')
+        target.write(os.path.join('Databases', 'Sales', 'Views', 'Old.sql'), 'CREATE VIEW Old AS SELECT 1\n')
+        target.close()
+
+        repo = Repo(path)
+        first = repo.commit('refs/heads/export')
+        self.assertEqual((first.message, target.commits), ('First export', 1))
+        self.assertEqual(sorted(x.path for x in first.tree.traverse() if x.type == 'blob'), [
+            'Databases/Sales/Views/"Quoted".sql', 'Databases/Sales/Views/Old.sql', 'Databases/Sales/Views/Totals.sql'
+        ])
+        self.assertFalse(os.path.exists(os.path.join(path, 'Databases')))  # the working tree is not touched
+
+        target = GitTarget(path, branch='export', replace=False, checkout=True)
+        target.write('Databases/Sales/Views/Totals.sql', 'CREATE VIEW Totals AS SELECT 2\n')
+        target.remove('Databases/Sales/Views/Old.sql')
+        target.close()
+
+        second = repo.commit('refs/heads/export')
+        self.assertEqual(second.parents, (first,))
+        self.assertEqual(sorted(x.path for x in second.tree.traverse() if x.type == 'blob'), [
+            'Databases/Sales/Views/"Quoted".sql', 'Databases/Sales/Views/Totals.sql'
+        ])
+        with open(os.path.join(path, 'Databases', 'Sales', 'Views', 'Totals.sql'), encoding='utf-8') as f:
+            self.assertEqual(f.read(), 'CREATE VIEW Totals AS SELECT 2\n')
+
+        target = GitTarget(path, branch='export', replace=False)
+        target.close()
+        self.assertEqual((target.commits, repo.commit('refs/heads/export')), (0, second))
+
+    def test_repo_generator_git_branch(self):
+        changed = self.server.add_object('Sales', 'V', 'dbo', 'Changed', 'CREATE VIEW Changed AS SELECT 1')
+        self.server.add_object('Sales', 'V', 'dbo', 'Dropped', 'CREATE VIEW Dropped AS SELECT 1')
+        export_path = os.path.join(self.tmp, 'export')
+        RepoGenerator(config=self.config, export_path=export_path, git_branch='export', incremental=True).run()
+
+        changed.definition = 'CREATE VIEW Changed AS SELECT 2'
+        changed.modify_date = changed.modify_date.replace(year=changed.modify_date.year + 1)
+        del self.server.databases['Sales'].objects[('dbo', 'dropped')]
+        RepoGenerator(config=self.config, export_path=export_path, git_branch='export', incremental=True).run()
+
+        head = Repo(export_path).commit('refs/heads/export')
+        self.assertEqual(len(head.parents), 1)
+        diff = {x.b_path or x.a_path: x.change_type for x in head.parents[0].diff(head)}
+        self.assertEqual(diff, {'Databases/Sales/Views/Changed.sql': 'M', 'Databases/Sales/Views/Dropped.sql': 'D'})
+        blob = head.tree / 'Databases/Sales/Views/Changed.sql'
+        self.assertEqual(blob.data_stream.read(), b'CREATE VIEW Changed AS SELECT 2\n')
+        self.assertTrue(any(x.path.endswith('Views_README.md') for x in head.tree.traverse()))
+
+    def test_repo_generator_git_branch_failed_export(self):
+        export_path = os.path.join(self.tmp, 'export')
+        generator = RepoGenerator(
+            config=self.config, export_path=export_path, git_branch='export', includes=['Missing']
+        )
+        # `git fast-import` starts with the first file.
+        self.assertIsNone(generator._target._process)
+
+        with self.assertRaises(ValueError):
+            generator.run()
+
+        # The process is stopped and the branch is not written.
+        self.assertIsNotNone(generator._target._process.returncode)
+        self.assertEqual(generator._target.commits, 0)
+        with self.assertRaises(GitCommandError):
+            Repo(export_path).git.rev_parse('--verify', 'refs/heads/export')
+
+    def test_listener_deploys_changes(self):
+        remote, listener = self._remote()
+        sha = self._commit(remote, {
+            'Databases/Sales/Tables/Orders.sql': 'CREATE TABLE Orders (Id INT NOT NULL)\nGO\n',
+            'Databases/Sales/Stored-Procedures/GetOrders.sql': 'CREATE PROCEDURE GetOrders AS SELECT Id FROM Orders',
+            'Databases/Sales/DMLs/Broken.sql': "RAISERROR('broken script', 16, 1)",
+        })
+
+        commit_id, is_failed, failures = listener.handle_changes()
+
+        self.assertEqual(commit_id, sha)
+        self.assertTrue(is_failed)
+        self.assertEqual([x[0] for x in failures], ['Databases/Sales/DMLs/Broken.sql'])
+        self.assertIn('broken script', failures[0][1])
+        sales = self.server.databases['Sales']
+        self.assertIsNotNone(sales.get('dbo', 'Orders'))
+        self.assertIsNotNone(sales.get('dbo', 'GetOrders'))
+        log = {x[2]: x[3] for x in self.server.databases['master'].execution_log}
+        self.assertEqual(log, {
+            'Databases/Sales/Tables/Orders.sql': False,
+            'Databases/Sales/Stored-Procedures/GetOrders.sql': False,
+            'Databases/Sales/DMLs/Broken.sql': True,
+        })
+        self.assertEqual(self.server.databases['master'].changelog[-1], sha)
+
+        # Nothing changed, nothing runs.
+        self.server.stats.clear()
+        self.assertIsNone(listener.handle_changes())
+        self.assertEqual(self.server.stats['scripts'], 0)
+
+    def test_listener_startup(self):
+        remote, listener = self._remote()
+        self._commit(remote, {'Databases/Sales/Views/Totals.sql': 'CREATE VIEW Totals AS SELECT 1 AS Total'})
+        listener.handle_changes()
+
+        # A new process finding no changes: one login, one query.
+        set_driver(fake_odbc)
+        self.server.stats.clear()
+        listener = Listener(self.config, changelog_path=os.path.join(self.tmp, 'changelog.csv'))
+        self.assertEqual(self.server.stats['connects'], 0)
+        self.assertIsNone(listener.handle_changes())
+        self.assertEqual(self.server.stats['connects'], 1)
+        self.assertEqual(self.server.stats['round_trips'], 1)
+        self.assertEqual(self.server.stats['INIT_DEPLOYDB'], 0)
+
+        # Credentials are validated by the first connection.
+        self.config['db_creds']['default_db'] = 'Missing'
+        listener = Listener(self.config, changelog_path=os.path.join(self.tmp, 'changelog.csv'))
+        with self.assertRaises(ValueError):
+            listener.handle_changes()
+
+    def test_listener_parallel_databases(self):
+        self.server.add_database('Hr')
+        remote, listener = self._remote(max_workers=2)
+        self._commit(remote, {
+            'Databases/Sales/Views/Totals.sql': 'CREATE VIEW Totals AS SELECT 1 AS Total',
+            'Databases/Sales/DMLs/Broken.sql': "RAISERROR('sales failed', 16, 1)",
+            'Databases/Hr/Tables/People.sql': 'CREATE TABLE People (Id INT)',
+            'Databases/Hr/DMLs/Broken.sql': "RAISERROR('hr failed', 16, 1)",
+            'Databases/Missing/Views/Report.sql': 'CREATE VIEW Report AS SELECT 1 AS Id',
+            'Databases/Missing/DMLs/Seed.sql': 'INSERT INTO Report VALUES (1)',
+        })
+
+        _, is_failed, failures = listener.handle_changes()
+
+        self.assertTrue(is_failed)
+        # Merged in the order the databases first appear in the execution sequence,
+        # a database failing as a whole fails each of its scripts.
+        self.assertEqual(
+            [x[0] for x in failures],
+            [
+                'Databases/Hr/DMLs/Broken.sql',
+                'Databases/Missing/Views/Report.sql',
+                'Databases/Missing/DMLs/Seed.sql',
+                'Databases/Sales/DMLs/Broken.sql',
+            ]
+        )
+        self.assertIn('Cannot open database', failures[2][1])
+        self.assertIsNotNone(self.server.databases['Hr'].get('dbo', 'People'))
+        self.assertIsNotNone(self.server.databases['Sales'].get('dbo', 'Totals'))
+        self.assertEqual(len(self.server.databases['master'].execution_log), 4)
+
+    def _wait_for(self, condition, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail('condition not met in time')
+            time.sleep(0.02)
+
+    def test_listener_watch(self):
+        remote, listener = self._remote()
+        runs = []
+        handle_changes = listener.handle_changes
+        listener.handle_changes = lambda executable=True: runs.append(handle_changes(executable))
+        stop_event = threading.Event()
+        thread = threading.Thread(
+            target=listener.watch, kwargs={'interval': 0.05, 'jitter': 0, 'stop_event': stop_event}
+        )
+        thread.start()
+        try:
+            time.sleep(0.3)
+            self.assertEqual(runs, [])  # the branch did not move
+            sha = self._commit(remote, {'Databases/Sales/Views/Totals.sql': 'CREATE VIEW Totals AS SELECT 1 AS Total'})
+            self._wait_for(lambda: self.server.databases['master'].changelog[-1] == sha and runs)
+            time.sleep(0.3)
+        finally:
+            stop_event.set()
+            thread.join()
+
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(runs[0][0], sha)
+        self.assertIsNotNone(self.server.databases['Sales'].get('dbo', 'Totals'))
+
+    def _post(self, port, payload, secret=None):
+        body = json.dumps(payload).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        if secret:
+            headers['X-Hub-Signature-256'] = 'sha256=' + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+        request = urllib.request.Request(f'http://127.0.0.1:{port}/', data=body, headers=headers)
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as ex:
+            return ex.code, json.loads(ex.read())
+
+    def test_webhook_server(self):
+        remote, listener = self._remote()
+        sha = self._commit(remote, {'Databases/Sales/Views/Totals.sql': 'CREATE VIEW Totals AS SELECT 1 AS Total'})
+        server = WebhookServer(listener, secret='secret', port=0, coalesce_delay=0.2).start()
+        try:
+            port = server.server_address[1]
+            self.assertEqual(self._post(port, {'ref': 'refs/heads/main', 'after': sha})[0], 401)
+            self.assertEqual(
+                self._post(port, {'ref': 'refs/heads/other', 'after': sha}, 'secret'),
+                (202, {'status': 'ignored', 'ref': 'refs/heads/other'})
+            )
+            for _ in range(3):
+                status, body = self._post(port, {'ref': 'refs/heads/main', 'after': sha}, 'secret')
+                self.assertEqual((status, body['status']), (202, 'queued'))
+            self._wait_for(lambda: server.runs)
+            time.sleep(0.5)
+        finally:
+            server.stop()
+
+        self.assertEqual(server.runs, 1)
+        self.assertEqual(self.server.databases['master'].changelog[-1], sha)
+
+    def test_listener_shallow_partial_sparse_clone(self):
+        self.server.add_database('Hr')
+        path = self.config['https_url']
+        # Local paths are hardlinked by git, depth and filters need a transport.
+        self.config.update(
+            https_url='file://' + path, clone_depth=1, partial_clone=True, sparse_databases=['Sales']
+        )
+        remote = Repo.init(path, initial_branch='main')
+        remote.git.config('uploadpack.allowFilter', 'true')
+        self.server.databases['master'].changelog.append(self._commit(remote, {'README.md': '# Databases'}))
+        listener = Listener(self.config, changelog_path=os.path.join(self.tmp, 'changelog.csv'))
+        self._commit(remote, {'Databases/Sales/Views/Old.sql': 'CREATE VIEW Old AS SELECT 1 AS Id'})
+        sha = self._commit(remote, {
+            'Databases/Sales/Views/Totals.sql': 'CREATE VIEW Totals AS SELECT 1 AS Total',
+            'Databases/Hr/Views/People.sql': 'CREATE VIEW People AS SELECT 1 AS Id',
+        })
+
+        # The last deployed commit is beyond the depth, it is fetched on demand.
+        commit_id, is_failed, _ = listener.handle_changes()
+
+        self.assertEqual((commit_id, is_failed), (sha, False))
+        local = Repo(self.config['local_path'])
+        self.assertTrue(os.path.exists(os.path.join(local.git_dir, 'shallow')))
+        self.assertEqual(local.git.config('remote.origin.partialclonefilter'), 'blob:none')
+        self.assertFalse(os.path.exists(os.path.join(self.config['local_path'], 'Databases', 'Hr')))
+        sales = self.server.databases['Sales']
+        self.assertIsNotNone(sales.get('dbo', 'Old'))
+        self.assertIsNotNone(sales.get('dbo', 'Totals'))
+        self.assertEqual(self.server.databases['Hr'].objects, {})
+
+    def test_listener_bare_mode(self):
+        self.config['bare'] = True
+        remote, listener = self._remote()
+        self._commit(remote, {'Databases/Sales/Views/Totals.sql': 'CREATE VIEW Totals AS SELECT 1 AS Total'})
+
+        listener.handle_changes()
+        sha = self._commit(remote, {
+            'Databases/Sales/Views/Totals.sql': 'CREATE OR ALTER VIEW Totals AS SELECT 2 AS Total',
+            'Databases/Sales/Views/Daily.sql': 'CREATE VIEW Daily AS SELECT 1 AS Total',
+        })
+        commit_id, is_failed, _ = listener.handle_changes()
+
+        self.assertEqual((commit_id, is_failed), (sha, False))
+        local = Repo(self.config['local_path'])
+        self.assertTrue(local.bare)
+        self.assertEqual(local.commit('refs/heads/main').hexsha, sha)
+        sales = self.server.databases['Sales']
+        self.assertIn('SELECT 2', sales.get('dbo', 'Totals').definition)
+        self.assertIsNotNone(sales.get('dbo', 'Daily'))
+
+    def test_change_set_renames_and_deletes(self):
+        repo = Repo.init(os.path.join(self.tmp, 'changes'), initial_branch='main')
+        body = 'CREATE PROCEDURE dbo.GetOrders\nAS\nSELECT Id, Total, CreatedAt FROM dbo.Orders\n'
+        source = self._commit(repo, {
+            'Databases/Sales/Stored-Procedures/GetOrders.sql': body,
+            'Databases/Sales/Tables/Legacy.sql': 'CREATE TABLE Legacy (Id int)',
+            'Databases/Sales/Views/Totals.sql': 'CREATE VIEW Totals AS SELECT 1 AS Total',
+            'docs/Orders.sql': 'SELECT 1',
+        })
+        target = self._commit(repo, {
+            'Databases/Sales/Stored-Procedures/GetOrders.sql': None,
+            'Databases/Sales/Stored-Procedures/[sales].[GetOrders].sql': body,
+            'Databases/Sales/Tables/Legacy.sql': None,
+            'Databases/Sales/Views/Totals.sql': 'CREATE OR ALTER VIEW Totals AS SELECT 2 AS Total',
+            'Databases/Sales/DMLs/Seed.sql': 'INSERT INTO Legacy VALUES (1)',
+            'docs/Orders.sql': None,
+        })
+
+        changes = ChangeSet(repo, source, target)
+
+        self.assertEqual([(x.path, x.status) for x in changes], [
+            ('Databases/Sales/Views/Totals.sql', 'M'),
+            ('Databases/Sales/Stored-Procedures/[sales].[GetOrders].sql', 'R'),
+            ('Databases/Sales/DMLs/Seed.sql', 'A'),
+        ])
+        self.assertEqual(len(changes), 3)
+        self.assertEqual(sorted((x.path, x.status) for x in changes.deleted), [
+            ('Databases/Sales/Stored-Procedures/GetOrders.sql', 'D'),
+            ('Databases/Sales/Tables/Legacy.sql', 'D'),
+        ])
+        renamed = list(changes)[1]
+        self.assertEqual(renamed.blob, repo.commit(target).tree[renamed.path].hexsha)
+
+    def _history_with_merge(self, remote):
+        """ Commits a range with repeated edits, a short lived script and an evil merge. """
+        self._commit(remote, {
+            'Databases/Sales/Views/Totals.sql': 'CREATE VIEW Totals AS SELECT 1 AS Total',
+            'Databases/Sales/Views/Temp.sql': 'CREATE VIEW Temp AS SELECT 1 AS Id',
+        })
+        self._commit(remote, {
+            'Databases/Sales/Views/Totals.sql': 'CREATE OR ALTER VIEW Totals AS SELECT 2 AS Total',
+            'Databases/Sales/Views/Temp.sql': None,
+        })
+        remote.git.checkout('-b', 'feature')
+        self._commit(remote, {'Databases/Sales/Views/Feature.sql': 'CREATE VIEW Feature AS SELECT 1 AS Id'})
+        remote.git.checkout('main')
+        self._commit(remote, {'Databases/Sales/Views/Totals.sql': 'CREATE OR ALTER VIEW Totals AS SELECT 3 AS Total'})
+        remote.git.merge('feature', no_commit=True, no_ff=True, env={
+            'GIT_COMMITTER_NAME': ACTOR.name, 'GIT_COMMITTER_EMAIL': ACTOR.email
+        })
+        # Evil merge: a change found in the merge commit only.
+        path = os.path.join(remote.working_tree_dir, 'Databases', 'Sales', 'Views', 'Evil.sql')
+        with open(path, mode='w', encoding='utf-8') as f:
+            f.write('CREATE VIEW Evil AS SELECT 1 AS Id')
+        remote.index.add([path])
+        parents = [remote.head.commit, remote.commit('feature')]
+        return remote.index.commit('merge', parent_commits=parents, author=ACTOR, committer=ACTOR).hexsha
+
+    def test_listener_coalesce_replay(self):
+        remote, listener = self._remote(replay='coalesce')
+        sha = self._history_with_merge(remote)
+        self.assertEqual(len(remote.commit(sha).parents), 2)
+
+        commit_id, is_failed, _ = listener.handle_changes()
+
+        self.assertEqual((commit_id, is_failed), (sha, False))
+        log = self.server.databases['master'].execution_log
+        self.assertEqual([(x[1], x[2]) for x in log], [
+            (sha, 'Databases/Sales/Views/Evil.sql'),
+            (sha, 'Databases/Sales/Views/Feature.sql'),
+            (sha, 'Databases/Sales/Views/Totals.sql'),
+        ])
+        # The blob of the final content, i.e. of the target tree.
+        tree = remote.commit(sha).tree
+        self.assertEqual([x[5] for x in log], [tree[x[2]].hexsha for x in log])
+        sales = self.server.databases['Sales']
+        self.assertIn('SELECT 3', sales.get('dbo', 'Totals').definition)
+        self.assertIsNone(sales.get('dbo', 'Temp'))
+
+    def test_listener_per_commit_replay(self):
+        remote, listener = self._remote(replay='per_commit')
+        sha = self._history_with_merge(remote)
+        first_parents = remote.git.rev_list('--first-parent', '--reverse', 'HEAD~4..HEAD').split()
+
+        commit_id, is_failed, _ = listener.handle_changes()
+
+        self.assertEqual((commit_id, is_failed), (sha, False))
+        master = self.server.databases['master']
+        self.assertEqual(master.changelog[-4:], first_parents)
+        log = [(first_parents.index(x[1]), x[2]) for x in master.execution_log]
+        self.assertEqual(log, [
+            (0, 'Databases/Sales/Views/Temp.sql'),
+            (0, 'Databases/Sales/Views/Totals.sql'),
+            (1, 'Databases/Sales/Views/Totals.sql'),
+            (2, 'Databases/Sales/Views/Totals.sql'),
+            (3, 'Databases/Sales/Views/Evil.sql'),
+            (3, 'Databases/Sales/Views/Feature.sql'),
+        ])
+        self.assertIn('SELECT 3', self.server.databases['Sales'].get('dbo', 'Totals').definition)
+
+    def test_listener_skip_unchanged(self):
+        remote, listener = self._remote()
+        initial = self.server.databases['master'].changelog[-1]
+        changelog_path = os.path.join(self.tmp, 'changelog.csv')
+        self._commit(remote, {
+            'Databases/Sales/Views/Totals.sql': 'CREATE OR ALTER VIEW Totals AS SELECT 1 AS Total',
+            'Databases/Sales/Views/Daily.sql': 'CREATE OR ALTER VIEW Daily AS SELECT 1 AS Total',
+        })
+        listener.handle_changes()
+        scripts, queries = self.server.stats['scripts'], self.server.stats['DEPLOYED_BLOBS']
+        daily = 'Databases/Sales/Views/Daily.sql'
+        sha = self._commit(remote, {daily: 'CREATE OR ALTER VIEW Daily AS SELECT 2 AS Total'})
+        # E.g. the changelog of a restored database, Totals is already deployed with the same content.
+        self.server.databases['master'].changelog.append(initial)
+
+        commit_id, is_failed, _ = Listener(self.config, changelog_path=changelog_path).handle_changes()
+
+        self.assertEqual((commit_id, is_failed), (sha, False))
+        self.assertEqual(self.server.stats['scripts'], scripts + 1)
+        self.assertEqual(self.server.stats['DEPLOYED_BLOBS'], queries + 1)
+        log = self.server.databases['master'].execution_log
+        self.assertEqual([x[2] for x in log if x[1] == sha], [daily])
+
+        self._commit(remote, {daily: 'CREATE OR ALTER VIEW Daily AS SELECT 3 AS Total'})
+        self.server.databases['master'].changelog.append(initial)
+        Listener(self.config, changelog_path=changelog_path, skip_unchanged=False).handle_changes()
+        self.assertEqual(self.server.stats['scripts'], scripts + 3)
+        self.assertEqual(self.server.stats['DEPLOYED_BLOBS'], queries + 1)
+
+    def test_listener_drift(self):
+        remote, listener = self._remote()
+        self._commit(remote, {
+            'Databases/Sales/Views/Same.sql': 'CREATE OR ALTER VIEW Same AS SELECT 1 AS Id\r\n',
+            'Databases/Sales/Views/Edited.sql': 'CREATE OR ALTER VIEW Edited AS SELECT 1 AS Id',
+            'Databases/Sales/Views/Dropped.sql': 'CREATE OR ALTER VIEW Dropped AS SELECT 1 AS Id',
+            'Databases/Sales/Tables/Orders.sql': 'CREATE TABLE Orders (Id int)',
+        })
+        listener.handle_changes()
+        sales = self.server.databases['Sales']
+        sales.get('dbo', 'Edited').definition = 'CREATE OR ALTER VIEW Edited AS SELECT 2 AS Id'
+        del sales.objects[('dbo', 'dropped')]
+        self.server.add_object('Sales', 'V', 'dbo', 'Extra', 'CREATE VIEW Extra AS SELECT 1 AS Id')
+        report_path = os.path.join(self.tmp, 'drift.csv')
+
+        drift = listener.detect_drift(report_path=report_path)
+
+        self.assertEqual([x[:4] for x in drift], [
+            ['Sales', 'Views', 'Dropped', 'missing'],
+            ['Sales', 'Views', 'Edited', 'changed'],
+            ['Sales', 'Views', '[dbo].[Extra]', 'extra'],
+        ])
+        self.assertIsNone(drift[2][4])
+        with open(report_path, encoding='utf-8') as f:
+            self.assertEqual(f.readline().strip(), 'DB_NAME,SUB_FOLDER,OBJECT_NAME,STATUS')
+            self.assertEqual(len(f.readlines()), 3)
+        self.assertEqual(listener.detect_drift(databases=['Hr']), [])
+
+        scripts = self.server.stats['scripts']
+        commit_id, is_failed, _ = listener.deploy_drift()
+
+        self.assertTrue(commit_id.startswith('drift-'))
+        self.assertFalse(is_failed)
+        self.assertEqual(self.server.stats['scripts'], scripts + 2)
+        log = self.server.databases['master'].execution_log
+        self.assertEqual(sorted(x[2] for x in log if x[1] == commit_id), [
+            'Databases/Sales/Views/Dropped.sql', 'Databases/Sales/Views/Edited.sql'
+        ])
+        self.assertEqual([x[3] for x in listener.detect_drift()], ['extra'])
+
+    def _export_tree(self, root):
+        files = {}
+        for folder, _, names in os.walk(root):
+            for name in names:
+                path = os.path.join(folder, name)
+                with open(path, encoding='utf-8') as f:
+                    files[os.path.relpath(path, root)] = f.read()
+        return files
+
+    def test_repo_generator_parallel_export(self):
+        for db_name in ('Sales', 'Hr', 'Ops'):
+            self.server.add_object(db_name, 'U', 'dbo', 'Items', columns=[('Id', 'int NOT NULL')])
+            self.server.add_object(db_name, 'V', 'dbo', 'Totals', f'CREATE VIEW Totals AS SELECT \'{db_name}\' AS Db')
+            self.server.add_object(db_name, 'P', 'dbo', 'GetItems', 'CREATE PROCEDURE GetItems AS SELECT 1')
+        serial_path, parallel_path = os.path.join(self.tmp, 'serial'), os.path.join(self.tmp, 'parallel')
+        RepoGenerator(config=self.config, export_path=serial_path).run()
+        self.server.round_trip_latency = 0.02
+        connects = self.server.stats['connects']
+
+        RepoGenerator(config=self.config, export_path=parallel_path, workers=3).run()
+
+        # Databases were exported at the same time, each on its own connection.
+        self.assertGreaterEqual(self.server.stats['connects'] - connects, 2)
+        files, expected = self._export_tree(parallel_path), self._export_tree(serial_path)
+        manifest = '.deploydb_manifest.json'
+        self.assertEqual(json.loads(files.pop(manifest)), json.loads(expected.pop(manifest)))
+        self.assertEqual(files, expected)
+        self.assertEqual(len([x for x in files if x.endswith('.sql')]), 9)
+        totals = files[os.path.join('Databases', 'Ops', 'Views', 'Totals.sql')]
+        self.assertEqual(totals, "CREATE VIEW Totals AS SELECT 'Ops' AS Db\n")
+
+        # Workers waiting for a connection would time out, more than the pool holds are refused.
+        for workers in (0, 6):  # pool_size 5
+            with self.assertRaises(ValueError):
+                RepoGenerator(config=self.config, export_path=os.path.join(self.tmp, 'refused'), workers=workers)
+
+    def test_listener_counts_every_round_trip(self):
+        metrics = Metrics()
+        remote, listener = self._remote(metrics=metrics, dependency_graph=True)
+        self._commit(remote, {
+            'Databases/Sales/Tables/Orders.sql': 'CREATE TABLE Orders (Id INT NOT NULL)',
+            'Databases/Sales/Views/Totals.sql': 'CREATE VIEW Totals AS SELECT COUNT(*) AS Total FROM Orders',
+            'Databases/Sales/DMLs/Seed.sql': 'INSERT INTO Orders VALUES (1)\nGO\nINSERT INTO Orders VALUES (2)',
+        })
+
+        listener.handle_changes()
+        listener.detect_drift()
+        listener.costly_scripts()
+
+        counted = sum(
+            value for (name, _), value in metrics._counters.items() if name == 'deploydb_round_trips_total'
+        )
+        # Only the pool's checkout and reset statements are left out.
+        pool_statements = self.server.stats['checkouts'] + self.server.stats['resets']
+        self.assertEqual(counted, self.server.stats['round_trips'] - pool_statements)
+        phases = {dict(labels)['phase'] for (name, labels) in metrics._counters if name == 'deploydb_round_trips_total'}
+        self.assertTrue({'changelog', 'policy', 'dependencies', 'drift', 'report'} <= phases)
+
+    def test_repo_generator_counts_every_round_trip(self):
+        metrics = Metrics()
+        self.server.add_object('Sales', 'U', 'dbo', 'Orders', columns=[('Id', 'int NOT NULL')])
+        self.server.add_object('Sales', 'V', 'dbo', 'Totals', 'CREATE VIEW Totals AS SELECT 1 AS Total')
+        self.server.add_object('Hr', 'U', 'dbo', 'People', columns=[('Id', 'int NOT NULL')])
+
+        RepoGenerator(
+            config=self.config, export_path=os.path.join(self.tmp, 'export'), fetch_size=1, metrics=metrics
+        ).run()
+
+        counters = {
+            dict(labels)['phase']: value
+            for (name, labels), value in metrics._counters.items() if name == 'deploydb_round_trips_total'
+        }
+        self.assertEqual(sum(counters.values()), self.server.stats['round_trips'] - self.server.stats['checkouts'])
+        self.assertEqual(set(counters), {'export_list', 'export_tables', 'export_objects'})
+
+    def test_listener_rejects_existing_table(self):
+        remote, listener = self._remote()
+        self.server.add_object('Sales', 'U', 'dbo', 'Orders', columns=[('Id', 'int NOT NULL')])
+        self._commit(remote, {'Databases/Sales/Tables/Orders.sql': 'CREATE TABLE Orders (Id INT NOT NULL)'})
+
+        _, is_failed, failures = listener.handle_changes()
+
+        self.assertFalse(is_failed)
+        self.assertEqual(self.server.databases['master'].execution_log, [])
+
+    def test_listener_bundles_module_scripts(self):
+        remote, listener = self._remote()
+        listener.bundle_max_count = 10
+        self._commit(remote, {
+            f'Databases/Sales/Views/V{i}.sql': f"CREATE VIEW V{i} AS SELECT '{i}' AS Id" for i in range(5)
+        })
+
+        _, is_failed, _ = listener.handle_changes()
+
+        self.assertFalse(is_failed)
+        self.assertEqual(self.server.stats['bundles'], 1)
+        self.assertEqual(len(self.server.databases['Sales'].objects), 5)
+
+    def test_listener_metrics(self):
+        events = []
+        metrics = Metrics(
+            textfile_path=os.path.join(self.tmp, 'deploydb.prom'),
+            event_log_path=os.path.join(self.tmp, 'events.jsonl'),
+            hooks=[events.append]
+        )
+        remote, listener = self._remote(metrics=metrics)
+        self._commit(remote, {
+            'Databases/Sales/Views/Totals.sql': 'CREATE VIEW Totals AS SELECT 1 AS Total',
+            'Databases/Sales/DMLs/Broken.sql': "RAISERROR('broken script', 16, 1)",
+        })
+
+        listener.handle_changes()
+
+        phases = {x['phase'] for x in events if x['event'] == 'phase'}
+        self.assertTrue({'pull', 'diff', 'policy', 'duplicate_check', 'execution', 'log_write', 'deploy'} <= phases)
+        with open(os.path.join(self.tmp, 'events.jsonl'), encoding='utf-8') as f:
+            self.assertEqual(len(f.readlines()), len(events))
+        with open(os.path.join(self.tmp, 'deploydb.prom'), encoding='utf-8') as f:
+            text = f.read()
+        self.assertIn('deploydb_files_total{result="success"} 1\n', text)
+        self.assertIn('deploydb_files_total{result="failed"} 1\n', text)
+        self.assertIn('deploydb_failures_total{component="listener"} 1\n', text)
+        self.assertIn('deploydb_phase_seconds_count{phase="execution"} 2\n', text)
+        self.assertIn('deploydb_phase_seconds_bucket{phase="deploy",le="+Inf"} 1\n', text)
+        self.assertTrue(metrics.render(openmetrics=True).endswith('# EOF\n'))
+
+    def test_listener_server_stats(self):
+        remote, listener = self._remote(server_stats=True)
+        self._commit(remote, {
+            'Databases/Sales/Views/Small.sql': 'CREATE VIEW Small AS SELECT 1 AS Id',
+            'Databases/Sales/Views/Large.sql': 'CREATE VIEW Large AS SELECT 1 AS Id' + ' -- padding' * 50,
+            'Databases/Sales/DMLs/Seed.sql': (
+                'CREATE TABLE #Ids (Id INT)\n'
+                'INSERT INTO #Ids VALUES (1);\nUPDATE #Ids SET Id = 2\nGO\n'
+                'DELETE FROM #Ids\nSELECT COUNT(*) FROM #Ids'
+            ),
+        })
+
+        listener.handle_changes()
+
+        ranking = listener.costly_scripts(by='reads', top=1)
+        self.assertEqual([x[1] for x in ranking], ['Databases/Sales/Views/Large.sql'])
+        self.assertGreater(ranking[0][5], 500)
+        self.assertEqual(len(listener.costly_scripts()), 3)
+        # Row counts of the statements of every batch, not the rows returned.
+        ranking = listener.costly_scripts(by='rows')
+        self.assertEqual([x[1] for x in ranking if x[6]], ['Databases/Sales/DMLs/Seed.sql'])
+        self.assertEqual(ranking[0][6], 3)
+        with self.assertRaises(ValueError):
+            listener.costly_scripts(by='size')
+
+    def test_connection_pool(self):
+        pool = ConnectionPool('DRIVER=fake', max_size=2, idle_timeout=300)
+        first = pool.checkout('Sales')
+        pool.checkin(first, 'Sales')
+        self.assertIs(pool.checkout('master'), first)  # reused, switched by the checkout statement
+        self.assertEqual(first.db_name, 'master')
+
+        # A reused connection failing on the checkout statement is replaced.
+        first.close()
+        pool.checkin(first, 'master')
+        second = pool.checkout('master')
+        self.assertIsNot(second, first)
+        self.assertFalse(second.closed)
+
+        # Idle connections are closed after `idle_timeout`.
+        pool.checkin(second, 'master')
+        pool.idle_timeout = 0
+        third = pool.checkout('Sales')
+        self.assertTrue(second.closed)
+        self.assertEqual(third.db_name, 'Sales')
+
+        # Broken connections are closed and free their slot.
+        pool.checkin(third, 'Sales', broken=True)
+        self.assertTrue(third.closed)
+        self.assertEqual(pool._size, 0)
+
+    def test_script_connections_are_reset(self):
+        database = Database(DbCreds(**self.config['db_creds']))
+        with database.connect('Sales', reset=True) as db:
+            shared = db.connection
+            db.execute('SET NOCOUNT ON;')
+        self.assertFalse(shared.closed)
+        self.assertFalse(shared.nocount)
+        self.assertEqual(self.server.stats['resets'], 1)
+
+        # Scripts leaving state a reset does not clear get a connection of their own.
+        with database.connect('Sales', reuse=False) as db:
+            self.assertIs(db.connection, shared)
+        self.assertTrue(shared.closed)
+        self.assertEqual(database.pool._size, 0)
+
+    def test_listener_reuses_script_connections(self):
+        remote, listener = self._remote()
+        self._commit(remote, {
+            **{f'Databases/Sales/DMLs/Update{i}.sql': f'UPDATE Orders SET Total = {i}' for i in range(10)},
+            'Databases/Sales/DMLs/Temp.sql': 'SELECT 1 AS Id INTO #Ids',
+        })
+
+        _, is_failed, _ = listener.handle_changes()
+
+        self.assertFalse(is_failed)
+        self.assertEqual(self.server.stats['resets'], 10)
+        # One login for the master database, one for the scripts and one for the temp table script.
+        self.assertLessEqual(self.server.stats['connects'], 3)
+
+    def test_listener_single_connection_pool(self):
+        # Execution logs are written after the connection of the script is released.
+        self.config['db_creds'].update(pool_size=1, pool_checkout_timeout=2)
+        remote, listener = self._remote(log_durability='file')
+        self._commit(remote, {
+            'Databases/Sales/Views/Totals.sql': 'CREATE VIEW Totals AS SELECT 1 AS Total',
+            'Databases/Sales/DMLs/Broken.sql': "RAISERROR('broken script', 16, 1)",
+        })
+
+        _, is_failed, failures = listener.handle_changes()
+
+        self.assertTrue(is_failed)
+        self.assertEqual([x[0] for x in failures], ['Databases/Sales/DMLs/Broken.sql'])
+        self.assertEqual(len(self.server.databases['master'].execution_log), 2)
+
+    def test_connection_pool_checkout_timeout(self):
+        pool = ConnectionPool('DRIVER=fake', max_size=1, checkout_timeout=0.05)
+        connection = pool.checkout('master')
+        with self.assertRaises(TimeoutError):
+            pool.checkout('master')
+        pool.checkin(connection, 'master')
+        self.assertIs(pool.checkout('master'), connection)
+
+    def test_execution_log_writer_keeps_failed_rows(self):
+        database = Database(DbCreds(**self.config['db_creds']))
+        writer = ExecutionLogWriter(database, 'Logs', batch_size=10)
+        writer.add('abc', 'Databases/Sales/Views/Totals.sql', False, None)
+
+        # The database is not reachable, the row is kept.
+        with self.assertRaises(ValueError):
+            writer.flush()
+        self.server.add_database('Logs')
+        with database.connect('Logs') as db:
+            db.execute(INIT_DEPLOYDB, SCHEMA_VERSION)
+        writer.add('abc', 'Databases/Sales/DMLs/Seed.sql', True, 'x' * 3000, batch=2)
+        writer.flush()
+
+        log = self.server.databases['Logs'].execution_log
+        self.assertEqual([x[2] for x in log], ['Databases/Sales/Views/Totals.sql', 'Databases/Sales/DMLs/Seed.sql'])
+        self.assertEqual(len(log[1][4]), ExecutionLogWriter.max_error_len)
+        self.assertEqual(log[1][6], 2)
+
+    def test_execution_log_writer_drops_rejected_rows(self):
+        metrics = Metrics()
+        database = Database(DbCreds(**self.config['db_creds']))
+        with database.connect('master') as db:
+            db.execute(INIT_DEPLOYDB, SCHEMA_VERSION)
+        writer = ExecutionLogWriter(database, 'master', batch_size=10, metrics=metrics)
+        writer.add('abc', 'Databases/Sales/DMLs/First.sql', False, None)
+        writer.add('abc', 'Databases/Sales/DMLs/' + 'x' * 1000 + '.sql', False, None)
+        writer.add('abc', 'Databases/Sales/DMLs/Last.sql', False, None)
+
+        # The rejected row fails the batch, the others are written once.
+        writer.flush()
+        writer.add('def', 'Databases/Sales/DMLs/Next.sql', False, None)
+        writer.flush()
+
+        log = self.server.databases['master'].execution_log
+        self.assertEqual(
+            [x[2] for x in log],
+            ['Databases/Sales/DMLs/First.sql', 'Databases/Sales/DMLs/Last.sql', 'Databases/Sales/DMLs/Next.sql'],
+        )
+        self.assertEqual(metrics._counters[('deploydb_failures_total', (('component', 'execution_log'),))], 1)
+
+    def test_catalog_snapshot_persistence(self):
+        database = Database(DbCreds(**self.config['db_creds']))
+        cache_path = os.path.join(self.tmp, 'catalog.json')
+        self.server.add_object('Sales', 'U', 'dbo', 'Orders', columns=[('Id', 'int')])
+        catalog = CatalogSnapshot(database, cache_path=cache_path)
+        self.assertTrue(catalog.exists('Sales', 'Tables', 'Orders'))
+        self.assertFalse(catalog.exists('Sales', 'Views', 'Orders'))
+        catalog.save()
+
+        # A restarted listener loads the snapshot and refreshes it incrementally.
+        self.server.add_object('Sales', 'V', 'sales', 'Report', 'CREATE VIEW sales.Report AS SELECT 1')
+        catalog = CatalogSnapshot(database, cache_path=cache_path)
+        self.assertIn('Sales', catalog._dbs)
+        self.assertTrue(catalog.exists('Sales', 'Views', '[sales].[Report]'))
+        self.assertTrue(catalog.exists('Sales', 'Tables', 'orders'))
+        self.assertEqual(self.server.stats['CATALOG_DELTA'], 2)
+        catalog.note_created('Sales', 'Tables', '[sales].[Created]')
+        self.assertTrue(catalog.exists('Sales', 'Tables', '[sales].[Created]'))  # no refresh within a run
+
+        # Dropped objects change the count, the database is scanned again.
+        del self.server.databases['Sales'].objects[('dbo', 'orders')]
+        catalog.begin_run()
+        self.assertFalse(catalog.exists('Sales', 'Tables', 'Orders'))
+        self.assertEqual(self.server.stats['CATALOG_DELTA'], 4)
+
+    def test_database_reraises_statement_errors(self):
+        remote, listener = self._remote()
+        listener._last_changelog_hash()
+        listener._set_changelog('abc')
+        connects = self.server.stats['connects']
+
+        with self.assertRaises(fake_odbc.IntegrityError):
+            listener._set_changelog('abc')
+        listener._set_changelog('def')
+        self.assertEqual(self.server.stats['connects'], connects)
+
+    def test_iter_batches(self):
+        script = io.StringIO(
+            "SELECT 'GO'\n"
+            "/*\nGO\n*/\n"
+            "GO\n"
+            "PRINT 1\n"
+            "GO 3 -- three times\n"
+        )
+        batches = list(iter_batches(script))
+        self.assertEqual([(x[1], x[2]) for x in batches], [(1, 1), (3, 6)])
+        self.assertEqual(batches[0][0], "SELECT 'GO'\n/*\nGO\n*/\n")
+
+    def test_dependency_graph_order(self):
+        scripts = {
+            'Databases/Sales/Views/Report.sql': 'CREATE VIEW Report AS SELECT * FROM dbo.Totals',
+            'Databases/Sales/Views/Totals.sql': 'CREATE VIEW Totals AS SELECT 1 AS Total',
+            'Databases/Sales/Tables/Orders.sql': 'CREATE TABLE Orders (Id INT)',
+        }
+        files = sorted((ChangedFile(x) for x in scripts), key=lambda x: x.sequence)
+        graph = DependencyGraph(files, lambda x: scripts[x.path])
+        self.assertEqual(
+            [x.object_name for x in graph.order()],
+            ['Orders', 'Totals', 'Report']
+        )
+
+    def test_dependency_graph_runs_concurrently(self):
+        scripts = {
+            'Databases/Sales/Views/A.sql': 'CREATE VIEW A AS SELECT 1 AS Id',
+            'Databases/Sales/Views/B.sql': 'CREATE VIEW B AS SELECT 1 AS Id',
+            'Databases/Sales/Views/C.sql': 'CREATE VIEW C AS SELECT 1 AS Id',
+            'Databases/Sales/Views/D.sql': 'CREATE VIEW D AS SELECT * FROM dbo.A',
+        }
+        graph = DependencyGraph([ChangedFile(x) for x in scripts], lambda x: scripts[x.path])
+        lock = threading.Lock()
+        running = []
+        peak = []
+        finished = {}
+
+        def execute(file):
+            with lock:
+                running.append(file.object_name)
+                peak.append(len(running))
+                if file.object_name == 'D':
+                    self.assertIn('A', finished)
+            time.sleep(0.05)
+            with lock:
+                running.remove(file.object_name)
+                finished[file.object_name] = True
+
+        graph.run(execute, max_workers=3)
+
+        self.assertEqual(set(finished), {'A', 'B', 'C', 'D'})
+        self.assertEqual(max(peak), 3)
+
+    def test_listener_dependency_graph_workers(self):
+        with self.assertRaises(ValueError):  # 6 workers, pool_size 5
+            Listener(self.config, dependency_graph=True, max_workers=2, max_workers_per_db=3)
+
+        self.server.add_database('Hr')
+        remote, listener = self._remote(dependency_graph=True, max_workers=2, max_workers_per_db=2)
+        self._commit(remote, {
+            'Databases/Sales/Views/Report.sql': 'CREATE VIEW Report AS SELECT * FROM dbo.Totals',
+            'Databases/Sales/Views/Totals.sql': 'CREATE VIEW Totals AS SELECT 1 AS Total',
+            'Databases/Sales/Views/Other.sql': 'CREATE VIEW Other AS SELECT 1 AS Id',
+            'Databases/Hr/Views/People.sql': 'CREATE VIEW People AS SELECT 1 AS Id',
+        })
+
+        _, is_failed, _ = listener.handle_changes()
+
+        self.assertFalse(is_failed)
+        folders = [x[2] for x in self.server.databases['master'].execution_log]
+        self.assertEqual(len(folders), 4)
+        self.assertLess(
+            folders.index('Databases/Sales/Views/Totals.sql'),
+            folders.index('Databases/Sales/Views/Report.sql')
+        )
+
+    def test_listener_dependency_graph_database_failure(self):
+        remote, listener = self._remote(dependency_graph=True)
+        self._commit(remote, {
+            'Databases/Sales/Views/Totals.sql': 'CREATE VIEW Totals AS SELECT 1 AS Total',
+            'Databases/Missing/Views/Report.sql': 'CREATE VIEW Report AS SELECT 1 AS Id',
+            'Databases/Missing/Views/Other.sql': 'CREATE VIEW Other AS SELECT 1 AS Id',
+        })
+
+        _, is_failed, failures = listener.handle_changes()
+
+        # Dependencies of the missing database can not be read, each of its scripts fails.
+        self.assertTrue(is_failed)
+        self.assertEqual(
+            sorted(x[0] for x in failures),
+            ['Databases/Missing/Views/Other.sql', 'Databases/Missing/Views/Report.sql']
+        )
+        self.assertIsNotNone(self.server.databases['Sales'].get('dbo', 'Totals'))
+
+    def test_split_object_name(self):
+        self.assertEqual(split_object_name('Orders'), ('dbo', 'Orders'))
+        self.assertEqual(split_object_name('[sales].[My Orders]'), ('sales', 'My Orders'))
 
-    def test_000_something(self):
-        """Test something."""
+    def test_webhook_signature(self):
+        body = b'{"ref": "refs/heads/main"}'
+        signature = 'sha256=' + hmac.new(b'secret', body, hashlib.sha256).hexdigest()
+        self.assertTrue(verify_signature('secret', body, {'X-Hub-Signature-256': signature}))
+        self.assertFalse(verify_signature('secret', body, {'X-Hub-Signature-256': 'sha256=0'}))
+        self.assertTrue(verify_signature('secret', body, {'X-Gitlab-Token': 'secret'}))
+        self.assertEqual(parse_push({'branch': 'main', 'sha': 'abc'}), ('refs/heads/main', 'abc'))